@@ -0,0 +1,93 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark memory use of long-lived protocol data objects.
+
+The data objects store their attributes in slots. For each class, this
+creates many instances and reports the growth of the resident set size per
+object, next to that of an equivalent class with a per-instance
+C{__dict__}, as these classes used to have.
+
+Every measurement runs in a fresh process, as the resident set size does
+not shrink when objects are freed.
+"""
+
+import resource
+import subprocess
+import sys
+
+from twisted.words.protocols.jabber.jid import JID
+
+from wokkel import data_form, disco, muc, pubsub, xmppim
+
+entity = JID(u'user@example.org')
+
+CASES = {
+    'RosterItem': lambda: xmppim.RosterItem(entity, True, True, u'User'),
+    'User': lambda: muc.User(u'thirdwitch', entity),
+    'AdminItem': lambda: muc.AdminItem(u'member', u'participant', entity),
+    'Subscription': lambda: pubsub.Subscription(u'test', entity,
+                                                u'subscribed'),
+    'DiscoItem': lambda: disco.DiscoItem(entity, u'test', u'Test'),
+    'DiscoIdentity': lambda: disco.DiscoIdentity(u'pubsub', u'service'),
+    'Field': lambda: data_form.Field(var=u'test', value=u'value'),
+    'Option': lambda: data_form.Option(u'value', u'Label'),
+    }
+
+def withDict(factory):
+    """
+    Make a factory for copies of objects with a per-instance C{__dict__}.
+    """
+    Class = factory().__class__
+    Unslotted = type(Class.__name__, (object,), {})
+
+    def make():
+        obj = factory()
+        copy = Unslotted()
+        for name in Class.__slots__:
+            if name not in ('__dict__', '__weakref__'):
+                setattr(copy, name, getattr(obj, name))
+        return copy
+
+    return make
+
+
+
+def measure(name, slotted, count):
+    factory = CASES[name]
+    if not slotted:
+        factory = withDict(factory)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    objects = [factory() for _ in xrange(count)]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux.
+    print (after - before) * 1024.0 / len(objects)
+
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3] == 'True', int(sys.argv[4]))
+        return
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    for name in sorted(CASES):
+        results = []
+        for slotted in (False, True):
+            process = subprocess.Popen([sys.executable, __file__,
+                                        '--measure', name,
+                                        str(slotted), str(count)],
+                                       stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            results.append(float(output))
+        print ("%-14s dict=%6.1f bytes slots=%6.1f bytes saved=%5.1f%%" %
+               (name, results[0], results[1],
+                100 * (1 - results[1] / results[0])))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark the cost of tracking IQ request timeouts in L{StreamManager}.
+
+This issues a large number of IQ requests with a timeout, so that they are
+all in flight at the same time, and then has them all answered. The
+scheduling cost is compared between a delayed call per request and batched
+tracking with L{TimeoutTracker}, for issuing the requests, for reactor
+iterations while the requests are in flight, for answering the requests and
+for the reactor to clean up after them.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.words.xish import domish
+
+from wokkel.generic import Request
+from wokkel.subprotocols import StreamManager
+
+class DummyFactory(object):
+    def addBootstrap(self, event, callback):
+        pass
+
+
+
+def run(count, resolution):
+    streamManager = StreamManager(DummyFactory(), reactor)
+    streamManager.timeoutResolution = resolution
+    streamManager.send = lambda obj: None
+
+    start = time.time()
+    for i in xrange(count):
+        request = Request()
+        request.stanzaID = str(i)
+        request.timeout = 30
+        streamManager.request(request)
+    scheduled = time.time()
+
+    pending = len(reactor.getDelayedCalls())
+
+    # Simulate reactor iterations while the requests are in flight.
+    for i in xrange(1000):
+        reactor.runUntilCurrent()
+        reactor.timeout()
+    iterated = time.time()
+
+    for i in xrange(count):
+        response = domish.Element((None, 'iq'))
+        response['type'] = 'result'
+        response['id'] = str(i)
+        streamManager._onIQResponse(response)
+    answered = time.time()
+
+    # Let the reactor clean up cancelled delayed calls.
+    reactor.runUntilCurrent()
+    cleaned = time.time()
+
+    print ("resolution=%-5s requests=%d delayed calls=%-7d schedule=%.3fs "
+           "iterate=%.3fs answer=%.3fs cleanup=%.3fs" % (
+                resolution, count, pending,
+                scheduled - start, iterated - scheduled,
+                answered - iterated, cleaned - answered))
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    run(count, None)
+    run(count, 1)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark parsing serialized stanzas.
+
+This compares L{parseXml}, which sets up a new parser for every stanza,
+with a reused L{XmlParser}, parsing stanzas one at a time and as a batch of
+concatenated stanzas, like when replaying captured traffic.
+"""
+
+import sys
+import time
+
+from wokkel.generic import XmlParser, parseXml
+
+STANZAS = [
+    "<message from='user%d@example.org/Home' to='other@example.org' "
+        "type='chat' id='m%d'><body>Hello, world!</body>"
+        "<active xmlns='http://jabber.org/protocol/chatstates'/></message>",
+    "<presence from='user%d@example.org/Home' id='p%d'><show>away</show>"
+        "<status>Out to lunch</status><priority>5</priority></presence>",
+    "<iq from='user%d@example.org/Home' to='example.org' type='get' "
+        "id='i%d'><query xmlns='http://jabber.org/protocol/disco#info'/>"
+        "</iq>",
+    ]
+
+def report(name, count, elapsed):
+    print ("%-22s stanzas=%d time=%.3fs (%.0f stanzas/s)" %
+           (name, count, elapsed, count / elapsed))
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    stanzas = [STANZAS[i % len(STANZAS)] % (i, i) for i in xrange(count)]
+
+    start = time.time()
+    for stanza in stanzas:
+        parseXml(stanza)
+    report("parseXml", count, time.time() - start)
+
+    parser = XmlParser()
+    start = time.time()
+    for stanza in stanzas:
+        parser.parse(stanza)
+    report("XmlParser.parse", count, time.time() - start)
+
+    data = ''.join(stanzas)
+    start = time.time()
+    parsed = sum(1 for _ in parser.parseStanzas(data))
+    report("XmlParser.parseStanzas", parsed, time.time() - start)
+
+
+
+if __name__ == '__main__':
+    main()
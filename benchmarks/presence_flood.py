@@ -0,0 +1,52 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark handling a presence flood.
+
+Addresses of parsed stanzas are only turned into JIDs when accessed. This
+parses a flood of presence stanzas from many distinct senders, like after
+joining a large room or logging in with a large roster, where the handler
+only looks at the availability and priority. For comparison, the eager
+runs access the sender and recipient of every presence, like parsing
+used to do.
+"""
+
+import sys
+import time
+
+from wokkel.generic import parseXml
+from wokkel.xmppim import AvailabilityPresence
+
+def run(elements, eager):
+    start = time.time()
+    for element in elements:
+        presence = AvailabilityPresence.fromElement(element)
+        if eager:
+            presence.sender
+            presence.recipient
+        presence.available, presence.priority
+    elapsed = time.time() - start
+
+    print ("eager=%-5s stanzas=%d time=%.3fs (%.0f stanzas/s)" %
+           (eager, len(elements), elapsed, len(elements) / elapsed))
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    for eager in (True, False):
+        # Use distinct addresses on every run, so that JIDs interned in a
+        # previous run are not reused.
+        elements = [parseXml("<presence from='user%d-%s@example.org/Home' "
+                             "to='other@example.org/%d'>"
+                             "<priority>5</priority></presence>" %
+                             (i, eager, i))
+                    for i in xrange(count)]
+        run(elements, eager)
+
+
+
+if __name__ == '__main__':
+    main()
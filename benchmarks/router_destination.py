@@ -0,0 +1,61 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark finding the route for stanzas to many distinct addresses.
+
+The router takes the host name from the destination address without
+parsing it into a JID. For comparison, the parsed runs parse every
+destination with stringprep first, like the router used to.
+"""
+
+import sys
+import time
+
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.xish import domish
+
+from wokkel.component import Router
+
+class Sink(object):
+    """
+    Route destination that drops all stanzas.
+    """
+
+    def addObserver(self, *args, **kwargs):
+        pass
+
+
+    def send(self, stanza):
+        pass
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    for parsed in (True, False):
+        router = Router()
+        router.addRoute('muc.example.org', Sink())
+
+        stanzas = []
+        for index in xrange(count):
+            stanza = domish.Element((None, 'message'))
+            stanza['to'] = (u'room%d-%s@muc.example.org/Nick%d' %
+                            (index, parsed, index))
+            stanzas.append(stanza)
+
+        start = time.time()
+        for stanza in stanzas:
+            if parsed:
+                JID(stanza['to'])
+            router.route(stanza)
+        elapsed = time.time() - start
+
+        print ("parsed=%-5s stanzas=%d time=%.3fs (%.0f stanzas/s)" %
+               (parsed, count, elapsed, count / elapsed))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark parsing presence and message stanzas into L{Stanza} objects.
+
+Child element parsers are accumulated once per stanza class. To compare
+with accumulating them for every stanza, the uncached runs clear the
+per-class cache before parsing each stanza.
+"""
+
+import sys
+import time
+
+from wokkel.generic import parseXml
+from wokkel.muc import GroupChat, UserPresence
+from wokkel.xmppim import AvailabilityPresence, Message
+
+CASES = [
+    (AvailabilityPresence,
+     "<presence from='user@example.org/Home' to='other@example.org'>"
+        "<show>away</show><status>Out to lunch</status>"
+        "<priority>5</priority></presence>"),
+    (UserPresence,
+     "<presence from='room@muc.example.org/thirdwitch' "
+        "to='user@example.org/Home'>"
+        "<x xmlns='http://jabber.org/protocol/muc#user'>"
+        "<item affiliation='member' role='participant'/>"
+        "<status code='110'/></x></presence>"),
+    (Message,
+     "<message from='user@example.org/Home' to='other@example.org' "
+        "type='chat'><body>Hello</body></message>"),
+    (GroupChat,
+     "<message from='room@muc.example.org/thirdwitch' "
+        "to='user@example.org/Home' type='groupchat'>"
+        "<body>Hello</body>"
+        "<delay xmlns='urn:xmpp:delay' stamp='2002-10-13T23:58:37Z'/>"
+        "</message>"),
+    ]
+
+def run(Class, xml, count, cached):
+    elements = [parseXml(xml) for _ in xrange(count)]
+
+    start = time.time()
+    if cached:
+        for element in elements:
+            Class.fromElement(element)
+    else:
+        for element in elements:
+            if '_childParserCache' in Class.__dict__:
+                del Class._childParserCache
+            Class.fromElement(element)
+    elapsed = time.time() - start
+
+    print ("%-20s cached=%-5s stanzas=%d time=%.3fs (%.0f stanzas/s)" %
+           (Class.__name__, cached, count, elapsed, count / elapsed))
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    for Class, xml in CASES:
+        run(Class, xml, count, False)
+        run(Class, xml, count, True)
+
+
+
+if __name__ == '__main__':
+    main()
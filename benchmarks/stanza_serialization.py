@@ -0,0 +1,64 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark serializing presence and message stanzas.
+
+This compares building an element with C{toElement} and serializing it,
+like sending a stanza's element does, with C{toBytes}, which serializes
+the stanza's fields directly.
+"""
+
+import sys
+import time
+from datetime import datetime
+
+from dateutil.tz import tzutc
+from twisted.words.protocols.jabber.jid import JID
+
+from wokkel.delay import Delay
+from wokkel.muc import GroupChat
+from wokkel.xmppim import AvailabilityPresence, Message
+
+sender = JID(u'user@example.org/Home')
+recipient = JID(u'other@example.org')
+
+def makeGroupChat():
+    message = GroupChat(recipient, sender, body=u'Hello & welcome')
+    message.delay = Delay(datetime(2002, 10, 13, 23, 58, 37, tzinfo=tzutc()))
+    return message
+
+CASES = [
+    lambda: AvailabilityPresence(recipient, sender, show='away',
+                                 status=u'Out to lunch', priority=5),
+    lambda: Message(recipient, sender, body=u'Hello, <world>!'),
+    makeGroupChat,
+    ]
+
+def run(stanza, count, direct):
+    start = time.time()
+    if direct:
+        for _ in xrange(count):
+            stanza.toBytes()
+    else:
+        for _ in xrange(count):
+            stanza.toElement().toXml().encode('utf-8')
+    elapsed = time.time() - start
+
+    print ("%-20s direct=%-5s stanzas=%d time=%.3fs (%.0f stanzas/s)" %
+           (stanza.__class__.__name__, direct, count, elapsed,
+            count / elapsed))
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    for factory in CASES:
+        stanza = factory()
+        run(stanza, count, False)
+        run(stanza, count, True)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark routing with many wildcard routes.
+
+This adds a wildcard route per tenant, like C{*.tenant42.example.com}, and
+routes stanzas to subdomains of random tenants. For comparison, the linear
+runs find the matching route by checking every route, like a router
+without the suffix trie would.
+"""
+
+import random
+import sys
+import time
+
+from twisted.words.xish import domish
+
+from wokkel.component import Router
+
+class Sink(object):
+    """
+    Route destination that drops all stanzas.
+    """
+
+    def addObserver(self, *args, **kwargs):
+        pass
+
+
+    def removeObserver(self, *args, **kwargs):
+        pass
+
+
+    def send(self, stanza):
+        pass
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    stanzaCount = 20000
+
+    router = Router()
+    sink = Sink()
+    start = time.time()
+    for index in xrange(count):
+        router.addRoute('*.tenant%d.example.com' % index, sink)
+    elapsed = time.time() - start
+    print "added %d routes in %.3fs" % (count, elapsed)
+
+    stanzas = []
+    for _ in xrange(stanzaCount):
+        stanza = domish.Element((None, 'message'))
+        stanza['to'] = 'room@muc.tenant%d.example.com' % random.randrange(count)
+        stanzas.append(stanza)
+
+    start = time.time()
+    for stanza in stanzas:
+        router.route(stanza)
+    elapsed = time.time() - start
+    print ("trie   stanzas=%d time=%.3fs (%.0f stanzas/s)" %
+           (stanzaCount, elapsed, stanzaCount / elapsed))
+
+    # Linear scan over a tenth of the stanzas, as it is much slower.
+    suffixes = [key[1:] for key in router.routes]
+    stanzas = stanzas[:stanzaCount / 10]
+    start = time.time()
+    for stanza in stanzas:
+        host = stanza['to'].split('@')[1]
+        for suffix in suffixes:
+            if host.endswith(suffix):
+                break
+    elapsed = time.time() - start
+    print ("linear stanzas=%d time=%.3fs (%.0f stanzas/s)" %
+           (len(stanzas), elapsed, len(stanzas) / elapsed))
+
+    start = time.time()
+    for index in xrange(count):
+        router.removeRoute('*.tenant%d.example.com' % index, sink)
+    elapsed = time.time() - start
+    print "removed %d routes in %.3fs" % (count, elapsed)
+
+
+
+if __name__ == '__main__':
+    main()
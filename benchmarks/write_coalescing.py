@@ -0,0 +1,84 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark write coalescing in L{StreamManager}.
+
+This simulates a fan-out, where a single event results in many stanzas
+being sent within one reactor iteration, and counts the number of write
+system calls and the time taken, with and without coalescing writes. The
+transport writes to C{/dev/null}, so that every write is a real system
+call.
+"""
+
+import os
+import sys
+import time
+
+from twisted.internet import task
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.xish import domish
+
+from wokkel.subprotocols import StreamManager
+
+class NullTransport(object):
+    """
+    Transport that writes to C{/dev/null} and counts system calls.
+    """
+    disconnecting = False
+
+    def __init__(self):
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+        self.syscalls = 0
+
+
+    def write(self, data):
+        self.syscalls += 1
+        os.write(self.fd, data)
+
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+
+
+def run(count, coalesce):
+    clock = task.Clock()
+    factory = xmlstream.XmlStreamFactory(xmlstream.Authenticator())
+    streamManager = StreamManager(factory, clock)
+    streamManager.coalesceWrites = coalesce
+
+    xs = factory.buildProtocol(None)
+    transport = NullTransport()
+    xs.makeConnection(transport)
+    xs.dataReceived("<stream:stream xmlns='jabber:client' "
+                    "xmlns:stream='http://etherx.jabber.org/streams' "
+                    "from='example.com' id='12345'>")
+    xs.dispatch(xs, xmlstream.STREAM_AUTHD_EVENT)
+    clock.advance(0)
+    transport.syscalls = 0
+
+    start = time.time()
+    for i in xrange(count):
+        message = domish.Element((None, 'message'))
+        message['to'] = 'user%d@example.org' % i
+        message.addElement('body', content='Notification')
+        streamManager.send(message)
+    clock.advance(0)
+    elapsed = time.time() - start
+
+    print ("coalesce=%-5s stanzas=%d syscalls=%-6d time=%.3fs "
+           "(%.0f stanzas/s)" % (coalesce, count, transport.syscalls, elapsed,
+                                 count / elapsed))
+
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    run(count, False)
+    run(count, True)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Benchmark request/response chains through an L{XmlPipe}.
+
+Both ends of the pipe answer a ping with another ping, until the count in
+the ping reaches zero. When dispatching directly, every response recurses
+through the observers of both ends, so that long chains exceed the
+recursion limit. In queued mode, the chain is dispatched iteratively.
+"""
+
+import sys
+import time
+
+from twisted.internet import task
+from twisted.words.xish import domish
+
+from wokkel.generic import XmlPipe
+
+def run(queued, length):
+    pipe = XmlPipe(queued=queued, batchSize=length + 1, reactor=task.Clock())
+    received = []
+
+    def onPing(element):
+        received.append(None)
+        count = int(element['count'])
+        if count:
+            ping = domish.Element((None, 'ping'))
+            ping['count'] = str(count - 1)
+            element.send(ping)
+
+    def onSourcePing(element):
+        element.send = pipe.source.send
+        onPing(element)
+
+    def onSinkPing(element):
+        element.send = pipe.sink.send
+        onPing(element)
+
+    pipe.source.addObserver('/ping', onSourcePing)
+    pipe.sink.addObserver('/ping', onSinkPing)
+
+    ping = domish.Element((None, 'ping'))
+    ping['count'] = str(length)
+
+    start = time.time()
+    try:
+        pipe.source.send(ping)
+    except RuntimeError:
+        pass
+    elapsed = time.time() - start
+
+    if len(received) <= length:
+        print ("queued=%-5s length=%d aborted after %d stanzas" %
+               (queued, length, len(received)))
+        return
+
+    print ("queued=%-5s length=%d time=%.3fs (%.0f stanzas/s)" %
+           (queued, length, elapsed, (length + 1) / elapsed))
+
+
+
+def main():
+    for length in (50, int(sys.argv[1]) if len(sys.argv) > 1 else 100000):
+        run(False, length)
+        run(True, length)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,83 @@ that should probably eventually move there.
 """
 
 from twisted.application import service
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.names.srvconnect import SRVConnector
 from twisted.words.protocols.jabber import client, sasl, xmlstream
+from twisted.words.xish import domish
 
 from wokkel import generic
-from wokkel.subprotocols import StreamManager
+from wokkel.subprotocols import NS_SM, StreamManager
+
+class StreamResumptionInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    """
+    Initializer that resumes a previous stream.
+
+    This implements stream resumption, as described in
+    U{XEP-0198<http://xmpp.org/extensions/xep-0198.html>}. It is to be
+    placed before resource binding, and if a previous stream was
+    successfully resumed, resource binding and session establishment are
+    skipped. Otherwise, those proceed as usual.
+
+    @ivar streamManager: The stream manager that keeps the state of the
+        previous stream.
+    @type streamManager: L{StreamManager}
+    """
+
+    feature = (NS_SM, 'sm')
+
+    def __init__(self, xs, streamManager):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs)
+        self.streamManager = streamManager
+
+
+    def start(self):
+        info = self.streamManager.resumptionInfo()
+        if info is None:
+            return None
+
+        previd, h = info
+        resume = domish.Element((NS_SM, 'resume'))
+        resume['previd'] = previd
+        resume['h'] = str(h)
+
+        d = defer.Deferred()
+        resumedQuery = '/resumed[@xmlns="%s"]' % NS_SM
+        failedQuery = '/failed[@xmlns="%s"]' % NS_SM
+
+        def onResumed(element):
+            self.xmlstream.removeObserver(failedQuery, onFailed)
+            self.onResumed(element)
+            d.callback(None)
+
+        def onFailed(element):
+            self.xmlstream.removeObserver(resumedQuery, onResumed)
+            self.streamManager.resumptionFailed()
+            d.callback(None)
+
+        self.xmlstream.addOnetimeObserver(resumedQuery, onResumed)
+        self.xmlstream.addOnetimeObserver(failedQuery, onFailed)
+        self.xmlstream.send(resume)
+        return d
+
+
+    def onResumed(self, element):
+        """
+        The stream was resumed: skip resource binding and session setup.
+        """
+        try:
+            h = int(element.getAttribute('h'))
+        except (TypeError, ValueError):
+            h = 0
+
+        initializers = self.xmlstream.initializers
+        initializers[1:] = [init for init in initializers[1:]
+                            if not isinstance(init,
+                                              (client.BindInitializer,
+                                               client.SessionInitializer))]
+        self.streamManager.streamResumed(h)
+
+
 
 class CheckAuthInitializer(object):
     """
@@ -36,6 +107,13 @@ class CheckAuthInitializer(object):
                 init = initClass(self.xmlstream)
                 init.required = required
                 self.xmlstream.initializers.append(init)
+
+            streamManager = getattr(self.xmlstream.authenticator,
+                                    'streamManager', None)
+            if streamManager is not None:
+                init = StreamResumptionInitializer(self.xmlstream,
+                                                   streamManager)
+                self.xmlstream.initializers.insert(-2, init)
         elif (client.NS_IQ_AUTH_FEATURE, 'auth') in self.xmlstream.features:
             self.xmlstream.initializers.append(
                     client.IQAuthInitializer(self.xmlstream))
@@ -49,9 +127,14 @@ class HybridAuthenticator(xmlstream.ConnectAuthenticator):
 
     This is similar to L{client.XMPPAuthenticator}, but also tries non-SASL
     autentication.
+
+    @ivar streamManager: If set, the stream manager to resume previous
+        streams for, see L{StreamResumptionInitializer}.
+    @type streamManager: L{StreamManager}
     """
 
     namespace = 'jabber:client'
+    streamManager = None
 
     def __init__(self, jid, password):
         xmlstream.ConnectAuthenticator.__init__(self, jid.host)
@@ -83,6 +166,10 @@ def HybridClientFactory(jid, password):
 class XMPPClient(StreamManager, service.Service):
     """
     Service that initiates an XMPP client connection.
+
+    When L{streamManagement<StreamManager.streamManagement>} is enabled,
+    reconnects will attempt to resume the previous stream instead of
+    binding a new resource.
     """
 
     def __init__(self, jid, password, host=None, port=5222):
@@ -94,6 +181,7 @@ class XMPPClient(StreamManager, service.Service):
         factory = HybridClientFactory(jid, password)
 
         StreamManager.__init__(self, factory)
+        factory.authenticator.streamManager = self
 
 
     def startService(self):
@@ -107,6 +195,7 @@ class XMPPClient(StreamManager, service.Service):
 
         self.factory.stopTrying()
         self._connection.disconnect()
+        self._stoppedTrying()
 
 
     def _authd(self, xs):
@@ -7,14 +7,20 @@
 XMPP External Component utilities.
 """
 
+import bisect
+import hashlib
+import random
+
+from zope.interface import implements
+
 from twisted.application import service
 from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
-from twisted.words.protocols.jabber.jid import internJID as JID
-from twisted.words.protocols.jabber import component, error, xmlstream
+from twisted.words.protocols.jabber import component, error, jid, xmlstream
 from twisted.words.xish import domish
 
-from wokkel.generic import XmlPipe
+from wokkel.generic import XmlParser, XmlPipe, internJID
 from wokkel.subprotocols import StreamManager
 
 NS_COMPONENT_ACCEPT = 'jabber:component:accept'
@@ -84,6 +90,7 @@ class Component(StreamManager, service.Service):
 
         self.factory.stopTrying()
         self._connection.disconnect()
+        self._stoppedTrying()
 
 
     def _getConnection(self):
@@ -104,8 +111,14 @@ class InternalComponent(xmlstream.XMPPHandlerCollection, service.Service):
 
     @ivar domains: Domains (as C{str}) this component will handle traffic for.
     @type domains: C{set}
+    @ivar queuedPipe: Whether to connect to the router with an
+        L{XmlPipe} in queued mode, so that stanzas sent in response to
+        received stanzas do not recurse through the router.
+    @type queuedPipe: C{bool}
     """
 
+    queuedPipe = False
+
     def __init__(self, router, domain=None):
         xmlstream.XMPPHandlerCollection.__init__(self)
 
@@ -115,6 +128,7 @@ class InternalComponent(xmlstream.XMPPHandlerCollection, service.Service):
             self.domains.add(domain)
 
         self.xmlstream = None
+        self._parser = None
 
     def startService(self):
         """
@@ -122,7 +136,7 @@ class InternalComponent(xmlstream.XMPPHandlerCollection, service.Service):
         """
         service.Service.startService(self)
 
-        self._pipe = XmlPipe()
+        self._pipe = XmlPipe(queued=self.queuedPipe)
         self.xmlstream = self._pipe.source
 
         for domain in self.domains:
@@ -163,7 +177,26 @@ class InternalComponent(xmlstream.XMPPHandlerCollection, service.Service):
     def send(self, obj):
         """
         Send data to the XML stream, so it ends up at the router.
+
+        The router only deals with elements, so serialized XML, like a
+        L{SerializedStanza<wokkel.generic.SerializedStanza>}, is parsed
+        before it is sent.
+
+        @raise ValueError: If serialized XML is not a single, complete and
+            well-formed stanza.
         """
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        if isinstance(obj, str):
+            if self._parser is None:
+                self._parser = XmlParser()
+            try:
+                element = self._parser.parse(obj)
+            except domish.ParserError:
+                element = None
+            if element is None:
+                raise ValueError("Not a single complete stanza: %r" % (obj,))
+            obj = element
         self.xmlstream.send(obj)
 
 
@@ -264,6 +297,321 @@ class ListenComponentAuthenticator(xmlstream.ListenAuthenticator):
 
 
 
+def outstandingBytes(xs):
+    """
+    Return the number of bytes written to a stream but not yet sent.
+
+    This looks at the write buffer of the stream's transport, if it has
+    one like L{twisted.internet.abstract.FileDescriptor}. A transport that
+    wraps another transport, like for TLS, is followed to the wrapped
+    transport. The parts of the write buffer that are internal to Twisted
+    count as C{0} if a transport doesn't have them, and a stream without
+    a write buffer has C{0} outstanding bytes.
+    """
+    transport = getattr(xs, 'transport', None)
+    while (transport is not None and
+           getattr(transport, 'dataBuffer', None) is None):
+        wrapped = getattr(transport, 'transport', None)
+        if wrapped is transport:
+            return 0
+        transport = wrapped
+
+    if transport is None:
+        return 0
+
+    return (len(transport.dataBuffer) - getattr(transport, 'offset', 0) +
+            getattr(transport, '_tempDataLen', 0))
+
+
+
+class MultiStreamRoute(object):
+    """
+    Route that spreads traffic for one destination over several streams.
+
+    This is used by L{Router} when it has a C{routeFactory}, so that
+    several components can connect for the same domain. Subclasses select
+    the stream for each stanza in L{select}.
+
+    @ivar streams: The streams of this route, in order of addition.
+    @type streams: C{list}
+    """
+
+    def __init__(self):
+        self.streams = []
+
+
+    def __len__(self):
+        return len(self.streams)
+
+
+    def addStream(self, xs):
+        """
+        Add a stream to this route.
+        """
+        self.streams.append(xs)
+
+
+    def removeStream(self, xs):
+        """
+        Remove a stream from this route.
+
+        Traffic is spread over the remaining streams from then on.
+        """
+        self.streams.remove(xs)
+
+
+    def select(self, stanza):
+        """
+        Select the stream to send a stanza over.
+
+        @rtype: L{EventDispatcher<twisted.words.xish.utility.EventDispatcher>}
+        """
+        raise NotImplementedError()
+
+
+    def send(self, stanza):
+        """
+        Send a stanza over the selected stream.
+        """
+        self.select(stanza).send(stanza)
+
+
+
+class RoundRobinRoute(MultiStreamRoute):
+    """
+    Route that selects its streams in turn.
+    """
+
+    def __init__(self):
+        MultiStreamRoute.__init__(self)
+        self._next = 0
+
+
+    def select(self, stanza):
+        if self._next >= len(self.streams):
+            self._next = 0
+        xs = self.streams[self._next]
+        self._next += 1
+        return xs
+
+
+
+class LeastOutstandingBytesRoute(MultiStreamRoute):
+    """
+    Route that selects the stream with the least unsent data.
+
+    See L{outstandingBytes}. Of streams with equal amounts, the one added
+    first is selected.
+    """
+
+    def select(self, stanza):
+        selected = None
+        least = None
+        for xs in self.streams:
+            outstanding = outstandingBytes(xs)
+            if least is None or outstanding < least:
+                selected = xs
+                least = outstanding
+                if not least:
+                    break
+        return selected
+
+
+
+class ConsistentHashRoute(MultiStreamRoute):
+    """
+    Route that selects streams by the sender or recipient of stanzas.
+
+    All stanzas from or to the same bare JID are sent over the same stream,
+    so that components can keep per-entity state. Bare JIDs are mapped to
+    streams with a hash ring, with C{replicas} points for each stream.
+    When a stream is added or removed, only the bare JIDs that map to the
+    points of that stream move to another stream.
+
+    The bare JID is normalized, so that all forms of the same address map
+    to the same stream. Addresses are parsed with L{internJID}, so this is
+    a cache lookup for addresses seen before. Invalid addresses are only
+    lowercased.
+
+    @ivar key: C{'sender'} or C{'recipient'}.
+    @type key: C{str}
+    @ivar replicas: Number of points on the hash ring per stream.
+    @type replicas: C{int}
+    """
+
+    def __init__(self, key='sender', replicas=64):
+        MultiStreamRoute.__init__(self)
+        if key == 'sender':
+            self._attribute = 'from'
+        elif key == 'recipient':
+            self._attribute = 'to'
+        else:
+            raise ValueError("Unknown key %r" % (key,))
+
+        self.key = key
+        self.replicas = replicas
+        self._points = []
+        self._ring = []
+
+
+    def _hash(self, value):
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+    def _rebuild(self):
+        ring = []
+        for index, xs in enumerate(self.streams):
+            serial = getattr(xs, 'serial', None)
+            if serial is None:
+                serial = id(xs)
+            for replica in xrange(self.replicas):
+                ring.append((self._hash('%s-%d' % (serial, replica)), index))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._ring = [self.streams[index] for _, index in ring]
+
+
+    def addStream(self, xs):
+        MultiStreamRoute.addStream(self, xs)
+        self._rebuild()
+
+
+    def removeStream(self, xs):
+        MultiStreamRoute.removeStream(self, xs)
+        self._rebuild()
+
+
+    def select(self, stanza):
+        address = stanza.getAttribute(self._attribute) or u''
+        try:
+            bare = internJID(address).userhost()
+        except jid.InvalidFormat:
+            bare = address.split(u'/', 1)[0].lower()
+        index = bisect.bisect(self._points, self._hash(bare.encode('utf-8')))
+        if index == len(self._points):
+            index = 0
+        return self._ring[index]
+
+
+
+class SuffixTrie(object):
+    """
+    Trie of domain names, keyed by their labels in reverse order.
+
+    This maps domain suffixes to values, and finds the value for the
+    longest suffix of a given domain name in time proportional to the number
+    of labels of that name, regardless of the number of suffixes. A suffix
+    only matches proper subdomains: C{example.org} matches
+    C{muc.example.org}, but not C{example.org} itself.
+
+    Each node is a C{list} of the mapping from label to child node and the
+    value of the node, or L{_NO_VALUE}.
+    """
+
+    def __init__(self):
+        self._root = [{}, _NO_VALUE]
+        self._size = 0
+
+
+    def __len__(self):
+        return self._size
+
+
+    def add(self, suffix, value):
+        """
+        Set the value for a domain suffix.
+        """
+        node = self._root
+        for label in reversed(suffix.split('.')):
+            children = node[0]
+            try:
+                node = children[label]
+            except KeyError:
+                node = children[label] = [{}, _NO_VALUE]
+
+        if node[1] is _NO_VALUE:
+            self._size += 1
+        node[1] = value
+
+
+    def remove(self, suffix):
+        """
+        Remove a domain suffix, and the nodes that are no longer needed.
+
+        @raise KeyError: If the suffix is not in the trie.
+        """
+        path = []
+        node = self._root
+        for label in reversed(suffix.split('.')):
+            path.append((node, label))
+            node = node[0][label]
+
+        if node[1] is _NO_VALUE:
+            raise KeyError(suffix)
+        node[1] = _NO_VALUE
+        self._size -= 1
+
+        for parent, label in reversed(path):
+            child = parent[0][label]
+            if child[0] or child[1] is not _NO_VALUE:
+                break
+            del parent[0][label]
+
+
+    def lookup(self, name):
+        """
+        Return the value for the longest suffix of a domain name.
+
+        @return: The value, or C{None} if no suffix matches.
+        """
+        labels = name.split('.')
+        labels.reverse()
+        node = self._root
+        value = None
+        last = len(labels) - 1
+        for index, label in enumerate(labels):
+            try:
+                node = node[0][label]
+            except KeyError:
+                break
+            if node[1] is not _NO_VALUE and index < last:
+                value = node[1]
+        return value
+
+_NO_VALUE = object()
+
+
+
+class RouteProducer(object):
+    """
+    Push producer that tracks congestion of a route's stream.
+
+    A L{Router} registers one of these with the transport of each stream
+    it routes to. When the transport's write buffer fills up, it pauses
+    the producer, and the router considers the stream congested until the
+    buffer has drained.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, router, xs):
+        self.router = router
+        self.xs = xs
+
+
+    def pauseProducing(self):
+        self.router._congested(self.xs)
+
+
+    def resumeProducing(self):
+        self.router._drained(self.xs)
+
+
+    def stopProducing(self):
+        self.router._drained(self.xs)
+
+
+
 class Router(object):
     """
     XMPP Server's Router.
@@ -277,14 +625,81 @@ class Router(object):
     A route destination of C{None} adds a default route. Traffic for which no
     specific route exists, will be routed to this default route.
 
+    A route destination starting with C{*.} is a wildcard route, that
+    matches all subdomains of the rest of the destination. E.g.
+    C{*.tenant.example.com} matches C{muc.tenant.example.com}. Routes for
+    the exact host take precedence, then the wildcard route for the longest
+    matching domain, then the default route. Wildcard routes are kept in a
+    L{SuffixTrie}, so their number does not affect the cost of routing.
+
+    By default, a destination has a single stream, and adding a route for
+    a destination replaces the previous one. If C{routeFactory} is set,
+    every destination has a L{MultiStreamRoute} instead, and streams added
+    for the same destination share its traffic. E.g. with
+    L{ConsistentHashRoute}, several processes can serve one component
+    domain, while stanzas from each sender end up at the same process.
+
     @ivar routes: Routes based on the host part of JIDs. Maps host names to the
         L{EventDispatcher<twisted.words.xish.utility.EventDispatcher>}s that
-        should receive the traffic. A key of C{None} means the default route.
+        should receive the traffic, or L{MultiStreamRoute}s. A key of
+        C{None} means the default route.
     @type routes: C{dict}
+    @ivar routeFactory: Callable that creates a L{MultiStreamRoute}, or
+        C{None}.
+    @ivar logSampleRate: Fraction of routed stanzas, between C{0} and C{1},
+        that are logged in full. Serializing stanzas for logging is
+        expensive, so this is off by default.
+    @type logSampleRate: C{float}
+    @ivar measureBytes: If true, count the number of bytes routed per
+        route. This serializes every stanza that is not already serialized,
+        so it is off by default.
+    @type measureBytes: C{bool}
+    @ivar noRoute: Number of stanzas for which there was no route.
+    @type noRoute: C{int}
+    @ivar defaultRouted: Number of stanzas routed to the default route.
+    @type defaultRouted: C{int}
+    @ivar hostCacheSize: Maximum number of addresses for which the host
+        name is cached. See L{_getHost}.
+    @type hostCacheSize: C{int}
+    @ivar highWater: Number of unsent bytes in the write buffer of a route's
+        stream above which the stream is congested. When a stanza is
+        routed to a congested route, the router stops reading from the
+        streams of the sender's route until it has drained. A
+        L{RouteProducer} is registered with the transports of streams, so
+        that they also signal congestion.
+    @type highWater: C{int}
+    @ivar lowWater: Number of unsent bytes at or below which a congested
+        stream has drained.
+    @type lowWater: C{int}
+    @ivar drainInterval: Number of seconds between checks whether
+        congested streams have drained.
+    @type drainInterval: C{float}
     """
 
-    def __init__(self):
+    logSampleRate = 0
+    measureBytes = False
+    routeFactory = None
+    hostCacheSize = 10000
+    highWater = 1024 * 1024
+    lowWater = 256 * 1024
+    drainInterval = 0.1
+
+    def __init__(self, random=random.random, reactor=reactor):
+        """
+        @param random: Callable returning a random float in [0, 1), used
+            for sampling stanzas to log.
+        @param reactor: Provider of L{IReactorTime} used to check whether
+            congested streams have drained.
+        """
         self.routes = {}
+        self.random = random
+        self._reactor = reactor
+        self._wildcards = SuffixTrie()
+        self._hostCache = {}
+        self._congestion = {}
+        self._drainCalls = {}
+        self._pauses = {}
+        self.resetStats()
 
 
     def addRoute(self, destination, xs):
@@ -303,7 +718,26 @@ class Router(object):
         @type xs:
             L{EventDispatcher<twisted.words.xish.utility.EventDispatcher>}
         """
-        self.routes[destination] = xs
+        if destination is not None and destination.startswith('*.'):
+            self._wildcards.add(destination[2:], destination)
+
+        if self.routeFactory is None:
+            self.routes[destination] = xs
+        else:
+            route = self.routes.get(destination)
+            if not isinstance(route, MultiStreamRoute):
+                previous = route
+                route = self.routes[destination] = self.routeFactory()
+                if previous is not None:
+                    route.addStream(previous)
+            route.addStream(xs)
+
+        transport = getattr(xs, 'transport', None)
+        if (transport is not None and
+            getattr(transport, 'producer', True) is None):
+            transport.bufferSize = self.highWater
+            transport.registerProducer(RouteProducer(self, xs), True)
+
         xs.addObserver('/*', self.route)
 
 
@@ -319,37 +753,334 @@ class Router(object):
             L{EventDispatcher<twisted.words.xish.utility.EventDispatcher>}
         """
         xs.removeObserver('/*', self.route)
-        if (xs == self.routes[destination]):
-            del self.routes[destination]
+        self._drained(xs)
+        self._resumeStream(xs, forget=True)
+
+        transport = getattr(xs, 'transport', None)
+        if isinstance(getattr(transport, 'producer', None), RouteProducer):
+            transport.unregisterProducer()
+
+        route = self.routes[destination]
+        if isinstance(route, MultiStreamRoute):
+            if xs in route.streams:
+                route.removeStream(xs)
+                if not route.streams:
+                    self._deleteRoute(destination)
+        elif (xs == route):
+            self._deleteRoute(destination)
+
+
+    def _deleteRoute(self, destination):
+        del self.routes[destination]
+        if destination is not None and destination.startswith('*.'):
+            self._wildcards.remove(destination[2:])
 
 
     def route(self, stanza):
         """
         Route a stanza.
 
+        To find the route, the host name is taken from the destination
+        address without parsing it into a L{JID<jid.JID>}, see
+        L{_getHost}. Only if there is no route for that host, the address
+        is parsed and validated in full, and the route looked up again with
+        the normalized host name.
+
         @param stanza: The stanza to be routed.
         @type stanza: L{domish.Element}.
         """
-        destination = JID(stanza['to'])
+        to = stanza['to']
+
+        host = self._getHost(to)
+        routeKey = self._findRoute(host)
+        if routeKey is None:
+            try:
+                destination = internJID(to)
+            except jid.InvalidFormat:
+                self.noRoute += 1
+                log.msg("Dropping stanza with malformed JID %r" % (to,))
+                return
+
+            if destination.host != host:
+                routeKey = self._findRoute(destination.host)
+
+            if routeKey is None:
+                if None not in self.routes:
+                    self._noRoute(destination, stanza)
+                    return
+                self.defaultRouted += 1
+
+        try:
+            counters = self._counters[routeKey]
+        except KeyError:
+            counters = self._counters[routeKey] = [0, 0]
+        counters[0] += 1
+        if self.measureBytes:
+            counters[1] += len(stanza.toXml().encode('utf-8'))
+
+        if routeKey is None:
+            self._logStanza("Routing to %s (default route): %r", to, stanza)
+        else:
+            self._logStanza("Routing to %s: %r", to, stanza)
+
+        route = self.routes[routeKey]
+        streams = self._streams(route)
+
+        if self._congestion:
+            if all(xs in self._congestion for xs in streams):
+                self._pauseSender(stanza, route)
+
+        self._send(route, stanza)
 
+        for xs in streams:
+            if (xs not in self._congestion and
+                outstandingBytes(xs) > self.highWater):
+                self._congested(xs)
 
-        if destination.host in self.routes:
-            log.msg("Routing to %s: %r" % (destination.full(),
-                                           stanza.toXml()))
-            self.routes[destination.host].send(stanza)
-        elif None in self.routes:
-            log.msg("Routing to %s (default route): %r" % (destination.full(),
-                                                           stanza.toXml()))
-            self.routes[None].send(stanza)
+
+    def _send(self, route, stanza):
+        """
+        Send a stanza over a route.
+        """
+        route.send(stanza)
+
+
+    def _streams(self, route):
+        """
+        Return the streams of a route.
+        """
+        if isinstance(route, MultiStreamRoute):
+            return route.streams
         else:
-            log.msg("No route to %s: %r" % (destination.full(),
-                                            stanza.toXml()))
-            if stanza.getAttribute('type') not in ('result', 'error'):
-                # No route, send back error
-                exc = error.StanzaError('remote-server-timeout', type='wait')
-                exc.code = '504'
-                response = exc.toResponse(stanza)
-                self.route(response)
+            return [route]
+
+
+    def _congested(self, xs):
+        """
+        Mark a stream as congested, and check later whether it drained.
+        """
+        if xs in self._congestion:
+            return
+
+        self._congestion[xs] = set()
+        log.msg("Route stream congested: %r" % (xs,))
+
+        def check():
+            if outstandingBytes(xs) <= self.lowWater:
+                del self._drainCalls[xs]
+                self._drained(xs)
+            else:
+                self._drainCalls[xs] = self._reactor.callLater(
+                        self.drainInterval, check)
+
+        self._drainCalls[xs] = self._reactor.callLater(self.drainInterval,
+                                                       check)
+
+
+    def _drained(self, xs):
+        """
+        Mark a stream as no longer congested, resuming paused senders.
+        """
+        try:
+            paused = self._congestion.pop(xs)
+        except KeyError:
+            return
+
+        call = self._drainCalls.pop(xs, None)
+        if call is not None:
+            call.cancel()
+
+        for sender in paused:
+            self._resumeStream(sender)
+
+
+    def _pauseSender(self, stanza, route):
+        """
+        Stop reading from the streams of the sender of a stanza.
+
+        The sender is found by the route for the host of the stanza's
+        C{from} address. Components are trusted to have correct addressing.
+        """
+        sender = stanza.getAttribute('from')
+        if sender is None:
+            return
+
+        senderKey = self._findRoute(self._getHost(sender))
+        if senderKey is None:
+            return
+
+        for senderStream in self._streams(self.routes[senderKey]):
+            transport = getattr(senderStream, 'transport', None)
+            if transport is None:
+                continue
+
+            for xs in self._streams(route):
+                paused = self._congestion[xs]
+                if senderStream not in paused:
+                    paused.add(senderStream)
+                    self._pauses[senderStream] = (
+                            self._pauses.get(senderStream, 0) + 1)
+                    if self._pauses[senderStream] == 1:
+                        transport.pauseProducing()
+
+
+    def _resumeStream(self, xs, forget=False):
+        """
+        Resume reading from a paused stream, if no longer paused for others.
+
+        @param forget: If set, forget all pauses of the stream, without
+            resuming it.
+        """
+        if forget:
+            self._pauses.pop(xs, None)
+            for paused in self._congestion.itervalues():
+                paused.discard(xs)
+            return
+
+        count = self._pauses.get(xs, 0) - 1
+        if count > 0:
+            self._pauses[xs] = count
+        elif count == 0:
+            del self._pauses[xs]
+            xs.transport.resumeProducing()
+
+
+    def queueDepth(self, destination):
+        """
+        Return the number of unsent bytes queued for a route.
+
+        @param destination: The destination of the route, as in L{routes}.
+        @rtype: C{int}
+        """
+        return sum(outstandingBytes(xs)
+                   for xs in self._streams(self.routes[destination]))
+
+
+    def isCongested(self, destination):
+        """
+        Return whether all streams of a route are congested.
+
+        @param destination: The destination of the route, as in L{routes}.
+        @rtype: C{bool}
+        """
+        return all(xs in self._congestion
+                   for xs in self._streams(self.routes[destination]))
+
+
+    def _getHost(self, address):
+        """
+        Get the host name of an address, without full JID parsing.
+
+        The host name is the part between the optional C{@} and C{/} of the
+        address. If it is ASCII, it is lowercased, which is what
+        stringprep would do to valid host names. Otherwise, or if the
+        address is not valid, this returns C{None}, and the address needs
+        to be parsed in full.
+
+        The result is cached per address. When the cache holds
+        C{hostCacheSize} addresses, it is cleared.
+
+        @type address: C{unicode}
+        @rtype: C{unicode} or C{NoneType}
+        """
+        cache = self._hostCache
+        try:
+            return cache[address]
+        except KeyError:
+            pass
+
+        host = address
+        slash = host.find(u'/')
+        if slash != -1:
+            host = host[:slash]
+        at = host.find(u'@')
+        if at != -1:
+            host = host[at + 1:]
+
+        try:
+            host.encode('ascii')
+        except UnicodeError:
+            host = None
+        else:
+            host = host.lower() or None
+
+        if len(cache) >= self.hostCacheSize:
+            cache.clear()
+        cache[address] = host
+        return host
+
+
+    def _findRoute(self, host):
+        """
+        Find the route for a host name, if any.
+
+        @return: The key of the route in L{routes}, or C{None} if there is
+            no exact or wildcard route for C{host}.
+        """
+        if host is None:
+            return None
+        elif host in self.routes:
+            return host
+        elif self._wildcards:
+            return self._wildcards.lookup(host)
+        else:
+            return None
+
+
+    def _noRoute(self, destination, stanza):
+        """
+        Handle a stanza for which there is no route.
+
+        Unless the stanza is a response, an error is sent back.
+        """
+        self.noRoute += 1
+        log.msg("No route to %s" % (destination.full(),))
+        self._logStanza("No route to %s: %r", destination.full(), stanza)
+        if stanza.getAttribute('type') not in ('result', 'error'):
+            # No route, send back error
+            exc = error.StanzaError('remote-server-timeout', type='wait')
+            exc.code = '504'
+            response = exc.toResponse(stanza)
+            self.route(response)
+
+
+    def _logStanza(self, message, destination, stanza):
+        """
+        Log a stanza in full, if it is sampled for logging.
+        """
+        if self.logSampleRate and self.random() < self.logSampleRate:
+            log.msg(message % (destination, stanza.toXml()))
+
+
+    def stats(self):
+        """
+        Return the routing statistics.
+
+        @return: The number of stanzas for which there was no route as
+            C{'noRoute'}, the number of stanzas routed to the default route
+            as C{'defaultRouted'}, and under C{'routes'} a mapping from the
+            destination of each route that was used, C{None} for the
+            default route, to a C{dict} with the number of C{'stanzas'} and
+            C{'bytes'} routed to it. The number of bytes is only counted
+            if L{measureBytes} is set.
+        @rtype: C{dict}
+        """
+        routes = {}
+        for destination, (stanzas, bytes) in self._counters.iteritems():
+            routes[destination] = {'stanzas': stanzas, 'bytes': bytes}
+
+        return {'routes': routes,
+                'noRoute': self.noRoute,
+                'defaultRouted': self.defaultRouted}
+
+
+    def resetStats(self):
+        """
+        Reset the routing statistics.
+        """
+        self._counters = {}
+        self.noRoute = 0
+        self.defaultRouted = 0
 
 
 
@@ -360,9 +1091,16 @@ class XMPPComponentServerFactory(xmlstream.XmlStreamServerFactory):
     This factory accepts XMPP external component connections and makes
     the router service route traffic for a component's bound domain
     to that component.
+
+    @ivar logTraffic: If true, log all traffic.
+    @type logTraffic: C{bool}
+    @ivar trafficTap: If set, capture traffic of all component connections
+        with this tap instead of logging it.
+    @type trafficTap: L{wokkel.traffic.TrafficTap}
     """
 
     logTraffic = False
+    trafficTap = None
 
     def __init__(self, router, secret='secret'):
         self.router = router
@@ -395,7 +1133,9 @@ class XMPPComponentServerFactory(xmlstream.XmlStreamServerFactory):
         def logDataOut(buf):
             log.msg("SEND (%d): %r" % (xs.serial, buf))
 
-        if self.logTraffic:
+        if self.trafficTap is not None:
+            self.trafficTap.attach(xs)
+        elif self.logTraffic:
             xs.rawDataInFn = logDataIn
             xs.rawDataOutFn = logDataOut
 
@@ -7,12 +7,19 @@ XMPP Component Service.
 This provides an XMPP server that accepts External Components connections
 and accepts and initiates server-to-server connections for the specified
 domain(s).
+
+With C{--workers}, the service is run as several worker processes that
+share the listening sockets, see L{wokkel.shard}.
 """
 
+import os
+import sys
+
 from twisted.application import service, strports
-from twisted.python import usage
-from twisted.words.protocols.jabber import component
-from wokkel import server
+from twisted.internet import protocol, reactor, stdio
+from twisted.python import log, randbytes, usage
+from wokkel import component, server, shard
+from wokkel.traffic import TrafficFileWriter, TrafficTap
 
 class Options(usage.Options):
 
@@ -25,6 +32,21 @@ class Options(usage.Options):
                 'Port other servers connect to'),
             ('server-secret', None, None,
                 'Shared secret for dialback verification'),
+            ('traffic-log', None, None,
+                'File to write sampled traffic to'),
+            ('traffic-sample-rate', None, 1.0,
+                'Fraction of traffic to write to the traffic log', float),
+            ('workers', None, 1,
+                'Number of worker processes', int),
+            ('worker-id', None, None,
+                'Worker identifier (set for worker processes)', int),
+            ('shard-dir', None, None,
+                'Directory for links between workers '
+                '(set for worker processes)'),
+            ('component-fd', None, None,
+                'Inherited component socket (set for worker processes)', int),
+            ('server-fd', None, None,
+                'Inherited server socket (set for worker processes)', int),
     ]
 
     optFlags = [
@@ -46,32 +68,174 @@ class Options(usage.Options):
     def postOptions(self):
         if not self['domains']:
             raise usage.UsageError('Need at least one domain')
+        if self['workers'] < 1:
+            raise usage.UsageError('Need at least one worker')
+        if self['workers'] > 1 and self['traffic-log']:
+            raise usage.UsageError('Traffic logs need a single worker')
 
 
 
 def makeService(config):
+    if config['workers'] > 1:
+        if config['worker-id'] is None:
+            return makeMasterService(config)
+        else:
+            return makeWorkerService(config)
+
     s = service.MultiService()
 
     router = component.Router()
 
+    # Set up traffic capture
+
+    if config['traffic-log']:
+        writer = TrafficFileWriter(config['traffic-log'])
+        writer.setServiceParent(s)
+        trafficTap = TrafficTap(sampleRate=config['traffic-sample-rate'],
+                                writer=writer)
+    else:
+        trafficTap = None
+
     # Set up the XMPP server service
 
     serverService = server.ServerService(router, secret=config['server-secret'])
     serverService.domains = config['domains']
     serverService.logTraffic = config['verbose']
+    serverService.trafficTap = trafficTap
 
     # Hook up XMPP server-to-server service
     s2sFactory = server.XMPPS2SServerFactory(serverService)
     s2sFactory.logTraffic = config['verbose']
+    s2sFactory.trafficTap = trafficTap
     s2sService = strports.service(config['server-port'], s2sFactory)
     s2sService.setServiceParent(s)
 
     # Hook up XMPP external server-side component service
-    cFactory = component.XMPPComponentServerFactory(router,
-                                                    config['component-secret'])
+    cFactory = component.XMPPComponentServerFactory(
+            router, config['component-secret'])
 
     cFactory.logTraffic = config['verbose']
+    cFactory.trafficTap = trafficTap
     cServer = strports.service(config['component-port'], cFactory)
     cServer.setServiceParent(s)
 
     return s
+
+
+
+# Secrets are passed to worker processes in their environment, as their
+# command line can be read by other users.
+_SECRET_VARIABLES = {'component-secret': 'WOKKEL_COMPONENT_SECRET',
+                     'server-secret': 'WOKKEL_SERVER_SECRET'}
+
+def _readSecrets(config, environment):
+    """
+    Set the secrets passed by L{makeMasterService} in C{config}.
+
+    The variables are removed from C{environment}, so that they are not
+    passed on to processes started by the worker.
+    """
+    for option, variable in _SECRET_VARIABLES.iteritems():
+        if variable in environment:
+            config[option] = environment.pop(variable)
+
+
+
+def makeMasterService(config):
+    """
+    Make the service that starts the worker processes.
+    """
+    secrets = {'component-secret': config['component-secret'],
+               # All workers need the same secret to verify dialback keys.
+               'server-secret': (config['server-secret'] or
+                                 randbytes.secureRandom(16).encode('hex'))}
+    environment = dict((_SECRET_VARIABLES[option], value)
+                       for option, value in secrets.iteritems())
+
+    # Workers adopt the inherited sockets with the family of the port.
+    arguments = ['--component-port=%s' % (config['component-port'],),
+                 '--server-port=%s' % (config['server-port'],)]
+    for domain in config['domains']:
+        arguments.append('--domain=%s' % (domain,))
+    if config['verbose']:
+        arguments.append('--verbose')
+
+    ports = {'component-fd': config['component-port'],
+             'server-fd': config['server-port']}
+
+    return shard.ShardMaster(config['workers'], arguments, ports,
+                             environment)
+
+
+
+def makeWorkerService(config):
+    """
+    Make the service of a worker process.
+
+    The worker accepts connections on the sockets inherited from the master
+    process, and routes stanzas with a L{shard.ShardedRouter} linked to
+    the other workers.
+    """
+    s = service.MultiService()
+
+    router = shard.ShardedRouter()
+    shardService = shard.ShardService(router, config['worker-id'],
+                                      config['workers'], config['shard-dir'])
+    shardService.setServiceParent(s)
+
+    # Set up the XMPP server service
+
+    serverService = server.ServerService(router,
+                                         secret=config['server-secret'])
+    serverService.domains = config['domains']
+    serverService.logTraffic = config['verbose']
+
+    # Hook up XMPP server-to-server service
+    s2sFactory = server.XMPPS2SServerFactory(serverService)
+    s2sFactory.logTraffic = config['verbose']
+    s2sService = shard.InheritedPortService(
+            config['server-fd'], s2sFactory,
+            shard.socketFamily(config['server-port']))
+    s2sService.setServiceParent(s)
+
+    # Hook up XMPP external server-side component service
+    cFactory = component.XMPPComponentServerFactory(
+            router, config['component-secret'])
+    cFactory.logTraffic = config['verbose']
+    cServer = shard.InheritedPortService(
+            config['component-fd'], cFactory,
+            shard.socketFamily(config['component-port']))
+    cServer.setServiceParent(s)
+
+    return s
+
+
+
+class _ParentWatcher(protocol.Protocol):
+    """
+    Stop the reactor when standard input is closed by the parent process.
+    """
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+
+def runWorker(argv=None):
+    """
+    Run a worker process, as started by L{shard.ShardMaster}.
+
+    The secrets are taken from the environment, see L{makeMasterService}.
+    """
+    config = Options()
+    config.parseOptions(argv if argv is not None else sys.argv[1:])
+    _readSecrets(config, os.environ)
+
+    log.startLogging(sys.stdout)
+    stdio.StandardIO(_ParentWatcher())
+
+    s = makeService(config)
+    s.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', s.stopService)
+    reactor.run()
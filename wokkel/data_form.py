@@ -17,6 +17,8 @@ from zope.interface.common import mapping
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.xish import domish
 
+from wokkel.generic import SlotsPickleMixin
+
 NS_X_DATA = 'jabber:x:data'
 
 
@@ -42,7 +44,7 @@ class TooManyValuesError(Error):
 
 
 
-class Option(object):
+class Option(SlotsPickleMixin):
     """
     Data Forms field option.
 
@@ -52,6 +54,8 @@ class Option(object):
     @type label: C{unicode} or C{NoneType}
     """
 
+    __slots__ = ('value', 'label', '__dict__', '__weakref__')
+
     def __init__(self, value, label=None):
         self.value = value
         self.label = label
@@ -90,7 +94,7 @@ class Option(object):
         return Option(unicode(valueElements[0]), label)
 
 
-class Field(object):
+class Field(SlotsPickleMixin):
     """
     Data Forms field.
 
@@ -118,6 +122,9 @@ class Field(object):
     @type required: C{bool}
     """
 
+    __slots__ = ('fieldType', 'var', 'values', 'label', 'options', 'desc',
+                 'required', '__dict__', '__weakref__')
+
     def __init__(self, fieldType='text-single', var=None, value=None,
                        values=None, options=None, label=None, desc=None,
                        required=False):
@@ -60,7 +60,7 @@ class DiscoFeature(unicode):
 
 
 
-class DiscoIdentity(object):
+class DiscoIdentity(generic.SlotsPickleMixin):
     """
     XMPP service discovery identity.
 
@@ -72,6 +72,8 @@ class DiscoIdentity(object):
     @type name: C{unicode}
     """
 
+    __slots__ = ('category', 'type', 'name', '__dict__', '__weakref__')
+
     def __init__(self, category, idType, name=None):
         self.category = category
         self.type = idType
@@ -216,7 +218,7 @@ class DiscoInfo(object):
 
 
 
-class DiscoItem(object):
+class DiscoItem(generic.SlotsPickleMixin):
     """
     XMPP service discovery item.
 
@@ -228,6 +230,8 @@ class DiscoItem(object):
     @type name: C{unicode}
     """
 
+    __slots__ = ('entity', 'nodeIdentifier', 'name', '__dict__', '__weakref__')
+
     def __init__(self, entity, nodeIdentifier='', name=None):
         self.entity = entity
         self.nodeIdentifier = nodeIdentifier
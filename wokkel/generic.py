@@ -7,6 +7,9 @@
 Generic XMPP protocol helpers.
 """
 
+import weakref
+from collections import deque
+
 from zope.interface import implements
 
 from twisted.internet import defer, protocol
@@ -27,6 +30,11 @@ IQ_SET = '/iq[@type="set"]'
 NS_VERSION = 'jabber:iq:version'
 VERSION = IQ_GET + '/query[@xmlns="' + NS_VERSION + '"]'
 
+KEEP_WEAK = 'weak'
+
+PIPE_CONGESTED_EVENT = '//event/pipe/congested'
+PIPE_DRAINED_EVENT = '//event/pipe/drained'
+
 def parseXml(string):
     """
     Parse serialized XML into a DOM structure.
@@ -47,19 +55,196 @@ def parseXml(string):
 
 
 
-def stripNamespace(rootElement):
-    namespace = rootElement.uri
+class XmlParser(object):
+    """
+    Reusable parser for serialized XML stanzas.
+
+    Where L{parseXml} sets up a new XML parser for every call, this keeps a
+    single parser around, fed with an unterminated synthetic root element.
+    Each stanza passed in then becomes a top-level child of that root, and
+    is handed back as soon as its end tag has been parsed. This makes it
+    cheap to parse many stanzas, one at a time with L{parse}, or in batches
+    and streams of concatenated stanzas with L{parseStanzas} and L{feed}.
+
+    Input that cannot be parsed as a single stanza in this way, like XML
+    with an XML declaration, is passed to L{parseXml} instead. The results
+    differ from those of L{parseXml} in one way: character data directly
+    in the top-level element is kept, where L{parseXml} drops it. Like
+    with L{parseXml}, data other than whitespace, comments and processing
+    instructions before or after the element passed to L{parse} is an
+    error.
+
+    Instances are not thread-safe. Use one parser per thread, or a pool.
+
+    @cvar chunkSize: Number of bytes fed to the underlying parser at once by
+        L{parseStanzas}.
+    @type chunkSize: C{int}
+    """
+
+    chunkSize = 65536
+
+    _prologue = "<wokkel-parser-root>"
+
+    def __init__(self):
+        self._elements = []
+        self.reset()
+
+
+    def reset(self):
+        """
+        Discard partially parsed data and start with a fresh parser.
+        """
+        del self._elements[:]
+        self._strayData = False
+        stream = domish.elementStream()
+        stream.DocumentStartEvent = lambda root: None
+        stream.ElementEvent = self._elements.append
+        stream.DocumentEndEvent = self._onDocumentEnd
+        stream.parser.CharacterDataHandler = self._onCdata
+        self._stream = stream
+        stream.parse(self._prologue)
+
+
+    def _onDocumentEnd(self):
+        """
+        Called when the synthetic root element was closed by the input.
+        """
+        raise domish.ParserError("Unexpected end of synthetic root element")
+
+
+    def _onCdata(self, data):
+        """
+        Called for character data, also outside of stanzas.
+        """
+        currElem = self._stream.currElem
+        if currElem is not None:
+            currElem.addContent(data)
+        elif data.strip():
+            self._strayData = True
+
+
+    def parse(self, string):
+        """
+        Parse serialized XML into a DOM structure.
+
+        This can be used in place of L{parseXml}, see L{XmlParser} for the
+        differences. Any data left over from an earlier call to L{feed} is
+        discarded.
+
+        @param string: The serialized XML to be parsed, UTF-8 encoded.
+        @type string: C{str}.
+        @return: The DOM structure, or C{None} on empty or incomplete input.
+        @rtype: L{domish.Element}
+        @raise domish.ParserError: If the data is not well-formed.
+        """
+        stream = self._stream
+        elements = self._elements
+
+        if elements or stream.currElem is not None or self._strayData:
+            self.reset()
+            stream = self._stream
+
+        try:
+            stream.parse(string)
+        except domish.ParserError:
+            pass
+        else:
+            if (len(elements) == 1 and stream.currElem is None and
+                not self._strayData):
+                return elements.pop()
+
+        self.reset()
+        return parseXml(string)
+
+
+    def feed(self, data):
+        """
+        Parse a chunk of a stream of concatenated stanzas.
+
+        Stanzas may span several chunks: the parser keeps incomplete data
+        around until the next call.
+
+        @param data: The next chunk of serialized XML, UTF-8 encoded.
+        @type data: C{str}
+        @return: The stanzas completed by this chunk.
+        @rtype: C{list} of L{domish.Element}
+        @raise domish.ParserError: If the data is not well-formed. The
+            parser is reset.
+        """
+        try:
+            self._stream.parse(data)
+        except domish.ParserError:
+            self.reset()
+            raise
 
-    def strip(element):
-        if element.uri == namespace:
-            element.uri = None
-            if element.defaultUri == namespace:
-                element.defaultUri = None
-            for child in element.elements():
-                strip(child)
+        elements = self._elements[:]
+        del self._elements[:]
+        return elements
 
-    if namespace is not None:
-        strip(rootElement)
+
+    def parseStanzas(self, data):
+        """
+        Parse concatenated stanzas in one pass, yielding them as it goes.
+
+        @param data: Serialized XML of zero or more stanzas, UTF-8 encoded,
+            either as one string or an iterable of chunks (e.g. a file).
+        @type data: C{str} or iterable of C{str}
+        @return: Iterator over the parsed stanzas.
+        @raise domish.ParserError: If the data is not well-formed, or ends
+            with an incomplete stanza.
+        """
+        if self._elements or self._stream.currElem is not None:
+            self.reset()
+
+        if isinstance(data, basestring):
+            chunkSize = self.chunkSize
+            chunks = (data[offset:offset + chunkSize]
+                      for offset in xrange(0, len(data), chunkSize))
+        else:
+            chunks = data
+
+        for chunk in chunks:
+            for element in self.feed(chunk):
+                yield element
+
+        if self._stream.currElem is not None:
+            self.reset()
+            raise domish.ParserError("Incomplete stanza at end of data")
+
+
+
+def stripNamespace(rootElement):
+    """
+    Remove the stream namespace from a stanza element and its children.
+
+    The namespace of C{rootElement} is taken to be the stream namespace
+    (e.g. C{'jabber:client'}). It is removed from the root element and,
+    transitively, from all children in that same namespace. Other elements,
+    like payloads in their own namespace, are not descended into.
+
+    The tree is walked iteratively, so that deeply nested stanzas do not
+    hit the recursion limit. A root element without namespace marks a
+    stanza that does not need stripping (e.g. because it was stripped
+    before, or created without namespace to be passed through an
+    L{XmlPipe}), and is returned right away.
+
+    @param rootElement: The stanza element.
+    @type rootElement: L{domish.Element}
+    @return: C{rootElement}
+    """
+    namespace = rootElement.uri
+    if namespace is None:
+        return rootElement
+
+    stack = [rootElement]
+    while stack:
+        element = stack.pop()
+        element.uri = None
+        if element.defaultUri == namespace:
+            element.defaultUri = None
+        for child in element.children:
+            if getattr(child, 'uri', None) == namespace:
+                stack.append(child)
 
     return rootElement
 
@@ -150,15 +335,310 @@ class XmlPipe(object):
     disconnection, initialization and stream errors are not dispatched or
     processed.
 
+    By default, sending an element dispatches it to the other side right
+    away. When a handler sends in response to a received element, this
+    recurses through the observers of both sides, and long request/response
+    chains can exceed the recursion limit. In queued mode, sent elements are
+    put in a queue instead. If the queue is not already being drained, it
+    is drained right away, dispatching elements one after the other, so that
+    elements sent by observers are dispatched after the current one
+    returns. At most C{batchSize} elements are dispatched at once, the rest
+    is drained in the next reactor iteration.
+
+    The queue holds at most C{maxQueue} elements. When it fills up,
+    L{PIPE_CONGESTED_EVENT} is dispatched to the observers of both sides,
+    and further elements are dropped until the queue has been drained.
+    Dropped iq requests are answered with a C{resource-constraint} error,
+    so that the sender does not have to wait for a timeout. Once drained,
+    L{PIPE_DRAINED_EVENT} is dispatched. Both events are dispatched with
+    the pipe as the object.
+
     @ivar source: Source XML stream.
     @ivar sink: Sink XML stream.
+    @ivar queued: Whether elements are queued.
+    @type queued: C{bool}
+    @ivar maxQueue: Maximum number of queued elements.
+    @type maxQueue: C{int}
+    @ivar batchSize: Maximum number of elements dispatched per reactor
+        iteration.
+    @type batchSize: C{int}
+    @ivar congested: Whether the queue filled up and has not been drained
+        since.
+    @type congested: C{bool}
+    @ivar delivered: Number of dispatched elements.
+    @type delivered: C{int}
+    @ivar dropped: Number of elements dropped because the queue was full.
+    @type dropped: C{int}
+    @ivar drains: Number of times the queue was drained.
+    @type drains: C{int}
+    @ivar peakDepth: Highest number of elements queued at once.
+    @type peakDepth: C{int}
     """
 
-    def __init__(self):
+    def __init__(self, queued=False, maxQueue=10000, batchSize=1000,
+                       reactor=None):
         self.source = utility.EventDispatcher()
         self.sink = utility.EventDispatcher()
-        self.source.send = lambda obj: self.sink.dispatch(obj)
-        self.sink.send = lambda obj: self.source.dispatch(obj)
+        self.queued = queued
+        self.maxQueue = maxQueue
+        self.batchSize = batchSize
+        self.congested = False
+        self.delivered = 0
+        self.dropped = 0
+        self.drains = 0
+        self.peakDepth = 0
+
+        if queued:
+            if reactor is None:
+                from twisted.internet import reactor
+            self._reactor = reactor
+            self._queue = deque()
+            self._draining = False
+            self._drainCall = None
+            self.source.send = lambda obj: self._enqueue(self.sink, obj)
+            self.sink.send = lambda obj: self._enqueue(self.source, obj)
+        else:
+            self.source.send = lambda obj: self.sink.dispatch(obj)
+            self.sink.send = lambda obj: self.source.dispatch(obj)
+
+
+    @property
+    def depth(self):
+        """
+        Number of queued elements.
+        """
+        if self.queued:
+            return len(self._queue)
+        else:
+            return 0
+
+
+    def _enqueue(self, dispatcher, obj):
+        """
+        Queue an element for dispatching, and drain the queue if needed.
+        """
+        if self.congested:
+            self.dropped += 1
+            if (getattr(obj, 'name', None) == 'iq' and
+                obj.getAttribute('type') in ('get', 'set')):
+                exc = error.StanzaError('resource-constraint', type='wait')
+                if dispatcher is self.sink:
+                    sender = self.source
+                else:
+                    sender = self.sink
+                sender.dispatch(exc.toResponse(obj))
+            return
+
+        self._queue.append((dispatcher, obj))
+        depth = len(self._queue)
+        if depth > self.peakDepth:
+            self.peakDepth = depth
+
+        if depth >= self.maxQueue:
+            self.congested = True
+            self.source.dispatch(self, PIPE_CONGESTED_EVENT)
+            self.sink.dispatch(self, PIPE_CONGESTED_EVENT)
+
+        if not self._draining and self._drainCall is None:
+            self._drain()
+
+
+    def _drain(self):
+        """
+        Dispatch queued elements, up to C{batchSize} of them.
+        """
+        self._drainCall = None
+        self._draining = True
+        self.drains += 1
+        queue = self._queue
+        try:
+            count = 0
+            while queue and count < self.batchSize:
+                dispatcher, obj = queue.popleft()
+                count += 1
+                dispatcher.dispatch(obj)
+        finally:
+            self.delivered += count
+            self._draining = False
+
+            if queue:
+                self._drainCall = self._reactor.callLater(0, self._drain)
+            elif self.congested:
+                self.congested = False
+                self.source.dispatch(self, PIPE_DRAINED_EVENT)
+                self.sink.dispatch(self, PIPE_DRAINED_EVENT)
+
+
+
+class JIDCache(object):
+    """
+    Bounded cache of parsed JIDs.
+
+    Like L{jid.internJID}, this maps the string representation of JIDs to
+    L{jid.JID} instances, so that the cost of parsing and stringprep is only
+    incurred once for often seen addresses. Unlike Twisted's cache, which
+    grows without limit, this holds at most C{maxSize} JIDs and evicts the
+    least recently used ones first.
+
+    The entries are kept in a dictionary, along with a circular doubly
+    linked list in order of use. Each link is a C{list} of the previous and
+    next link, the key and the JID.
+
+    @ivar maxSize: Maximum number of cached JIDs.
+    @type maxSize: C{int}
+    @ivar hits: Number of lookups for a cached JID.
+    @type hits: C{int}
+    @ivar misses: Number of lookups that parsed a new JID.
+    @type misses: C{int}
+    @ivar evictions: Number of JIDs evicted to make room for others.
+    @type evictions: C{int}
+    """
+
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self.clear()
+
+
+    def clear(self):
+        """
+        Remove all cached JIDs and reset the statistics.
+        """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._links = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def __contains__(self, jidString):
+        return jidString in self._links
+
+
+    def get(self, jidString):
+        """
+        Get the JID for a string, parsing it if not cached.
+
+        @param jidString: The string representation of the JID.
+        @type jidString: C{unicode}
+        @raise jid.InvalidFormat: If the string is not a valid JID. Invalid
+            JIDs are not cached.
+        @rtype: L{jid.JID}
+        """
+        links = self._links
+        root = self._root
+
+        try:
+            link = links[jidString]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            # Move the link to the most recently used end.
+            previous, next, _, entity = link
+            previous[1] = next
+            next[0] = previous
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return entity
+
+        entity = jid.JID(jidString)
+        self.misses += 1
+
+        if len(links) >= self.maxSize:
+            if not self.maxSize:
+                return entity
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del links[oldest[2]]
+            self.evictions += 1
+
+        last = root[0]
+        last[1] = root[0] = links[jidString] = [last, root, jidString, entity]
+        return entity
+
+
+    def stats(self):
+        """
+        Return the statistics of this cache.
+
+        @return: The current C{'size'} and C{'maxSize'} and the number of
+            C{'hits'}, C{'misses'} and C{'evictions'}.
+        @rtype: C{dict}
+        """
+        return {'size': len(self._links),
+                'maxSize': self.maxSize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+jidCache = JIDCache()
+
+def internJID(jidString):
+    """
+    Return a cached JID from the shared L{jidCache}.
+
+    This is used instead of L{jid.internJID}, whose cache grows without
+    limit, when turning the addresses of received stanzas into JIDs.
+
+    @param jidString: The string representation of the JID.
+    @type jidString: C{unicode}
+    @raise jid.InvalidFormat: If the string is not a valid JID.
+    @rtype: L{jid.JID}
+    """
+    return jidCache.get(jidString)
+
+
+
+class SlotsPickleMixin(object):
+    """
+    Mixin for pickling objects that store their attributes in slots.
+
+    With pickle protocols before 2, instances of classes that define
+    C{__slots__} can only be pickled if they define C{__getstate__}. This
+    provides the state as a dictionary of the set slots and other instance
+    attributes.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for Class in self.__class__.__mro__:
+            for name in Class.__dict__.get('__slots__', ()):
+                if name in ('__dict__', '__weakref__'):
+                    continue
+                try:
+                    state[name] = getattr(self, name)
+                except AttributeError:
+                    pass
+        return state
+
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+
+
+def _lateChildParser(name):
+    """
+    Make a child element parser that looks up its handler on the stanza.
+
+    This is used for handlers named in C{childParsers} that are not
+    defined on the class itself.
+    """
+    def parser(stanza, element):
+        getattr(stanza, name)(element)
+    return parser
 
 
 
@@ -166,14 +646,38 @@ class Stanza(object):
     """
     Abstract representation of a stanza.
 
+    When parsed from an element, the addressing attributes are kept as is,
+    and only turned into L{jid.JID}s when L{sender} or L{recipient} is
+    first accessed. Code that just looks at the stanza type, or forwards
+    the stanza, then doesn't incur the cost of stringprep. As a
+    consequence, a malformed address raises L{jid.InvalidFormat} on access
+    of the respective attribute, instead of when parsing.
+
     @ivar sender: The sending entity.
     @type sender: L{jid.JID}
     @ivar recipient: The receiving entity.
     @type recipient: L{jid.JID}
+    @ivar element: The element this stanza was parsed from, or C{None} if
+        it was not kept (see L{keepElement}).
+    @type element: L{domish.Element}
+    @ivar keepElement: What to do with the element a stanza was parsed from
+        by L{fromElement}, once parsed. If C{True}, the element is kept. If
+        C{False}, it is dropped. If L{KEEP_WEAK}, only a weak reference is
+        kept, so that the element is available from L{sourceElement} as
+        long as it is referenced elsewhere. Dropping the element reduces the
+        memory footprint of long-lived parsed stanzas. This is usually set
+        on a class, but can be overridden per call to L{fromElement}. A
+        stanza can always be rendered again from its parsed fields with
+        C{toElement} or C{toBytes}.
     """
 
-    recipient = None
-    sender = None
+    keepElement = True
+    element = None
+    _elementRef = None
+    _sender = None
+    _senderRaw = None
+    _recipient = None
+    _recipientRaw = None
     stanzaKind = None
     stanzaID = None
     stanzaType = None
@@ -183,13 +687,68 @@ class Stanza(object):
         self.sender = sender
 
 
+    def _getSender(self):
+        if self._senderRaw is not None:
+            self._sender = internJID(self._senderRaw)
+            self._senderRaw = None
+        return self._sender
+
+
+    def _setSender(self, sender):
+        self._sender = sender
+        self._senderRaw = None
+
+    sender = property(_getSender, _setSender)
+
+
+    def _getRecipient(self):
+        if self._recipientRaw is not None:
+            self._recipient = internJID(self._recipientRaw)
+            self._recipientRaw = None
+        return self._recipient
+
+
+    def _setRecipient(self, recipient):
+        self._recipient = recipient
+        self._recipientRaw = None
+
+    recipient = property(_getRecipient, _setRecipient)
+
+
+    def sourceElement(self):
+        """
+        Return the element this stanza was parsed from, if still available.
+
+        @return: The kept element, the weakly referenced element if it is
+            still alive, or C{None}.
+        @rtype: L{domish.Element}
+        """
+        if self.element is not None:
+            return self.element
+        elif self._elementRef is not None:
+            return self._elementRef()
+        else:
+            return None
+
+
     @classmethod
-    def fromElement(Class, element):
+    def fromElement(Class, element, keepElement=None):
         """
         Create a stanza from a L{domish.Element}.
+
+        @param keepElement: If not C{None}, overrides L{keepElement} for
+            this stanza.
         """
         stanza = Class()
+        if keepElement is not None:
+            stanza.keepElement = keepElement
         stanza.parseElement(element)
+
+        if stanza.keepElement == KEEP_WEAK:
+            stanza._elementRef = weakref.ref(element)
+            stanza.element = None
+        elif not stanza.keepElement:
+            stanza.element = None
         return stanza
 
 
@@ -210,11 +769,17 @@ class Stanza(object):
         elements and pass it to matching handlers based on the child element's
         URI and name. The special key of C{None} can be used to pass all
         child elements to.
+
+        The accumulated C{childParsers} are cached per class, see
+        L{_getChildParsers}.
         """
-        if element.hasAttribute('from'):
-            self.sender = jid.internJID(element['from'])
-        if element.hasAttribute('to'):
-            self.recipient = jid.internJID(element['to'])
+        attributes = element.attributes
+        if 'from' in attributes:
+            self._sender = None
+            self._senderRaw = attributes['from']
+        if 'to' in attributes:
+            self._recipient = None
+            self._recipientRaw = attributes['to']
         self.stanzaType = element.getAttribute('type')
         self.stanzaID = element.getAttribute('id')
 
@@ -222,9 +787,9 @@ class Stanza(object):
         stripNamespace(element)
         self.element = element
 
-        # accumulate all childHandlers in the class hierarchy of Class 
-        handlers = {}
-        reflect.accumulateClassDict(self.__class__, 'childParsers', handlers)
+        handlers = self._getChildParsers()
+        if not handlers:
+            return
 
         for child in element.elements():
             try:
@@ -235,7 +800,40 @@ class Stanza(object):
                 except KeyError:
                     continue
 
-            getattr(self, handler)(child)
+            handler(self, child)
+
+
+    @classmethod
+    def _getChildParsers(Class):
+        """
+        Get the child element parsers for this class.
+
+        This accumulates all C{childParsers} in the class hierarchy of
+        C{Class} and looks up the handlers by name, once per class. Changes
+        to C{childParsers} after the first stanza of a class was parsed are
+        not picked up.
+
+        @return: Mapping from (URI, name), or C{None}, to a function that
+            takes the stanza and the child element.
+        @rtype: C{dict}
+        """
+        try:
+            return Class.__dict__['_childParserCache']
+        except KeyError:
+            pass
+
+        names = {}
+        reflect.accumulateClassDict(Class, 'childParsers', names)
+
+        handlers = {}
+        for key, name in names.iteritems():
+            handler = getattr(Class, name, None)
+            if handler is None:
+                handler = _lateChildParser(name)
+            handlers[key] = handler
+
+        Class._childParserCache = handlers
+        return handlers
 
 
     def toElement(self):
@@ -251,6 +849,110 @@ class Stanza(object):
         return element
 
 
+    def toBytes(self, **kwargs):
+        """
+        Render into a serialized stanza.
+
+        The result is the same as serializing the element returned by
+        L{toElement}, UTF-8 encoded. Classes that render their child
+        elements with C{_renderChildren} next to C{toElement} are serialized
+        from the stanza's fields directly, without building an element
+        tree. Other classes fall back to serializing the result of
+        L{toElement}.
+
+        The result can be passed to
+        L{XMPPHandler.send<wokkel.subprotocols.XMPPHandler.send>} as is.
+
+        @param kwargs: Passed on to L{toElement}.
+        @rtype: L{SerializedStanza}
+        """
+        renderChildren = self._getChildRenderer()
+        if renderChildren is None:
+            element = self.toElement(**kwargs)
+            data = element.toXml().encode('utf-8')
+        else:
+            # Render the children first, as that may change the type.
+            children = renderChildren(self, **kwargs)
+            data = self._renderStanza(children).encode('utf-8')
+
+        return SerializedStanza(data, self.stanzaKind, self.stanzaType,
+                                self.stanzaID)
+
+
+    @classmethod
+    def _getChildRenderer(Class):
+        """
+        Get the child element renderer for this class, if any.
+
+        The renderer is the C{_renderChildren} defined by the same class as
+        the C{toElement} that applies to C{Class}, so that subclasses
+        overriding C{toElement} alone are not serialized incompletely. The
+        result is cached per class.
+
+        @return: Function that takes the stanza and returns a C{list} of
+            serialized child elements, or C{None}.
+        """
+        try:
+            return Class.__dict__['_childRendererCache']
+        except KeyError:
+            pass
+
+        renderer = None
+        for base in Class.__mro__:
+            if 'toElement' in base.__dict__:
+                renderer = base.__dict__.get('_renderChildren')
+                break
+
+        Class._childRendererCache = renderer
+        return renderer
+
+
+    def _renderChildren(self):
+        """
+        Render the child elements of this stanza.
+
+        This is the counterpart of L{toElement} for L{toBytes}. A subclass
+        that overrides C{toElement} can override this method to render the
+        same child elements, and must then do so in the same order.
+
+        @return: Serialized child elements.
+        @rtype: C{list} of C{unicode}
+        """
+        return []
+
+
+    def _renderStanza(self, children):
+        """
+        Serialize the stanza element around already serialized children.
+
+        Attributes are collected in a C{dict} in the same order as
+        L{toElement} sets them, so that they are serialized in the same
+        order as by L{domish.Element.toXml}.
+        """
+        attributes = {}
+        if self.sender is not None:
+            attributes['from'] = self.sender.full()
+        if self.recipient is not None:
+            attributes['to'] = self.recipient.full()
+        if self.stanzaType:
+            attributes['type'] = self.stanzaType
+        if self.stanzaID:
+            attributes['id'] = self.stanzaID
+
+        parts = [u'<', self.stanzaKind]
+        for name, value in attributes.items():
+            parts.append(u" %s='%s'" % (name, domish.escapeToXml(value, 1)))
+
+        if children:
+            parts.append(u'>')
+            parts.extend(children)
+            parts.append(u'</%s>' % (self.stanzaKind,))
+        else:
+            parts.append(u'/>')
+
+        return u''.join(parts)
+
+
 
 class ErrorStanza(Stanza):
 
@@ -266,11 +968,22 @@ class Request(Stanza):
 
     This is a base class for IQ get or set stanzas, to be used with
     L{wokkel.subprotocols.StreamManager.request}.
+
+    @ivar timeout: Number of seconds to wait for a response, or C{None} to
+        use the stream manager's default.
+    @type timeout: C{int}
+    @ivar idempotent: Whether sending this request more than once has the
+        same effect as sending it once. If so, the stream manager may hold
+        on to it when the connection is lost before a response was
+        received, and resend it on the next stream. See
+        L{wokkel.subprotocols.StreamManager.maxReplays}.
+    @type idempotent: C{bool}
     """
 
     stanzaKind = 'iq'
     stanzaType = 'get'
     timeout = None
+    idempotent = False
 
     childParsers = {None: 'parseRequest'}
 
@@ -301,6 +1014,119 @@ class Request(Stanza):
 
 
 
+class SerializedStanza(str):
+    """
+    Pre-serialized stanza.
+
+    This is a UTF-8 encoded serialized stanza that can be passed to
+    L{XMPPHandler.send<wokkel.subprotocols.XMPPHandler.send>} and
+    L{StreamManager.send<wokkel.subprotocols.StreamManager.send>} as is,
+    but still carries the stanza's kind, type and identifier. This allows
+    the stream manager to recognize requests when they are dropped from its
+    queue of unsent data.
+
+    Note that, unlike elements, serialized stanzas are sent as is. E.g.
+    L{Component<wokkel.component.Component>} will not add a C{from}
+    attribute if there is none. An
+    L{InternalComponent<wokkel.component.InternalComponent>} accepts them
+    too, but parses them back into elements for the router, so there is
+    nothing to be gained from serializing stanzas up front there.
+
+    @ivar stanzaKind: The kind of stanza, e.g. C{'message'}.
+    @type stanzaKind: C{str}
+    @ivar stanzaType: The type of the stanza, if any.
+    @type stanzaType: C{unicode}
+    @ivar stanzaID: The identifier of the stanza, if any.
+    @type stanzaID: C{unicode}
+    """
+
+    def __new__(cls, data, stanzaKind=None, stanzaType=None, stanzaID=None):
+        self = str.__new__(cls, data)
+        self.stanzaKind = stanzaKind
+        self.stanzaType = stanzaType
+        self.stanzaID = stanzaID
+        return self
+
+
+
+class StanzaTemplate(object):
+    """
+    Template for stanzas that only differ in addressing and identifier.
+
+    A template is created from a stanza element without C{to} or C{id}
+    attributes. The element is serialized once, and L{render} splices in the
+    recipient and identifier for each stanza to be sent, without building or
+    serializing an element tree. This is useful for sending the same
+    notification or presence to many recipients:
+
+        >>> message = domish.Element((None, 'message'))
+        >>> message.addElement('body', content='Hello')
+        >>> template = StanzaTemplate(message)
+        >>> for recipient in recipients:
+        ...     handler.send(template.render(recipient))
+
+    @ivar stanzaKind: The kind of stanza, e.g. C{'message'}.
+    @type stanzaKind: C{str}
+    @ivar stanzaType: The type of the stanza, if any.
+    @type stanzaType: C{unicode}
+    """
+
+    def __init__(self, element):
+        """
+        @param element: The stanza element to serve as the template. Any
+            C{to} or C{id} attributes are ignored.
+        @type element: L{domish.Element}
+        """
+        self.stanzaKind = element.name
+        self.stanzaType = element.getAttribute('type')
+
+        saved = {}
+        for attribute in ('to', 'id'):
+            if element.hasAttribute(attribute):
+                saved[attribute] = element.attributes.pop(attribute)
+
+        try:
+            serialized = element.toXml().encode('utf-8')
+        finally:
+            element.attributes.update(saved)
+
+        start = '<' + element.name.encode('utf-8')
+        if not serialized.startswith(start):
+            raise ValueError("Unsupported template element %r" % serialized)
+
+        self._start = start
+        self._rest = serialized[len(start):]
+
+
+    def render(self, recipient=None, stanzaID=None):
+        """
+        Render a serialized stanza from the template.
+
+        @param recipient: The addressee of the stanza.
+        @type recipient: L{jid.JID} or C{unicode}
+        @param stanzaID: The identifier of the stanza.
+        @type stanzaID: C{unicode}
+        @rtype: L{SerializedStanza}
+        """
+        parts = [self._start]
+
+        if recipient is not None:
+            if isinstance(recipient, jid.JID):
+                recipient = recipient.full()
+            parts.append(" to='%s'" %
+                         domish.escapeToXml(recipient, 1).encode('utf-8'))
+
+        if stanzaID is not None:
+            parts.append(" id='%s'" %
+                         domish.escapeToXml(stanzaID, 1).encode('utf-8'))
+
+        parts.append(self._rest)
+
+        return SerializedStanza(''.join(parts), self.stanzaKind,
+                                self.stanzaType, stanzaID)
+
+
+
 class DeferredXmlStreamFactory(BootstrapMixin, protocol.ClientFactory):
     protocol = xmlstream.XmlStream
 
@@ -141,11 +141,14 @@ class RegisterRequest(_FormRequest):
 
 
 
-class AdminItem(object):
+class AdminItem(generic.SlotsPickleMixin):
     """
     Item representing role and/or affiliation for admin request.
     """
 
+    __slots__ = ('affiliation', 'role', 'entity', 'nick', 'reason', '__dict__',
+                 '__weakref__')
+
     def __init__(self, affiliation=None, role=None, entity=None, nick=None,
                        reason=None):
         self.affiliation = affiliation
@@ -284,6 +287,16 @@ class GroupChat(xmppim.Message, DelayMixin):
         return element
 
 
+    def _renderChildren(self, legacyDelay=False):
+        children = xmppim.Message._renderChildren(self)
+
+        if self.delay:
+            delay = self.delay.toElement(legacy=legacyDelay)
+            children.append(delay.toXml())
+
+        return children
+
+
 
 class PrivateChat(xmppim.Message):
     """
@@ -1104,11 +1117,14 @@ class MUCClientProtocol(xmppim.BasePresenceProtocol):
 
 
 
-class User(object):
+class User(generic.SlotsPickleMixin):
     """
     A user/entity in a multi-user chat room.
     """
 
+    __slots__ = ('nick', 'entity', 'affiliation', 'role', 'status', 'show',
+                 '__dict__', '__weakref__')
+
     def __init__(self, nick, entity=None):
         self.nick = nick
         self.entity = entity
@@ -1156,7 +1172,7 @@ class Room(object):
 
 
     def setNick(self, nick):
-        self.occupantJID = jid.internJID(u"%s/%s" % (self.roomJID, nick))
+        self.occupantJID = generic.internJID(u"%s/%s" % (self.roomJID, nick))
         self.nick = nick
 
 
@@ -98,7 +98,7 @@ class Unsupported(PubSubError):
         return message
 
 
-class Subscription(object):
+class Subscription(generic.SlotsPickleMixin):
     """
     A subscription to a node.
 
@@ -120,6 +120,9 @@ class Subscription(object):
     @type subscriptionIdentifier: C{unicode}
     """
 
+    __slots__ = ('nodeIdentifier', 'subscriber', 'state', 'options',
+                 'subscriptionIdentifier', '__dict__', '__weakref__')
+
     def __init__(self, nodeIdentifier, subscriber, state, options=None,
                        subscriptionIdentifier=None):
         self.nodeIdentifier = nodeIdentifier
@@ -378,7 +381,7 @@ class PubSubRequest(generic.Stanza):
         Parse subscriber out of the verbElement for un-/subscribe requests.
         """
         try:
-            self.subscriber = jid.internJID(verbElement["jid"])
+            self.subscriber = generic.internJID(verbElement["jid"])
         except KeyError:
             raise BadRequest('jid-required')
 
@@ -548,7 +551,7 @@ class PubSubRequest(generic.Stanza):
             if (element.uri == NS_PUBSUB_OWNER and
                 element.name == 'affiliation'):
                 try:
-                    entity = jid.internJID(element['jid']).userhostJID()
+                    entity = generic.internJID(element['jid']).userhostJID()
                 except KeyError:
                     raise BadRequest(text='Missing jid attribute')
 
@@ -29,7 +29,7 @@ from twisted.python import log, randbytes
 from twisted.words.protocols.jabber import error, ijabber, jid, xmlstream
 from twisted.words.xish import domish
 
-from wokkel.generic import DeferredXmlStreamFactory, XmlPipe
+from wokkel.generic import DeferredXmlStreamFactory, XmlPipe, internJID
 
 NS_DIALBACK = 'jabber:server:dialback'
 
@@ -147,7 +147,7 @@ class OriginatingDialbackInitializer(object):
         self.xmlstream.removeObserver(xmlstream.STREAM_ERROR_EVENT,
                                       self.onStreamError)
         if result['type'] == 'valid':
-            self.xmlstream.otherEntity = jid.internJID(self.otherHost)
+            self.xmlstream.otherEntity = internJID(self.otherHost)
             self._deferred.callback(None)
         else:
             self._deferred.errback(DialbackFailed())
@@ -244,7 +244,7 @@ class XMPPServerConnectAuthenticator(xmlstream.ConnectAuthenticator):
 
 
     def connectionMade(self):
-        self.xmlstream.thisEntity = jid.internJID(self.thisHost)
+        self.xmlstream.thisEntity = internJID(self.thisHost)
         self.xmlstream.prefixes = {xmlstream.NS_STREAMS: 'stream',
                                    NS_DIALBACK: 'db'}
         xmlstream.ConnectAuthenticator.connectionMade(self)
@@ -285,7 +285,7 @@ class XMPPServerVerifyAuthenticator(xmlstream.ConnectAuthenticator):
 
 
     def connectionMade(self):
-        self.xmlstream.thisEntity = jid.internJID(self.thisHost)
+        self.xmlstream.thisEntity = internJID(self.thisHost)
         self.xmlstream.prefixes = {xmlstream.NS_STREAMS: 'stream',
                                    NS_DIALBACK: 'db'}
         xmlstream.ConnectAuthenticator.connectionMade(self)
@@ -342,7 +342,7 @@ class XMPPServerListenAuthenticator(xmlstream.ListenAuthenticator):
             self.xmlstream.prefixes = {xmlstream.NS_STREAMS: 'stream',
                                        NS_DIALBACK: 'db'}
             if domain:
-                self.xmlstream.thisEntity = jid.internJID(domain)
+                self.xmlstream.thisEntity = internJID(domain)
 
         try:
             if xmlstream.NS_STREAMS != rootElement.uri or \
@@ -411,8 +411,8 @@ class XMPPServerListenAuthenticator(xmlstream.ListenAuthenticator):
         def valid(xs):
             reply('valid')
             if not self.xmlstream.thisEntity:
-                self.xmlstream.thisEntity = jid.internJID(receivingServer)
-            self.xmlstream.otherEntity = jid.internJID(originatingServer)
+                self.xmlstream.thisEntity = internJID(receivingServer)
+            self.xmlstream.otherEntity = internJID(originatingServer)
             self.xmlstream.dispatch(self.xmlstream,
                                     xmlstream.STREAM_AUTHD_EVENT)
 
@@ -441,6 +441,7 @@ class DeferredS2SClientFactory(DeferredXmlStreamFactory):
     """
 
     logTraffic = False
+    trafficTap = None
 
     def __init__(self, authenticator):
         DeferredXmlStreamFactory.__init__(self, authenticator)
@@ -461,7 +462,9 @@ class DeferredS2SClientFactory(DeferredXmlStreamFactory):
         def logDataOut(buf):
             log.msg("SEND (%d): %r" % (xs.serial, buf))
 
-        if self.logTraffic:
+        if self.trafficTap is not None:
+            self.trafficTap.attach(xs)
+        elif self.logTraffic:
             xs.rawDataInFn = logDataIn
             xs.rawDataOutFn = logDataOut
 
@@ -483,6 +486,7 @@ class XMPPS2SServerFactory(xmlstream.XmlStreamServerFactory):
     """
 
     logTraffic = False
+    trafficTap = None
 
     def __init__(self, service):
         self.service = service
@@ -514,7 +518,9 @@ class XMPPS2SServerFactory(xmlstream.XmlStreamServerFactory):
         def logDataOut(buf):
             log.msg("SEND (%d): %r" % (xs.serial, buf))
 
-        if self.logTraffic:
+        if self.trafficTap is not None:
+            self.trafficTap.attach(xs)
+        elif self.logTraffic:
             xs.rawDataInFn = logDataIn
             xs.rawDataOutFn = logDataOut
 
@@ -563,6 +569,7 @@ class ServerService(object):
     """
 
     logTraffic = False
+    trafficTap = None
 
     def __init__(self, router, domain=None, secret=None):
         self.router = router
@@ -633,6 +640,7 @@ class ServerService(object):
         factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT,
                              self.outgoingInitialized)
         factory.logTraffic = self.logTraffic
+        factory.trafficTap = self.trafficTap
 
         self._outgoingConnecting.add((thisHost, otherHost))
 
@@ -658,6 +666,7 @@ class ServerService(object):
         factory = DeferredS2SClientFactory(authenticator)
         factory.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, connected)
         factory.logTraffic = self.logTraffic
+        factory.trafficTap = self.trafficTap
 
         d = initiateS2S(factory)
         return d
@@ -671,8 +680,8 @@ class ServerService(object):
         to forward the stanza to.
         """
 
-        otherHost = jid.internJID(stanza["to"]).host
-        thisHost = jid.internJID(stanza["from"]).host
+        otherHost = internJID(stanza["to"]).host
+        thisHost = internJID(stanza["from"]).host
 
         if (thisHost, otherHost) not in self._outgoingStreams:
             # There is no connection with the destination (yet). Cache the
@@ -698,8 +707,8 @@ class ServerService(object):
             xs.sendStreamError(error.StreamError('improper-addressing'))
         else:
             try:
-                sender = jid.internJID(stanzaFrom)
-                jid.internJID(stanzaTo)
+                sender = internJID(stanzaFrom)
+                internJID(stanzaTo)
             except jid.InvalidFormat:
                 log.msg("Dropping error stanza with malformed JID")
 
@@ -0,0 +1,640 @@
+# -*- test-case-name: wokkel.test.test_shard -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Running a component server as several worker processes.
+
+A single L{Router} runs on a single core. To spread the load of a
+component server over several cores, a L{ShardMaster} opens the listening
+sockets and starts a number of worker processes that inherit them, so
+that the operating system spreads incoming connections over the workers.
+
+Each worker has its own L{ShardedRouter}, and the workers are connected
+to each other with links over Unix sockets, forming a full mesh. Whenever
+a component connects to a worker, the worker announces the component's
+domain to its peers, which then route stanzas for that domain over the
+link. A stanza is relayed over at most one link: stanzas received from a
+peer are only routed to local streams or the default route.
+"""
+
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+
+from twisted.application import service
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.abstract import isIPv6Address
+from twisted.internet.error import ProcessExitedAlready
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+from twisted.words.xish import domish, utility
+
+from wokkel.component import MultiStreamRoute, Router
+from wokkel.generic import XmlParser
+
+NS_SHARD = 'urn:x-wokkel:shard'
+
+def socketPath(directory, workerID):
+    """
+    Return the path of the Unix socket that a worker accepts links on.
+    """
+    return os.path.join(directory, 'worker-%d.sock' % (workerID,))
+
+
+
+class ShardLink(utility.EventDispatcher):
+    """
+    Link to a peer worker.
+
+    A link is used as a route destination in a L{ShardedRouter}, like XML
+    streams of components. Stanzas sent over the link are serialized, and
+    stanzas received are dispatched to observers, marked as relayed.
+    Relayed stanzas are never sent over a link again.
+
+    Route announcements received from the peer are passed to the router
+    instead.
+
+    @ivar protocol: The protocol the link is sent over.
+    @type protocol: L{ShardLinkProtocol}
+    @ivar router: The router of this worker.
+    @type router: L{ShardedRouter}
+    """
+
+    def __init__(self, protocol, router):
+        utility.EventDispatcher.__init__(self)
+        self.protocol = protocol
+        self.router = router
+        self._parser = XmlParser()
+
+
+    def send(self, obj):
+        """
+        Send a stanza, or serialized stanza, to the peer.
+        """
+        if getattr(obj, 'shardRelayed', False):
+            log.msg("Dropping stanza relayed from another worker: %r" %
+                    (obj.toXml(),))
+            return
+
+        if isinstance(obj, domish.Element):
+            obj = obj.toXml().encode('utf-8')
+
+        self.protocol.sendString(obj)
+
+
+    def sendRoute(self, action, destination):
+        """
+        Announce the addition or removal of a local route to the peer.
+
+        @param action: C{'add'} or C{'remove'}.
+        @type action: C{str}
+        @param destination: The destination of the route.
+        @type destination: C{unicode}
+        """
+        element = domish.Element((NS_SHARD, action))
+        element['destination'] = destination
+        self.protocol.sendString(element.toXml().encode('utf-8'))
+
+
+    def dataReceived(self, data):
+        """
+        Called when a serialized stanza or announcement was received.
+
+        Messages that are not a single well-formed element are logged and
+        dropped, keeping the link up.
+        """
+        try:
+            element = self._parser.parse(data)
+        except domish.ParserError:
+            element = None
+
+        if element is None:
+            log.msg("Dropping malformed message from another worker: %r" %
+                    (data,))
+            return
+
+        if element.uri == NS_SHARD:
+            destination = element.getAttribute('destination')
+            if element.name == 'add':
+                self.router.addRemoteRoute(destination, self)
+            elif element.name == 'remove':
+                self.router.removeRemoteRoute(destination, self)
+        else:
+            element.shardRelayed = True
+            self.dispatch(element)
+
+
+
+class ShardLinkProtocol(Int32StringReceiver):
+    """
+    Protocol for links between workers.
+
+    Each message is a serialized stanza or route announcement, prefixed
+    with its length.
+    """
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    link = None
+
+    def connectionMade(self):
+        self.link = ShardLink(self, self.factory.router)
+        self.factory.router.addLink(self.link)
+
+
+    def stringReceived(self, data):
+        self.link.dataReceived(data)
+
+
+    def connectionLost(self, reason):
+        if self.link is not None:
+            self.factory.router.removeLink(self.link)
+            self.link = None
+
+
+
+class ShardLinkServerFactory(protocol.ServerFactory):
+    """
+    Factory for links accepted from peer workers.
+    """
+
+    protocol = ShardLinkProtocol
+
+    def __init__(self, router):
+        self.router = router
+
+
+
+class ShardLinkClientFactory(protocol.ReconnectingClientFactory):
+    """
+    Factory for links to peer workers.
+
+    The peer might not be listening yet, so connection attempts are
+    retried.
+    """
+
+    protocol = ShardLinkProtocol
+    initialDelay = 0.1
+    maxDelay = 5
+
+    def __init__(self, router):
+        self.router = router
+
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+
+
+
+class ShardedRouter(Router):
+    """
+    Router of a worker that shares the routes of its peers.
+
+    Local routes, except for the default route, are announced to all
+    linked peers, and the routes announced by peers are added with the
+    link to that peer as the destination. If a domain has both a local
+    and a remote route, only the local one is used, unless a
+    C{routeFactory} is set, in which case traffic is spread over both.
+    Stanzas relayed from a peer are only spread over the local streams of
+    such a route.
+
+    @ivar links: The links to peer workers.
+    @type links: C{set} of L{ShardLink}
+    """
+
+    def __init__(self, *args, **kwargs):
+        Router.__init__(self, *args, **kwargs)
+        self.links = set()
+        self._remote = {}
+        self._nextLocal = 0
+
+
+    def _isLocal(self, destination):
+        """
+        Return whether a destination has a route to a local stream.
+        """
+        route = self.routes.get(destination)
+        if route is None:
+            return False
+        return any(not isinstance(xs, ShardLink)
+                   for xs in self._streams(route))
+
+
+    def _send(self, route, stanza):
+        """
+        Send a stanza over a route, keeping relayed stanzas local.
+
+        If the route selects a link for a stanza that was relayed from a
+        peer, one of the local streams of the route is selected in turn
+        instead, as relayed stanzas are never sent over a link again.
+        """
+        if (not getattr(stanza, 'shardRelayed', False) or
+            not isinstance(route, MultiStreamRoute)):
+            route.send(stanza)
+            return
+
+        xs = route.select(stanza)
+        if isinstance(xs, ShardLink):
+            local = [other for other in route.streams
+                     if not isinstance(other, ShardLink)]
+            if local:
+                xs = local[self._nextLocal % len(local)]
+                self._nextLocal += 1
+        xs.send(stanza)
+
+
+    def localRoutes(self):
+        """
+        Return the destinations of local routes, except the default route.
+        """
+        return [destination for destination in self.routes
+                if destination is not None and self._isLocal(destination)]
+
+
+    def addRoute(self, destination, xs):
+        announce = destination is not None and not self._isLocal(destination)
+
+        if self.routeFactory is None and destination in self.routes:
+            # Replace a remote route by the local one.
+            for link in self._remote.get(destination, ()):
+                self._removeLinkRoute(destination, link)
+
+        Router.addRoute(self, destination, xs)
+
+        if announce:
+            for link in self.links:
+                link.sendRoute('add', destination)
+
+
+    def removeRoute(self, destination, xs):
+        Router.removeRoute(self, destination, xs)
+
+        if destination is None or self._isLocal(destination):
+            return
+
+        for link in self.links:
+            link.sendRoute('remove', destination)
+
+        # Fall back to remote routes for the destination, if any.
+        for link in self._remote.get(destination, ()):
+            self._addLinkRoute(destination, link)
+
+
+    def _addLinkRoute(self, destination, link):
+        route = self.routes.get(destination)
+        if route is link or (isinstance(route, MultiStreamRoute) and
+                             link in route.streams):
+            return
+        Router.addRoute(self, destination, link)
+
+
+    def _removeLinkRoute(self, destination, link):
+        route = self.routes.get(destination)
+        if route is link or (isinstance(route, MultiStreamRoute) and
+                             link in route.streams):
+            Router.removeRoute(self, destination, link)
+            # Stanzas from the peer are still to be routed.
+            link.addObserver('/*', self.route)
+
+            if destination not in self.routes:
+                # Fall back to other peers that announced the destination.
+                for other in self._remote.get(destination, ()):
+                    self._addLinkRoute(destination, other)
+
+
+    def addRemoteRoute(self, destination, link):
+        """
+        Add a route announced by a peer.
+        """
+        self._remote.setdefault(destination, set()).add(link)
+        if self.routeFactory is not None or not self._isLocal(destination):
+            self._addLinkRoute(destination, link)
+
+
+    def removeRemoteRoute(self, destination, link):
+        """
+        Remove a route that a peer announced to be removed.
+        """
+        links = self._remote.get(destination)
+        if links is None:
+            return
+        links.discard(link)
+        if not links:
+            del self._remote[destination]
+        self._removeLinkRoute(destination, link)
+
+
+    def addLink(self, link):
+        """
+        Add a link to a peer, and announce the local routes to it.
+        """
+        self.links.add(link)
+        link.addObserver('/*', self.route)
+        for destination in self.localRoutes():
+            link.sendRoute('add', destination)
+
+
+    def removeLink(self, link):
+        """
+        Remove a link to a peer, and the routes it announced.
+        """
+        self.links.discard(link)
+        for destination, links in self._remote.items():
+            if link in links:
+                self.removeRemoteRoute(destination, link)
+        link.removeObserver('/*', self.route)
+
+
+
+class ShardService(service.Service):
+    """
+    Service that links a worker to its peers.
+
+    Each worker accepts links on a Unix socket in a shared directory, and
+    connects to the workers with a lower identifier, so that every pair of
+    workers has exactly one link.
+
+    @ivar router: The router of this worker.
+    @type router: L{ShardedRouter}
+    @ivar workerID: The identifier of this worker, from C{0} up to
+        C{workerCount}.
+    @type workerID: C{int}
+    @ivar workerCount: The total number of workers.
+    @type workerCount: C{int}
+    @ivar directory: The directory with the sockets of all workers.
+    @type directory: C{str}
+    """
+
+    def __init__(self, router, workerID, workerCount, directory,
+                       reactor=reactor):
+        self.router = router
+        self.workerID = workerID
+        self.workerCount = workerCount
+        self.directory = directory
+        self._reactor = reactor
+        self._port = None
+        self._connectors = []
+
+
+    def startService(self):
+        service.Service.startService(self)
+
+        path = socketPath(self.directory, self.workerID)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._port = self._reactor.listenUNIX(
+                path, ShardLinkServerFactory(self.router))
+
+        for peerID in xrange(self.workerID):
+            factory = ShardLinkClientFactory(self.router)
+            connector = self._reactor.connectUNIX(
+                    socketPath(self.directory, peerID), factory)
+            self._connectors.append((factory, connector))
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        for factory, connector in self._connectors:
+            factory.stopTrying()
+            connector.disconnect()
+        self._connectors = []
+
+        if self._port is not None:
+            d = defer.maybeDeferred(self._port.stopListening)
+            self._port = None
+            return d
+
+
+
+class InheritedPortService(service.Service):
+    """
+    Service that accepts connections on a socket inherited from the parent.
+
+    @ivar fileno: The file descriptor of the listening socket.
+    @type fileno: C{int}
+    @ivar factory: The factory for accepted connections.
+    @ivar family: The address family of the listening socket, see
+        L{socketFamily}.
+    """
+
+    def __init__(self, fileno, factory, family=socket.AF_INET,
+                       reactor=reactor):
+        self.fileno = fileno
+        self.factory = factory
+        self.family = family
+        self._reactor = reactor
+        self._port = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self._port = self._reactor.adoptStreamPort(self.fileno,
+                                                   self.family,
+                                                   self.factory)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port is not None:
+            d = defer.maybeDeferred(self._port.stopListening)
+            self._port = None
+            return d
+
+
+
+def _parseDescription(description):
+    """
+    Parse a TCP port description into a mapping of its options.
+
+    Colons in values, like in IPv6 addresses, are escaped with a backslash,
+    as for L{strports}.
+    """
+    parts = [part.replace('\\:', ':')
+             for part in re.split(r'(?<!\\):', description)]
+    if parts[0] != 'tcp':
+        raise ValueError("Only TCP ports can be shared: %r" % (description,))
+
+    options = {'interface': '', 'backlog': '50'}
+    positional = []
+    for part in parts[1:]:
+        if '=' in part:
+            key, value = part.split('=', 1)
+            options[key] = value
+        else:
+            positional.append(part)
+
+    if positional:
+        options['port'] = positional[0]
+    if 'port' not in options:
+        raise ValueError("No port given: %r" % (description,))
+
+    return options
+
+
+
+def socketFamily(description):
+    """
+    Return the address family of the socket for a port description.
+
+    @return: C{socket.AF_INET6} if the interface is an IPv6 address,
+        C{socket.AF_INET} otherwise.
+    @raise ValueError: If the description is not supported.
+    """
+    if isIPv6Address(_parseDescription(description)['interface']):
+        return socket.AF_INET6
+    else:
+        return socket.AF_INET
+
+
+
+def listeningSocket(description):
+    """
+    Open a listening TCP socket from a port description.
+
+    Only TCP port descriptions like for L{strports} are supported, e.g.
+    C{'tcp:5269'}, C{'tcp:5347:interface=127.0.0.1'} or
+    C{'tcp:5347:interface=\\:\\:1'}.
+
+    @rtype: L{socket.socket}
+    @raise ValueError: If the description is not supported.
+    """
+    options = _parseDescription(description)
+
+    sock = socket.socket(socketFamily(description), socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((options['interface'], int(options['port'])))
+    sock.listen(int(options['backlog']))
+    sock.setblocking(False)
+    return sock
+
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    Process protocol for a worker, that logs its output.
+    """
+
+    def __init__(self, workerID):
+        self.workerID = workerID
+        self.ended = defer.Deferred()
+
+
+    def outReceived(self, data):
+        for line in data.splitlines():
+            log.msg("[worker %d] %s" % (self.workerID, line))
+
+    errReceived = outReceived
+
+
+    def processEnded(self, reason):
+        log.msg("Worker %d ended: %s" % (self.workerID,
+                                          reason.getErrorMessage()))
+        self.ended.callback(None)
+
+
+
+class ShardMaster(service.Service):
+    """
+    Service that starts worker processes sharing listening sockets.
+
+    On start, this opens the listening sockets given by C{ports}, a
+    mapping from a worker option name to a port description (see
+    L{listeningSocket}), and creates a directory for the sockets of the
+    links between workers. Then it starts C{workerCount} workers, passing
+    each listening socket as an inherited file descriptor, in the option
+    of the same name. Workers are started as::
+
+        python -c "from wokkel.componentservertap import runWorker; ..."
+            <arguments> --worker-id=<id> --shard-dir=<directory> ...
+
+    The workers exit when their standard input is closed, e.g. when this
+    process exits, and are terminated when this service is stopped.
+
+    Secrets are not to be passed in C{arguments}, as the command line of
+    processes can be read by other users. Pass them in C{environment}
+    instead.
+
+    @ivar workerCount: The number of worker processes.
+    @type workerCount: C{int}
+    @ivar arguments: Command line arguments passed to every worker.
+    @type arguments: C{list} of C{str}
+    @ivar ports: Mapping from worker option to port description.
+    @type ports: C{dict}
+    @ivar environment: Environment variables set for the workers, in
+        addition to those of this process.
+    @type environment: C{dict}
+    """
+
+    command = "from wokkel.componentservertap import runWorker; runWorker()"
+
+    def __init__(self, workerCount, arguments, ports, environment=None,
+                       reactor=reactor):
+        self.workerCount = workerCount
+        self.arguments = arguments
+        self.ports = ports
+        self.environment = environment or {}
+        self._reactor = reactor
+        self._sockets = {}
+        self._workers = []
+        self.directory = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+
+        for option, description in self.ports.iteritems():
+            self._sockets[option] = listeningSocket(description)
+
+        self.directory = tempfile.mkdtemp(prefix='wokkel-shard-')
+
+        childFDs = {0: 'w', 1: 'r', 2: 'r'}
+        arguments = list(self.arguments)
+        for option, sock in self._sockets.iteritems():
+            childFDs[sock.fileno()] = sock.fileno()
+            arguments.append('--%s=%d' % (option, sock.fileno()))
+
+        environment = dict(os.environ)
+        environment.update(self.environment)
+
+        for workerID in xrange(self.workerCount):
+            args = [sys.executable, '-c', self.command] + arguments + [
+                    '--workers=%d' % (self.workerCount,),
+                    '--worker-id=%d' % (workerID,),
+                    '--shard-dir=%s' % (self.directory,)]
+            processProtocol = WorkerProcessProtocol(workerID)
+            process = self._reactor.spawnProcess(processProtocol,
+                                                 sys.executable, args,
+                                                 env=environment,
+                                                 childFDs=childFDs)
+            self._workers.append((processProtocol, process))
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        ended = []
+        for processProtocol, process in self._workers:
+            ended.append(processProtocol.ended)
+            try:
+                process.signalProcess('TERM')
+            except ProcessExitedAlready:
+                pass
+        self._workers = []
+
+        for sock in self._sockets.itervalues():
+            sock.close()
+        self._sockets = {}
+
+        def cleanup(_):
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+        d = defer.DeferredList(ended)
+        d.addCallback(cleanup)
+        return d
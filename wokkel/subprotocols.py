@@ -8,19 +8,27 @@ XMPP subprotocol support.
 """
 
 __all__ = ['XMPPHandler', 'XMPPHandlerCollection', 'StreamManager',
-           'IQHandlerMixin']
+           'IQHandlerMixin', 'TimeoutTracker', 'QueueOverflowError',
+           'DROP_OLDEST', 'REJECT_NEW', 'CoalescingTransport', 'NS_SM',
+           'HandlerStatistics']
+
+import heapq
+import math
+import re
+import time
+from collections import deque
 
 from zope.interface import implements
 
-from twisted.internet import defer
+from twisted.internet import defer, protocol
 from twisted.internet.error import ConnectionDone
-from twisted.python import failure, log
+from twisted.python import failure, log, reflect
 from twisted.python.deprecate import deprecatedModuleAttribute
 from twisted.python.versions import Version
 from twisted.words.protocols.jabber import error, ijabber, xmlstream
 from twisted.words.protocols.jabber.xmlstream import toResponse
 from twisted.words.protocols.jabber.xmlstream import XMPPHandlerCollection
-from twisted.words.xish import xpath
+from twisted.words.xish import domish, xpath
 from twisted.words.xish.domish import IElement
 
 deprecatedModuleAttribute(
@@ -30,6 +38,21 @@ deprecatedModuleAttribute(
         __name__,
         "XMPPHandlerCollection")
 
+# Overflow policies for the stream manager's queue of unsent data
+DROP_OLDEST = 'dropOldest'
+REJECT_NEW = 'rejectNew'
+
+NS_SM = 'urn:xmpp:sm:3'
+
+STANZA_KINDS = ('message', 'presence', 'iq')
+
+class QueueOverflowError(Exception):
+    """
+    Raised when queued data was dropped because the queue was full.
+    """
+
+
+
 class XMPPHandler(object):
     """
     XMPP protocol handler.
@@ -77,6 +100,23 @@ class XMPPHandler(object):
         """
 
 
+    def connectionResumed(self):
+        """
+        A previous XML stream has been resumed on a new XML stream.
+
+        This is called instead of L{connectionInitialized} when the stream
+        manager resumed a previous session using Stream Management (see
+        L{StreamManager.streamManagement}). Stanzas that were not
+        acknowledged have been resent, and outstanding requests are still
+        tracked, so there is no need to redo work like retrieving the roster
+        or sending initial presence.
+
+        By default, this calls L{connectionInitialized}. Override this method
+        to only set up observers on the new stream.
+        """
+        self.connectionInitialized()
+
+
     def connectionLost(self, reason):
         """
         The XML stream has been closed.
@@ -99,7 +139,8 @@ class XMPPHandler(object):
                C{self.xmlstream}.
 
         @param obj: data to be sent over the XML stream. This is usually an
-                    object providing L{domish.IElement}, or serialized XML. See
+                    object providing L{domish.IElement}, or serialized XML,
+                    possibly as a L{generic.SerializedStanza}. See
                     L{xmlstream.XmlStream} for details.
         """
         self.parent.send(obj)
@@ -117,6 +158,557 @@ class XMPPHandler(object):
         return self.parent.request(request)
 
 
+    def requestMany(self, requests, window=10, maxPerRecipient=None):
+        """
+        Send IQ requests with a bounded number in flight.
+
+        This passes the requests to the parent for sending and response
+        tracking.
+
+        @see: L{StreamManager.requestMany}.
+        """
+        return self.parent.requestMany(requests, window, maxPerRecipient)
+
+
+
+class TimeoutTracker(object):
+    """
+    Bucketed deadline tracker.
+
+    Instead of scheduling a delayed call for every tracked item, deadlines
+    are rounded up to a multiple of C{resolution} and grouped in buckets.
+    At most one delayed call is outstanding at any time, for the earliest
+    non-empty bucket. When it fires, all items in the expired buckets are
+    timed out in one batch.
+
+    As a consequence, items may time out up to C{resolution} seconds later
+    than requested.
+
+    @ivar resolution: The granularity of deadlines, in seconds.
+    @type resolution: C{float}
+    @ivar _buckets: Mapping from tick to a mapping of keys to the callables
+        to be called when the key times out.
+    @type _buckets: C{dict}
+    @ivar _ticks: Heap of ticks that have (or had) a bucket. Ticks for
+        buckets that have since been emptied are removed lazily.
+    @type _ticks: C{list}
+    @ivar _keys: Mapping from tracked keys to their tick.
+    @type _keys: C{dict}
+    @ivar _call: The delayed call for the earliest bucket, if any.
+    @type _call: L{IDelayedCall<twisted.internet.interfaces.IDelayedCall>}
+    @ivar _callTick: The tick L{_call} was scheduled for.
+    @type _callTick: C{int}
+    """
+
+    def __init__(self, reactor, resolution=1):
+        self._reactor = reactor
+        self.resolution = resolution
+        self._buckets = {}
+        self._ticks = []
+        self._keys = {}
+        self._call = None
+        self._callTick = None
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def __contains__(self, key):
+        return key in self._keys
+
+
+    def add(self, key, timeout, onTimeout):
+        """
+        Start tracking a deadline.
+
+        @param key: Identifier of the tracked item, to be used with
+            L{remove}. Adding a key that is already tracked replaces it.
+        @param timeout: Number of seconds after which C{onTimeout} is called.
+        @type timeout: C{float}
+        @param onTimeout: Called without arguments when the deadline
+            passes.
+        """
+        if key in self._keys:
+            self.remove(key)
+
+        deadline = self._reactor.seconds() + timeout
+        tick = int(math.ceil(deadline / self.resolution))
+
+        try:
+            bucket = self._buckets[tick]
+        except KeyError:
+            bucket = self._buckets[tick] = {}
+            heapq.heappush(self._ticks, tick)
+
+        bucket[key] = onTimeout
+        self._keys[key] = tick
+        self._schedule()
+
+
+    def remove(self, key):
+        """
+        Stop tracking a deadline.
+
+        Unknown keys are ignored.
+        """
+        try:
+            tick = self._keys.pop(key)
+        except KeyError:
+            return
+
+        bucket = self._buckets[tick]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[tick]
+            if not self._buckets:
+                self._ticks = []
+            self._schedule()
+
+
+    def clear(self):
+        """
+        Stop tracking all deadlines, without calling their callables.
+        """
+        self._buckets = {}
+        self._ticks = []
+        self._keys = {}
+        self._schedule()
+
+
+    def _schedule(self):
+        """
+        Make sure the delayed call matches the earliest non-empty bucket.
+        """
+        while self._ticks and self._ticks[0] not in self._buckets:
+            heapq.heappop(self._ticks)
+
+        if self._ticks:
+            tick = self._ticks[0]
+        else:
+            tick = None
+
+        if tick == self._callTick:
+            return
+
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+            self._callTick = None
+
+        if tick is not None:
+            delay = max(0, tick * self.resolution - self._reactor.seconds())
+            self._call = self._reactor.callLater(delay, self._expire)
+            self._callTick = tick
+
+
+    def _expire(self):
+        """
+        Time out all items in buckets that have expired.
+        """
+        self._call = None
+        self._callTick = None
+
+        now = self._reactor.seconds()
+        expired = []
+        while self._ticks and self._ticks[0] * self.resolution <= now:
+            tick = heapq.heappop(self._ticks)
+            bucket = self._buckets.pop(tick, None)
+            if bucket:
+                for key in bucket:
+                    del self._keys[key]
+                expired.append(bucket)
+
+        # Reschedule before calling out, as callables may add new items.
+        self._schedule()
+
+        for bucket in expired:
+            for onTimeout in bucket.itervalues():
+                onTimeout()
+
+
+
+class CoalescingTransport(object):
+    """
+    Transport wrapper that coalesces writes.
+
+    Data written to this transport is buffered, and passed on to the wrapped
+    transport with a single call to C{writeSequence}, either after
+    C{maxDelay} seconds (by default at the next reactor iteration), or as
+    soon as more than C{maxBytes} bytes have been buffered. Data is also
+    written out before closing the connection or starting TLS.
+
+    All other attributes are taken from the wrapped transport.
+
+    @ivar transport: The wrapped transport.
+    @ivar maxBytes: Maximum number of bytes to buffer before writing.
+    @type maxBytes: C{int}
+    @ivar maxDelay: Maximum number of seconds to buffer data.
+    @type maxDelay: C{float}
+    @ivar writes: Number of writes to this transport.
+    @type writes: C{int}
+    @ivar flushes: Number of writes to the wrapped transport.
+    @type flushes: C{int}
+    """
+
+    def __init__(self, transport, reactor, maxBytes=65536, maxDelay=0):
+        self.transport = transport
+        self.maxBytes = maxBytes
+        self.maxDelay = maxDelay
+        self.writes = 0
+        self.flushes = 0
+        self._reactor = reactor
+        self._buffer = []
+        self._bufferSize = 0
+        self._flushCall = None
+
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+    def write(self, data):
+        """
+        Buffer data to be written to the wrapped transport.
+        """
+        self.writes += 1
+        self._buffer.append(data)
+        self._bufferSize += len(data)
+
+        if self._bufferSize >= self.maxBytes:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = self._reactor.callLater(self.maxDelay,
+                                                      self.flush)
+
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+
+    def flush(self):
+        """
+        Write out all buffered data to the wrapped transport.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        if self._buffer:
+            data = self._buffer
+            self._buffer = []
+            self._bufferSize = 0
+            self.flushes += 1
+            self.transport.writeSequence(data)
+
+
+    def startTLS(self, *args, **kwargs):
+        self.flush()
+        return self.transport.startTLS(*args, **kwargs)
+
+
+    def loseConnection(self, *args, **kwargs):
+        self.flush()
+        return self.transport.loseConnection(*args, **kwargs)
+
+
+    def abortConnection(self):
+        self.stopFlushing()
+        return self.transport.abortConnection()
+
+
+    def stopFlushing(self):
+        """
+        Discard buffered data and stop writing to the wrapped transport.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        self._buffer = []
+        self._bufferSize = 0
+
+
+
+class _RequestPipeline(object):
+    """
+    Pipeline of IQ requests with a bounded number of requests in flight.
+
+    Requests are queued per recipient. Whenever there is room in the
+    window, the next request is taken from the recipients in round-robin
+    order, skipping recipients that already have the maximum number of
+    requests in flight.
+
+    @ivar inFlight: Number of requests sent that have not been responded to.
+    @type inFlight: C{int}
+    @ivar _queues: Mapping from recipient to a queue of C{(request,
+        deferred)} tuples waiting to be sent.
+    @type _queues: C{dict}
+    @ivar _ring: Recipients with waiting requests, in round-robin order.
+    @type _ring: C{collections.deque}
+    @ivar _perRecipient: Mapping from recipient to the number of requests in
+        flight to that recipient.
+    @type _perRecipient: C{dict}
+    """
+
+    def __init__(self, streamManager, window, maxPerRecipient=None):
+        if window < 1:
+            raise ValueError("The window must hold at least one request")
+        self._streamManager = streamManager
+        self.window = window
+        self.maxPerRecipient = maxPerRecipient
+        self.inFlight = 0
+        self._queues = {}
+        self._ring = deque()
+        self._perRecipient = {}
+        self._pumping = False
+        self._pumpAgain = False
+
+
+    def add(self, request):
+        """
+        Queue a request for sending.
+
+        @return: Deferred that fires with the response, like
+            L{StreamManager.request}.
+        @rtype: L{defer.Deferred}
+        """
+        d = defer.Deferred()
+        recipient = request.recipient
+        try:
+            queue = self._queues[recipient]
+        except KeyError:
+            queue = self._queues[recipient] = deque()
+            self._ring.append(recipient)
+        queue.append((request, d))
+        return d
+
+
+    def pump(self):
+        """
+        Send waiting requests while there is room in the window.
+        """
+        if self._pumping:
+            self._pumpAgain = True
+            return
+
+        self._pumping = True
+        try:
+            self._pumpAgain = True
+            while self._pumpAgain:
+                self._pumpAgain = False
+                self._fill()
+        finally:
+            self._pumping = False
+
+
+    def _fill(self):
+        ring = self._ring
+        skipped = 0
+        while ring and self.inFlight < self.window and skipped < len(ring):
+            recipient = ring[0]
+            ring.rotate(-1)
+
+            if (self.maxPerRecipient is not None and
+                self._perRecipient.get(recipient, 0) >= self.maxPerRecipient):
+                skipped += 1
+                continue
+
+            skipped = 0
+            queue = self._queues[recipient]
+            request, d = queue.popleft()
+            if not queue:
+                del self._queues[recipient]
+                ring.pop()
+
+            self._send(recipient, request, d)
+
+
+    def _send(self, recipient, request, d):
+        def done(result):
+            self.inFlight -= 1
+            count = self._perRecipient[recipient] - 1
+            if count:
+                self._perRecipient[recipient] = count
+            else:
+                del self._perRecipient[recipient]
+            self.pump()
+            return result
+
+        try:
+            responseDeferred = self._streamManager.request(request)
+        except:
+            d.errback()
+            return
+
+        self.inFlight += 1
+        self._perRecipient[recipient] = self._perRecipient.get(recipient,
+                                                               0) + 1
+
+        responseDeferred.addBoth(done)
+        responseDeferred.chainDeferred(d)
+
+
+
+class _RecordedObserver(object):
+    """
+    XML stream observer wrapper that records statistics for its calls.
+
+    This compares and hashes equal to the wrapped observer, so that it can
+    be removed by passing the original observer to C{removeObserver}.
+    """
+
+    def __init__(self, statistics, key, observer):
+        self.statistics = statistics
+        self.key = key
+        self.observer = observer
+
+
+    def __call__(self, *args, **kwargs):
+        return self.statistics._call(self.key, self.observer, *args, **kwargs)
+
+
+    def __eq__(self, other):
+        if isinstance(other, _RecordedObserver):
+            other = other.observer
+        return self.observer == other
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __hash__(self):
+        return hash(self.observer)
+
+
+
+class HandlerStatistics(object):
+    """
+    Latency and throughput statistics of protocol handler methods.
+
+    Calls are recorded per handler class and method name. For each, this
+    keeps the number of calls, the number of errors, the total time spent
+    in the synchronous part of the calls and, for calls that returned a
+    deferred, the total time until the deferred fired.
+
+    Besides methods called directly, the XML stream observers of handlers
+    can be recorded, by wrapping them with L{wrapObserver}. Those are
+    recorded under the name of the observer.
+
+    @ivar clock: Callable that returns the current time in seconds.
+    @ivar _entries: Mapping from handler class and method name to the
+        statistics for that method.
+    @type _entries: C{dict}
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._entries = {}
+
+
+    def _getEntry(self, key):
+        try:
+            return self._entries[key]
+        except KeyError:
+            entry = self._entries[key] = {'calls': 0,
+                                          'errors': 0,
+                                          'syncTime': 0.0,
+                                          'deferredCalls': 0,
+                                          'deferredTime': 0.0,
+                                          'pending': 0}
+            return entry
+
+
+    def call(self, handler, methodName, *args, **kwargs):
+        """
+        Call a method on a handler, and record statistics for it.
+
+        Exceptions raised by the method are propagated, like returned
+        deferreds are passed on.
+
+        @param handler: The handler to call the method on.
+        @param methodName: The name of the method.
+        @type methodName: C{str}
+        @return: The result of the method call.
+        """
+        return self._call((handler.__class__, methodName),
+                          getattr(handler, methodName), *args, **kwargs)
+
+
+    def wrapObserver(self, handler, observer):
+        """
+        Wrap an XML stream observer of a handler to record its calls.
+
+        @param handler: The handler the observer was added by.
+        @param observer: The observer callable.
+        @return: A callable to add as observer instead of C{observer}. It
+            compares equal to C{observer}, so the latter can still be used
+            to remove the observer.
+        """
+        name = getattr(observer, '__name__', None) or repr(observer)
+        return _RecordedObserver(self, (handler.__class__, name), observer)
+
+
+    def _call(self, key, method, *args, **kwargs):
+        entry = self._getEntry(key)
+        entry['calls'] += 1
+
+        start = self.clock()
+        try:
+            result = method(*args, **kwargs)
+        except:
+            entry['syncTime'] += self.clock() - start
+            entry['errors'] += 1
+            raise
+
+        entry['syncTime'] += self.clock() - start
+
+        if isinstance(result, defer.Deferred):
+            entry['deferredCalls'] += 1
+            entry['pending'] += 1
+
+            def done(result):
+                entry['deferredTime'] += self.clock() - start
+                entry['pending'] -= 1
+                if isinstance(result, failure.Failure):
+                    entry['errors'] += 1
+                return result
+
+            result.addBoth(done)
+
+        return result
+
+
+    def snapshot(self):
+        """
+        Return the statistics recorded so far.
+
+        @return: Mapping from C{(handler class name, method name)} to a
+            C{dict} with the number of C{'calls'} and C{'errors'}, the total
+            time in the synchronous part of the calls as C{'syncTime'}, the
+            number of calls that returned a deferred as C{'deferredCalls'},
+            the total time until those fired as C{'deferredTime'} and the
+            number of those that haven't fired yet as C{'pending'}.
+        @rtype: C{dict}
+        """
+        return dict(((reflect.qual(handlerClass), methodName), dict(entry))
+                    for (handlerClass, methodName), entry
+                    in self._entries.iteritems())
+
+
+    def reset(self):
+        """
+        Discard all recorded statistics.
+
+        Deferreds still pending are recorded in the old statistics.
+        """
+        self._entries = {}
+
+
 
 class StreamManager(XMPPHandlerCollection):
     """
@@ -131,20 +723,158 @@ class StreamManager(XMPPHandlerCollection):
     @type xmlstream: L{XmlStream}
     @ivar logTraffic: if true, log all traffic.
     @type logTraffic: C{bool}
+    @ivar trafficTap: If set, capture traffic with this tap instead of
+        logging it. This is cheap enough to leave on under load.
+    @type trafficTap: L{wokkel.traffic.TrafficTap}
     @ivar _initialized: Whether the stream represented by L{xmlstream} has
                         been initialized. This is used when caching outgoing
                         stanzas.
     @type _initialized: C{bool}
     @ivar _packetQueue: internal buffer of unsent data. See L{send} for details.
-    @type _packetQueue: L{list}
+    @type _packetQueue: C{collections.deque}
+    @ivar _packetQueueInfo: For each entry in L{_packetQueue}, a tuple of
+        its size in bytes (only measured if L{maxQueueBytes} is set) and the
+        time it expires (only if L{queueTimeout} is set).
+    @type _packetQueueInfo: C{collections.deque}
+    @ivar maxQueueLength: Maximum number of stanzas to keep in the queue of
+        unsent data, or C{None} for no limit.
+    @type maxQueueLength: C{int}
+    @ivar maxQueueBytes: Maximum total size in bytes of the serialized
+        stanzas in the queue of unsent data, or C{None} for no limit.
+    @type maxQueueBytes: C{int}
+    @ivar queueTimeout: Number of seconds after which queued data is
+        discarded if it couldn't be sent, or C{None} to keep it indefinitely.
+    @type queueTimeout: C{float}
+    @ivar queueOverflowPolicy: What to do when queueing data would exceed
+        L{maxQueueLength} or L{maxQueueBytes}. With L{DROP_OLDEST}, the
+        oldest data in the queue is dropped to make room. With
+        L{REJECT_NEW}, the new data is dropped instead.
+    @ivar queueFlushSize: Maximum number of queued stanzas sent in one
+        reactor iteration when a stream has been initialized, or C{None} to
+        send all of them at once.
+    @type queueFlushSize: C{int}
+    @ivar queueBytes: Total size of the queued data in bytes, if
+        L{maxQueueBytes} is set.
+    @type queueBytes: C{int}
+    @ivar queueDropped: Number of stanzas dropped from the queue because it
+        was full.
+    @type queueDropped: C{int}
+    @ivar queueDroppedBytes: Total size in bytes of the stanzas dropped from
+        the queue, if L{maxQueueBytes} is set.
+    @type queueDroppedBytes: C{int}
+    @ivar queueExpired: Number of stanzas dropped from the queue because they
+        were not sent within L{queueTimeout}.
+    @type queueExpired: C{int}
+    @ivar coalesceWrites: If true, writes to the transport of new streams
+        are coalesced using L{CoalescingTransport}, so that stanzas sent
+        within one reactor iteration are written out together.
+    @type coalesceWrites: C{bool}
+    @ivar coalesceMaxBytes: Maximum number of bytes to buffer when
+        coalescing writes.
+    @type coalesceMaxBytes: C{int}
+    @ivar coalesceMaxDelay: Maximum number of seconds to buffer data when
+        coalescing writes.
+    @type coalesceMaxDelay: C{float}
+    @ivar streamManagement: If true, enable Stream Management as described
+        in U{XEP-0198<http://xmpp.org/extensions/xep-0198.html>}, when
+        offered by the server. Sent stanzas are kept until acknowledged by
+        the server. If the server allows the stream to be resumed and the
+        factory reconnects, pending requests are not failed when the
+        connection is lost, and the next connection can resume the stream
+        with L{resumptionInfo} and L{streamResumed}, after which
+        unacknowledged stanzas are resent and handlers have their
+        C{connectionResumed} method called instead of
+        C{connectionInitialized}.
+    @type streamManagement: C{bool}
+    @ivar smAckInterval: Request an acknowledgement from the server every
+        this many unacknowledged stanzas, or never if C{None}.
+    @type smAckInterval: C{int}
+    @ivar _smID: The identifier of a resumable stream, or C{None}.
+    @type _smID: C{unicode}
+    @ivar _smActive: Whether Stream Management is active on the current
+        stream.
+    @type _smActive: C{bool}
+    @ivar _smInbound: Number of stanzas received since enabling Stream
+        Management.
+    @type _smInbound: C{int}
+    @ivar _smAcked: Number of sent stanzas acknowledged by the server.
+    @type _smAcked: C{int}
+    @ivar _smUnacked: Stanzas sent, but not yet acknowledged by the server.
+    @type _smUnacked: C{collections.deque}
+    @ivar statistics: If set, calls to handlers are recorded here. This
+        includes the connection events dispatched by the stream manager,
+        the XML stream observers added by handlers while processing those
+        events and iq requests handled through L{IQHandlerMixin}.
+    @type statistics: L{HandlerStatistics}
+    @ivar _smHeld: The identifiers of requests that were outstanding when
+        the connection of a resumable stream was lost, and the reason for
+        losing the connection.
+    @type _smHeld: C{tuple}
     @ivar timeout: Default IQ request timeout in seconds.
     @type timeout: C{int}
+    @ivar timeoutResolution: Granularity, in seconds, of IQ request
+        timeouts. Timeouts are tracked in batches using a L{TimeoutTracker},
+        instead of a delayed call per request, so that requests time out up
+        to this many seconds late. If C{None}, a delayed call is scheduled
+        for every request with a timeout.
+    @type timeoutResolution: C{float}
+    @ivar maxReplays: Number of times an idempotent request (see
+        L{generic.Request.idempotent}) is resent after the connection was
+        lost before a response came in. Until this budget is exhausted,
+        such requests are not failed when the connection is lost, but held
+        and resent once a new stream has been initialized. Their timeouts,
+        if any, keep running in the mean time.
+    @type maxReplays: C{int}
+    @ivar replayBatchSize: Maximum number of held requests resent in one go,
+        or C{None} to resend all of them at once.
+    @type replayBatchSize: C{int}
+    @ivar replayInterval: Number of seconds between resending batches of
+        held requests.
+    @type replayInterval: C{float}
+    @ivar _replayable: Outstanding idempotent requests, as a mapping of
+        their identifiers to a sequence number reflecting the order they
+        were sent in, their element and the number of times they were
+        resent.
+    @type _replayable: C{dict}
+    @ivar _replayHeld: Identifiers of the requests held since the
+        connection was lost, including those still in the queue of unsent
+        data.
+    @type _replayHeld: C{list}
+    @ivar _replayPending: Identifiers of held requests that have yet to be
+        resent.
+    @type _replayPending: C{collections.deque}
+    @ivar _replayReason: The reason the connection was lost when requests
+        were last held.
+    @type _replayReason: L{failure.Failure}
     @ivar _reactor: A provider of L{IReactorTime} to track timeouts.
+    @ivar _timeouts: Tracker for the deadlines of outstanding IQ requests.
+    @type _timeouts: L{TimeoutTracker}
     """
     timeout = None
+    timeoutResolution = 1
     _reactor = None
 
+    maxQueueLength = None
+    maxQueueBytes = None
+    queueTimeout = None
+    queueOverflowPolicy = DROP_OLDEST
+    queueFlushSize = None
+
+    coalesceWrites = False
+    coalesceMaxBytes = 65536
+    coalesceMaxDelay = 0
+
+    streamManagement = False
+    smAckInterval = 5
+
+    statistics = None
+
+    maxReplays = 3
+    replayBatchSize = 10
+    replayInterval = 0.1
+
     logTraffic = False
+    trafficTap = None
 
     def __init__(self, factory, reactor=None):
         """
@@ -156,9 +886,16 @@ class StreamManager(XMPPHandlerCollection):
         """
         XMPPHandlerCollection.__init__(self)
         self.xmlstream = None
-        self._packetQueue = []
+        self._packetQueue = deque()
+        self._packetQueueInfo = deque()
+        self._flushCall = None
         self._initialized = False
 
+        self.queueBytes = 0
+        self.queueDropped = 0
+        self.queueDroppedBytes = 0
+        self.queueExpired = 0
+
         factory.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, self._connected)
         factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self._authd)
         factory.addBootstrap(xmlstream.INIT_FAILED_EVENT,
@@ -172,6 +909,24 @@ class StreamManager(XMPPHandlerCollection):
 
         # Set up IQ response tracking
         self._iqDeferreds = {}
+        self._timeouts = None
+
+        # Replay of idempotent requests
+        self._replayable = {}
+        self._replaySerial = 0
+        self._replayHeld = []
+        self._replayPending = deque()
+        self._replayReason = None
+        self._replayCall = None
+
+        # Stream Management state
+        self._smID = None
+        self._smActive = False
+        self._smResumed = False
+        self._smInbound = 0
+        self._smAcked = 0
+        self._smUnacked = deque()
+        self._smHeld = None
 
 
     def addHandler(self, handler):
@@ -186,18 +941,19 @@ class StreamManager(XMPPHandlerCollection):
         # get protocol handler up to speed when a connection has already
         # been established
         if self.xmlstream:
-            handler.makeConnection(self.xmlstream)
+            self._notifyHandler(handler, 'makeConnection', self.xmlstream)
         if self._initialized:
-            handler.connectionInitialized()
+            self._notifyHandler(handler, 'connectionInitialized')
 
 
     def _connected(self, xs):
         """
         Called when the transport connection has been established.
 
-        Here we optionally set up traffic logging (depending on L{logTraffic})
-        and call each handler's C{makeConnection} method with the L{XmlStream}
-        instance.
+        Here we optionally set up traffic logging (depending on L{trafficTap}
+        and L{logTraffic}) and write coalescing (depending on
+        L{coalesceWrites}) and call each handler's C{makeConnection} method
+        with the L{XmlStream} instance.
         """
         def logDataIn(buf):
             log.msg("RECV: %r" % buf)
@@ -205,14 +961,21 @@ class StreamManager(XMPPHandlerCollection):
         def logDataOut(buf):
             log.msg("SEND: %r" % buf)
 
-        if self.logTraffic:
+        if self.trafficTap is not None:
+            self.trafficTap.attach(xs)
+        elif self.logTraffic:
             xs.rawDataInFn = logDataIn
             xs.rawDataOutFn = logDataOut
 
+        if self.coalesceWrites and xs.transport is not None:
+            xs.transport = CoalescingTransport(xs.transport, self._reactor,
+                                               self.coalesceMaxBytes,
+                                               self.coalesceMaxDelay)
+
         self.xmlstream = xs
 
         for e in list(self):
-            e.makeConnection(xs)
+            self._notifyHandler(e, 'makeConnection', xs)
 
 
     def _authd(self, xs):
@@ -220,22 +983,72 @@ class StreamManager(XMPPHandlerCollection):
         Called when the stream has been initialized.
 
         Send out cached stanzas and call each handler's
-        C{connectionInitialized} method.
+        C{connectionInitialized} method, or C{connectionResumed} if a
+        previous stream was resumed.
         """
 
         xs.addObserver('/iq[@type="result"]', self._onIQResponse)
         xs.addObserver('/iq[@type="error"]', self._onIQResponse)
 
+        resumed = self._smResumed
+        self._smResumed = False
+        if not resumed:
+            self._smSessionLost()
+
+        features = getattr(xs, 'features', {})
+        if self.streamManagement and (resumed or (NS_SM, 'sm') in features):
+            self._smStart(xs, resumed)
+
         # Flush all pending packets
-        for p in self._packetQueue:
-            xs.send(p)
-        self._packetQueue = []
         self._initialized = True
+        self._flushQueue()
+        self._replayRequests()
 
         # Notify all child services which implement
         # the IService interface
         for e in list(self):
-            e.connectionInitialized()
+            if resumed and hasattr(e, 'connectionResumed'):
+                self._notifyHandler(e, 'connectionResumed')
+            else:
+                self._notifyHandler(e, 'connectionInitialized')
+
+
+    def _notifyHandler(self, handler, methodName, *args):
+        """
+        Call a connection event method on a handler.
+
+        If L{statistics} is set, the call is recorded, as are the calls to
+        the observers that the handler adds to the XML stream during the
+        call.
+        """
+        statistics = self.statistics
+        if statistics is None:
+            getattr(handler, methodName)(*args)
+            return
+
+        xs = self.xmlstream
+        if xs is None:
+            statistics.call(handler, methodName, *args)
+            return
+
+        def wrap(add):
+            def addObserver(event, observerfn, *args, **kwargs):
+                observerfn = statistics.wrapObserver(handler, observerfn)
+                return add(event, observerfn, *args, **kwargs)
+            return addObserver
+
+        names = ('addObserver', 'addOnetimeObserver')
+        saved = dict((name, xs.__dict__.get(name)) for name in names)
+        for name in names:
+            setattr(xs, name, wrap(getattr(xs, name)))
+        try:
+            statistics.call(handler, methodName, *args)
+        finally:
+            for name, value in saved.iteritems():
+                if value is None:
+                    delattr(xs, name)
+                else:
+                    setattr(xs, name, value)
 
 
     def initializationFailed(self, reason):
@@ -260,9 +1073,23 @@ class StreamManager(XMPPHandlerCollection):
         L{XmlStream} anymore and notifies each handler that the connection
         was lost by calling its C{connectionLost} method.
         """
+        transport = getattr(self.xmlstream, 'transport', None)
+        if isinstance(transport, CoalescingTransport):
+            transport.stopFlushing()
+
         self.xmlstream = None
         self._initialized = False
 
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+
+        if self._replayCall is not None:
+            self._replayCall.cancel()
+            self._replayCall = None
+        self._replayHeld = []
+        self._replayPending.clear()
+
         # Twisted versions before 11.0 passed an XmlStream here.
         if not hasattr(reason, 'trap'):
             reason = failure.Failure(ConnectionDone())
@@ -270,15 +1097,271 @@ class StreamManager(XMPPHandlerCollection):
         # Notify all child services which implement
         # the IService interface
         for e in list(self):
-            e.connectionLost(reason)
+            self._notifyHandler(e, 'connectionLost', reason)
+
+        self._smActive = False
+        if self._smID is not None:
+            if self._willReconnect():
+                # Hold on to outstanding requests until the stream is
+                # resumed, or resumption has failed.
+                self._smHeld = (list(self._iqDeferreds), reason)
+                return
+            else:
+                self._smSessionLost()
 
         # This errbacks all deferreds of iq's for which no response has
         # been received with a L{ConnectionLost} failure. Otherwise, the
         # deferreds will never be fired.
-        iqDeferreds = self._iqDeferreds
-        self._iqDeferreds = {}
-        for d in iqDeferreds.itervalues():
-            d.errback(reason)
+        self._failRequests(list(self._iqDeferreds), reason)
+
+
+    def _willReconnect(self):
+        """
+        Return whether the factory will make a new connection.
+
+        Only factories derived from L{protocol.ReconnectingClientFactory}
+        reconnect, as long as they have not been told to stop trying.
+        """
+        return (isinstance(self.factory, protocol.ReconnectingClientFactory)
+                and self.factory.continueTrying)
+
+
+    def _stoppedTrying(self):
+        """
+        Called when the factory has stopped making new connections.
+
+        Without a new stream, the previous stream cannot be resumed and
+        held idempotent requests cannot be resent, so those requests are
+        failed with the reason the connection was lost. If there is a
+        current stream, this happens when its connection is lost.
+        """
+        if self.xmlstream is None:
+            self._smSessionLost()
+
+            held, self._replayHeld = self._replayHeld, []
+            self._replayPending.clear()
+            for stanzaID in held:
+                d = self._iqDeferreds.pop(stanzaID, None)
+                if d is not None:
+                    d.errback(self._replayReason)
+
+
+    def resumptionInfo(self):
+        """
+        Get the information needed to resume the previous stream.
+
+        @return: The identifier of the resumable stream and the number of
+            stanzas received on it, or C{None} if there is no resumable
+            stream.
+        @rtype: C{tuple} or C{NoneType}
+        """
+        if self.streamManagement and self._smID is not None:
+            return self._smID, self._smInbound
+        else:
+            return None
+
+
+    def streamResumed(self, h):
+        """
+        Called when the previous stream has been resumed.
+
+        This is to be called during stream initialization, before
+        L{_authd}, by the initializer that resumed the stream.
+
+        @param h: The number of our stanzas the server has received.
+        @type h: C{int}
+        """
+        self._smResumed = True
+        self._smAcknowledge(h)
+
+
+    def resumptionFailed(self):
+        """
+        Called when the previous stream could not be resumed.
+
+        Requests that were outstanding when the connection of that stream
+        was lost have their deferreds errbacked with the reason the
+        connection was lost, and unacknowledged stanzas are discarded.
+        """
+        self._smSessionLost()
+
+
+    def _smSessionLost(self):
+        """
+        Forget about the previous stream and its outstanding requests.
+        """
+        self._smID = None
+        self._smUnacked.clear()
+
+        held, self._smHeld = self._smHeld, None
+        if held is not None:
+            stanzaIDs, reason = held
+            self._failRequests(stanzaIDs, reason)
+
+
+    def _failRequests(self, stanzaIDs, reason):
+        """
+        Fail outstanding requests because the connection was lost.
+
+        Idempotent requests that have not exhausted L{maxReplays} are held
+        to be resent by L{_replayRequests} instead, in the order they were
+        originally sent, unless no new connection will be made. If such a
+        request still sits in the queue of unsent data, it is held without
+        being resent.
+
+        @param stanzaIDs: The identifiers of the requests.
+        @param reason: The reason the connection was lost.
+        @type reason: L{failure.Failure}
+        """
+        held = []
+        for stanzaID in stanzaIDs:
+            try:
+                d = self._iqDeferreds[stanzaID]
+            except KeyError:
+                continue
+
+            replay = self._replayable.get(stanzaID)
+            if (replay is not None and replay[2] < self.maxReplays and
+                self._willReconnect()):
+                held.append((replay[0], stanzaID))
+            else:
+                del self._iqDeferreds[stanzaID]
+                d.errback(reason)
+
+        if held:
+            self._replayReason = reason
+            held.sort()
+            queued = set(id(obj) for obj in self._packetQueue)
+            for _, stanzaID in held:
+                self._replayHeld.append(stanzaID)
+                if id(self._replayable[stanzaID][1]) not in queued:
+                    self._replayPending.append(stanzaID)
+
+
+    def _replayRequests(self):
+        """
+        Resend held idempotent requests over the initialized XML stream.
+
+        At most L{replayBatchSize} requests are resent at once, the
+        remainder follows after L{replayInterval} seconds.
+        """
+        self._replayCall = None
+
+        pending = self._replayPending
+        if not pending or not self._initialized:
+            return
+
+        count = self.replayBatchSize
+        while pending and (count is None or count > 0):
+            stanzaID = pending.popleft()
+            replay = self._replayable.get(stanzaID)
+            if replay is None or stanzaID not in self._iqDeferreds:
+                continue
+
+            replay[2] += 1
+            self.send(replay[1])
+            if count is not None:
+                count -= 1
+
+        if pending:
+            self._replayCall = self._reactor.callLater(self.replayInterval,
+                                                       self._replayRequests)
+
+
+    def _smStart(self, xs, resumed):
+        """
+        Set up Stream Management on a new stream.
+
+        This sets up counting and acknowledgement of stanzas. If a previous
+        stream was resumed, stanzas not acknowledged by the server are sent
+        again. Otherwise Stream Management is enabled, requesting the
+        stream to be resumable.
+        """
+        self._smActive = True
+
+        send = xs.send
+
+        def smSend(obj):
+            send(obj)
+            if self._smActive and _isStanza(obj):
+                self._smUnacked.append(obj)
+                if (self.smAckInterval and
+                    not len(self._smUnacked) % self.smAckInterval):
+                    send(domish.Element((NS_SM, 'r')))
+
+        xs.send = smSend
+        xs.addObserver('/*', self._smOnElement, 100)
+        xs.addObserver('/r[@xmlns="%s"]' % NS_SM, self._smOnAckRequest)
+        xs.addObserver('/a[@xmlns="%s"]' % NS_SM, self._smOnAck)
+
+        if resumed:
+            unacked = list(self._smUnacked)
+            self._smUnacked.clear()
+            for obj in unacked:
+                xs.send(obj)
+        else:
+            self._smInbound = 0
+            self._smAcked = 0
+
+            def onEnabled(element):
+                xs.removeObserver(failedQuery, onFailed)
+                if element.getAttribute('resume') in ('true', '1'):
+                    self._smID = element.getAttribute('id')
+
+            def onFailed(element):
+                xs.removeObserver(enabledQuery, onEnabled)
+                self._smActive = False
+                self._smUnacked.clear()
+
+            enabledQuery = '/enabled[@xmlns="%s"]' % NS_SM
+            failedQuery = '/failed[@xmlns="%s"]' % NS_SM
+            xs.addOnetimeObserver(enabledQuery, onEnabled)
+            xs.addOnetimeObserver(failedQuery, onFailed)
+
+            enable = domish.Element((NS_SM, 'enable'))
+            enable['resume'] = 'true'
+            xs.send(enable)
+
+
+    def _smOnElement(self, element):
+        """
+        Count received stanzas.
+        """
+        if self._smActive and element.name in STANZA_KINDS:
+            self._smInbound += 1
+
+
+    def _smOnAckRequest(self, element):
+        """
+        Acknowledge the stanzas received so far.
+        """
+        if self._smActive:
+            answer = domish.Element((NS_SM, 'a'))
+            answer['h'] = str(self._smInbound)
+            self.xmlstream.send(answer)
+
+
+    def _smOnAck(self, element):
+        """
+        Process an acknowledgement from the server.
+        """
+        try:
+            h = int(element.getAttribute('h'))
+        except (TypeError, ValueError):
+            return
+        self._smAcknowledge(h)
+
+
+    def _smAcknowledge(self, h):
+        """
+        Discard the stanzas the server has acknowledged.
+
+        The counter wraps around at 2**32.
+        """
+        count = (h - self._smAcked) % 2**32
+        for _ in xrange(min(count, len(self._smUnacked))):
+            self._smUnacked.popleft()
+        self._smAcked = h
 
 
     def _onIQResponse(self, iq):
@@ -303,15 +1386,140 @@ class StreamManager(XMPPHandlerCollection):
         Send data over the XML stream.
 
         When there is no established XML stream, the data is queued and sent
-        out when a new XML stream has been established and initialized.
-
-        @param obj: data to be sent over the XML stream. See
+        out when a new XML stream has been established and initialized. The
+        size of this queue can be bounded, and queued data can be set to
+        expire. See L{maxQueueLength}, L{maxQueueBytes} and L{queueTimeout}.
+        If queued data for an outstanding request (see L{request}) is
+        dropped, the deferred for its response is errbacked.
+
+        @param obj: data to be sent over the XML stream. Besides elements,
+                    this may be serialized XML, like a
+                    L{generic.SerializedStanza} rendered from a
+                    L{generic.StanzaTemplate}. See
                     L{xmlstream.XmlStream.send} for details.
         """
-        if self._initialized:
+        if self._initialized and not self._packetQueue:
             self.xmlstream.send(obj)
         else:
-            self._packetQueue.append(obj)
+            self._queuePacket(obj)
+
+
+    def _queuePacket(self, obj):
+        """
+        Add data to the queue of unsent data, subject to its limits.
+        """
+        if self.queueTimeout is not None:
+            now = self._reactor.seconds()
+            self._expireQueue(now)
+            expires = now + self.queueTimeout
+        else:
+            expires = None
+
+        if self.maxQueueBytes is not None:
+            size = _serializedSize(obj)
+        else:
+            size = 0
+
+        while self._queueFull(size):
+            if (self.queueOverflowPolicy == REJECT_NEW or
+                not self._packetQueue):
+                self._dropPacket(obj, size)
+                return
+            else:
+                oldest = self._packetQueue.popleft()
+                oldestSize = self._packetQueueInfo.popleft()[0]
+                self.queueBytes -= oldestSize
+                self._dropPacket(oldest, oldestSize)
+
+        self._packetQueue.append(obj)
+        self._packetQueueInfo.append((size, expires))
+        self.queueBytes += size
+
+
+    def _queueFull(self, size):
+        """
+        Check if adding data of the given size would exceed the queue limits.
+        """
+        return ((self.maxQueueLength is not None and
+                 len(self._packetQueue) >= self.maxQueueLength) or
+                (self.maxQueueBytes is not None and
+                 self.queueBytes + size > self.maxQueueBytes))
+
+
+    def _dropPacket(self, obj, size):
+        """
+        Account for data dropped because the queue was full.
+
+        The size of data that was in the queue is expected to have been
+        subtracted from L{queueBytes} by the caller.
+        """
+        self.queueDropped += 1
+        self.queueDroppedBytes += size
+        self._failQueuedRequest(obj, QueueOverflowError())
+
+
+    def _expireQueue(self, now):
+        """
+        Drop queued data that has expired.
+        """
+        queue, info = self._packetQueue, self._packetQueueInfo
+        while info and info[0][1] is not None and info[0][1] <= now:
+            obj = queue.popleft()
+            size = info.popleft()[0]
+            self.queueBytes -= size
+            self.queueExpired += 1
+            self._failQueuedRequest(
+                    obj, xmlstream.TimeoutError("Queued stanza expired"))
+
+
+    def _failQueuedRequest(self, obj, exc):
+        """
+        Errback the deferred for a request if it was dropped from the queue.
+        """
+        if IElement.providedBy(obj):
+            kind = obj.name
+            stanzaType = obj.getAttribute('type')
+            stanzaID = obj.getAttribute('id')
+        else:
+            # Pre-serialized stanzas, see L{generic.SerializedStanza}.
+            kind = getattr(obj, 'stanzaKind', None)
+            stanzaType = getattr(obj, 'stanzaType', None)
+            stanzaID = getattr(obj, 'stanzaID', None)
+
+        if kind == 'iq' and stanzaType in ('get', 'set'):
+            try:
+                d = self._iqDeferreds.pop(stanzaID)
+            except KeyError:
+                pass
+            else:
+                d.errback(exc)
+
+
+    def _flushQueue(self):
+        """
+        Send out queued data over the initialized XML stream.
+
+        If L{queueFlushSize} is set, at most that many stanzas are sent in
+        one go, and the remainder is sent in subsequent reactor iterations.
+        Data sent in the mean time is appended to the queue, to retain
+        ordering.
+        """
+        self._flushCall = None
+
+        if self.queueTimeout is not None:
+            self._expireQueue(self._reactor.seconds())
+
+        queue, info = self._packetQueue, self._packetQueueInfo
+        count = self.queueFlushSize
+        while queue and self._initialized and (count is None or count > 0):
+            obj = queue.popleft()
+            self.queueBytes -= info.popleft()[0]
+            self.xmlstream.send(obj)
+            if count is not None:
+                count -= 1
+
+        if queue and self._initialized:
+            self._flushCall = self._reactor.callLater(0, self._flushQueue)
 
 
     def request(self, request):
@@ -334,7 +1542,9 @@ class StreamManager(XMPPHandlerCollection):
         corresponding L{error.StanzaError} will be errbacked.
 
         If the connection is closed before a response was received, the deferred
-        will be errbacked with the reason failure.
+        will be errbacked with the reason failure. Unless the request is
+        marked as idempotent, in which case it is resent on the next
+        stream, up to L{maxReplays} times.
 
         A request may also have a timeout, either by setting a default timeout
         in L{StreamManager}'s C{timeout} attribute or on the C{timeout}
@@ -355,16 +1565,72 @@ class StreamManager(XMPPHandlerCollection):
             request.stanzaID = element['id']
 
         # Set up iq response tracking
+        stanzaID = element['id']
         d = defer.Deferred()
-        self._iqDeferreds[element['id']] = d
+        self._iqDeferreds[stanzaID] = d
 
         timeout = getattr(request, 'timeout', self.timeout)
 
         if timeout is not None:
-            def onTimeout():
-                del self._iqDeferreds[element['id']]
-                d.errback(xmlstream.TimeoutError("IQ timed out"))
+            self._trackTimeout(stanzaID, d, timeout)
+
+        if getattr(request, 'idempotent', False):
+            def forgetReplay(result):
+                self._replayable.pop(stanzaID, None)
+                return result
+
+            self._replayable[stanzaID] = [self._replaySerial, element, 0]
+            self._replaySerial += 1
+            d.addBoth(forgetReplay)
+
+        self.send(element)
+        return d
+
 
+    def requestMany(self, requests, window=10, maxPerRecipient=None):
+        """
+        Send IQ requests with a bounded number of requests in flight.
+
+        Instead of sending all requests at once, like calling L{request} in
+        a loop would do, at most C{window} requests are sent out without
+        having received a response. Every time a response comes in (or a
+        request fails or times out), the next request is sent. Requests are
+        taken from the different recipients in round-robin order, so that
+        bulk work for one entity does not starve the others. Optionally,
+        the number of requests in flight per recipient can be limited too.
+
+        @param requests: The IQ requests to send, see L{request}.
+        @type requests: iterable of L{generic.Request}
+        @param window: Maximum number of requests in flight.
+        @type window: C{int}
+        @param maxPerRecipient: Maximum number of requests in flight per
+            recipient, or C{None} for no limit besides C{window}.
+        @type maxPerRecipient: C{int}
+        @return: For each request, in the order of C{requests}, a deferred
+            that fires with its response as soon as it comes in, like the
+            deferred returned by L{request}.
+        @rtype: C{list} of L{defer.Deferred}
+        """
+        pipeline = _RequestPipeline(self, window, maxPerRecipient)
+        deferreds = [pipeline.add(request) for request in requests]
+        pipeline.pump()
+        return deferreds
+
+
+    def _trackTimeout(self, stanzaID, d, timeout):
+        """
+        Time out an outstanding IQ request after C{timeout} seconds.
+
+        @param stanzaID: The identifier of the request.
+        @type stanzaID: C{unicode}
+        @param d: The deferred for the response to the request.
+        @type d: L{defer.Deferred}
+        """
+        def onTimeout():
+            del self._iqDeferreds[stanzaID]
+            d.errback(xmlstream.TimeoutError("IQ timed out"))
+
+        if self.timeoutResolution is None:
             call = self._reactor.callLater(timeout, onTimeout)
 
             def cancelTimeout(result):
@@ -372,10 +1638,127 @@ class StreamManager(XMPPHandlerCollection):
                     call.cancel()
 
                 return result
+        else:
+            if self._timeouts is None:
+                self._timeouts = TimeoutTracker(self._reactor,
+                                                self.timeoutResolution)
+            timeouts = self._timeouts
 
-            d.addBoth(cancelTimeout)
-        self.send(element)
-        return d
+            def cancelTimeout(result):
+                timeouts.remove(stanzaID)
+                return result
+
+            timeouts.add(stanzaID, timeout, onTimeout)
+
+        d.addBoth(cancelTimeout)
+
+
+
+_SIMPLE_IQ_QUERY = re.compile(r"""
+    ^/iq\[@type=(?P<q1>['"])(?P<type>[^'"]+)(?P=q1)\]
+    /(?P<name>[^\[\]/'"*@]+)
+    \[@xmlns=(?P<q2>['"])(?P<uri>[^'"]+)(?P=q2)\]$
+    """, re.VERBOSE)
+
+def _isStanza(obj):
+    """
+    Check whether data sent over an XML stream is a stanza.
+    """
+    if IElement.providedBy(obj):
+        return obj.name in STANZA_KINDS
+
+    kind = getattr(obj, 'stanzaKind', None)
+    if kind is not None:
+        return kind in STANZA_KINDS
+
+    for kind in STANZA_KINDS:
+        if obj.startswith('<' + kind):
+            return obj[len(kind) + 1:len(kind) + 2] in (' ', '/', '>')
+    return False
+
+
+
+def _serializedSize(obj):
+    """
+    Return the size in bytes of data when sent over an XML stream.
+    """
+    if IElement.providedBy(obj):
+        obj = obj.toXml()
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+    return len(obj)
+
+
+
+class _IQDispatchIndex(object):
+    """
+    Compiled form of an C{iqHandlers} mapping.
+
+    Queries of the form C{/iq[@type='T']/name[@xmlns='NS']}, as used by
+    most protocol implementations, are indexed by C{(T, NS, name)}, so that
+    finding a handler for an incoming request only takes a dictionary lookup
+    per child element of the iq. Other queries are kept as compiled XPath
+    queries and are only tried if no indexed query matched.
+
+    @ivar iqHandlers: The mapping this index was built from.
+    @type iqHandlers: C{dict}
+    @ivar size: Number of queries in C{iqHandlers} when the index was built.
+    @type size: C{int}
+    @ivar index: Mapping from C{(type, uri, name)} to method name.
+    @type index: C{dict}
+    @ivar fallback: List of C{(query, method name)} tuples for the queries
+        that could not be indexed.
+    @type fallback: C{list}
+    """
+
+    def __init__(self, iqHandlers):
+        self.iqHandlers = iqHandlers
+        self.size = len(iqHandlers)
+        self.index = {}
+        self.fallback = []
+
+        for queryString, method in iqHandlers.iteritems():
+            match = _SIMPLE_IQ_QUERY.match(queryString)
+            if match:
+                key = match.group('type'), match.group('uri'), \
+                      match.group('name')
+                self.index[key] = method
+            else:
+                self.fallback.append((xpath.internQuery(queryString), method))
+
+
+    def lookup(self, iq):
+        """
+        Find the name of the method to handle the given iq.
+
+        @return: The method name or C{None} if no query matched.
+        """
+        if self.index:
+            iqType = iq.getAttribute('type')
+            for child in iq.elements():
+                try:
+                    return self.index[iqType, child.uri, child.name]
+                except KeyError:
+                    pass
+
+        for query, method in self.fallback:
+            if query.matches(iq):
+                return method
+
+        return None
+
+
+    def isCurrent(self, iqHandlers):
+        """
+        Check if this index is built from the given mapping.
+
+        Besides the identity of the mapping, only its size is compared, so
+        that this check is cheap. Queries added to or removed from the
+        mapping are noticed, but changing the method name of a query in
+        place is not.
+        """
+        return (self.iqHandlers is iqHandlers and
+                self.size == len(iqHandlers))
 
 
 
@@ -418,6 +1801,16 @@ class IQHandlerMixin(object):
         ...    def onRosterSet(self, iq):
         ...        pass
 
+    If the handler's parent has L{statistics<StreamManager.statistics>}
+    set, calls to the methods handling requests are recorded there.
+
+    The queries in C{iqHandlers} are compiled into a dispatch index once
+    per class (see L{_IQDispatchIndex}), so that the common form of query
+    (matching the iq type and the name and namespace of its child element)
+    doesn't need XPath evaluation for every incoming request. To change
+    which method handles a query, replace C{iqHandlers} instead of changing
+    it in place.
+
     @cvar iqHandlers: Mapping from XPath queries (as a string) to the method
                       name that will handle requests that match the query.
     @type iqHandlers: C{dict}
@@ -425,6 +1818,31 @@ class IQHandlerMixin(object):
 
     iqHandlers = None
 
+    def _getIQDispatchIndex(self):
+        """
+        Get the dispatch index for C{iqHandlers}, building it if needed.
+
+        The index is cached on the class, and rebuilt when the class'
+        C{iqHandlers} has been replaced, or queries were added to or
+        removed from it (see L{_IQDispatchIndex.isCurrent}). If
+        C{iqHandlers} was overridden on the instance, it is cached on the
+        instance instead.
+        """
+        iqHandlers = self.iqHandlers
+        if 'iqHandlers' in self.__dict__:
+            holder = self
+            cached = self.__dict__.get('_iqDispatchIndex')
+        else:
+            holder = self.__class__
+            cached = holder.__dict__.get('_iqDispatchIndex')
+
+        if cached is None or not cached.isCurrent(iqHandlers):
+            cached = _IQDispatchIndex(iqHandlers)
+            setattr(holder, '_iqDispatchIndex', cached)
+
+        return cached
+
+
     def handleRequest(self, iq):
         """
         Find a handler and wrap the call for sending a response stanza.
@@ -454,13 +1872,15 @@ class IQHandlerMixin(object):
             log.err(failure)
             return error.StanzaError('internal-server-error').toResponse(iq)
 
-        handler = None
-        for queryString, method in self.iqHandlers.iteritems():
-            if xpath.internQuery(queryString).matches(iq):
-                handler = getattr(self, method)
+        method = self._getIQDispatchIndex().lookup(iq)
 
-        if handler:
-            d = defer.maybeDeferred(handler, iq)
+        if method is not None:
+            statistics = getattr(getattr(self, 'parent', None),
+                                 'statistics', None)
+            if statistics is None:
+                d = defer.maybeDeferred(getattr(self, method), iq)
+            else:
+                d = defer.maybeDeferred(statistics.call, self, method, iq)
         else:
             d = defer.fail(NotImplementedError())
 
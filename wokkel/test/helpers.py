@@ -5,6 +5,9 @@
 Unit test helpers.
 """
 
+import pickle
+import weakref
+
 from twisted.internet import defer
 from twisted.words.xish import xpath
 from twisted.words.xish.utility import EventDispatcher
@@ -95,6 +98,38 @@ class TestableRequestHandlerMixin(object):
         return d
 
 
+class SlotsTestMixin(object):
+    """
+    Mixin with tests for data objects that store their attributes in slots.
+
+    Test cases using this mixin define C{makeObject} to return an instance
+    of the class under test.
+    """
+
+    def test_slots(self):
+        """
+        Attributes are stored in slots, additional ones are still allowed.
+        """
+        obj = self.makeObject()
+        self.assertEqual({}, vars(obj))
+        obj.extra = True
+        self.assertEqual({'extra': True}, vars(obj))
+        self.assertIdentical(obj, weakref.ref(obj)())
+
+
+    def test_pickle(self):
+        """
+        Objects can be pickled with all protocols, including extra attributes.
+        """
+        obj = self.makeObject()
+        obj.extra = True
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(obj, protocol))
+            self.assertIdentical(obj.__class__, copy.__class__)
+            self.assertEqual(obj.__getstate__(), copy.__getstate__())
+            self.assertTrue(copy.extra)
+
+
 class TestableStreamManager(StreamManager):
     """
     Stream manager for testing subprotocol handlers.
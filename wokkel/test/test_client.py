@@ -6,8 +6,11 @@ Tests for L{wokkel.client}.
 """
 
 from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
 from twisted.trial import unittest
-from twisted.words.protocols.jabber import xmlstream
+from twisted.words.protocols.jabber import client as jabberclient
+from twisted.words.protocols.jabber import sasl, xmlstream
 from twisted.words.protocols.jabber.client import XMPPAuthenticator
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.protocols.jabber.xmlstream import STREAM_AUTHD_EVENT
@@ -15,6 +18,8 @@ from twisted.words.protocols.jabber.xmlstream import INIT_FAILED_EVENT
 from twisted.words.protocols.jabber.xmlstream import XMPPHandler
 
 from wokkel import client
+from wokkel.generic import parseXml
+from wokkel.subprotocols import NS_SM
 
 class XMPPClientTest(unittest.TestCase):
     """
@@ -50,6 +55,182 @@ class XMPPClientTest(unittest.TestCase):
         self.assertEqual(b'example.org', self.client.domain)
 
 
+    def test_stopServiceFailsHeldRequests(self):
+        """
+        Stopping the service fails requests held for stream resumption.
+        """
+        d = defer.Deferred()
+        self.client._iqDeferreds['test'] = d
+        self.client._smID = u'sm1'
+        self.client._smHeld = (['test'], failure.Failure(ConnectionDone()))
+        self.client._connection = DummyConnector()
+
+        self.client.stopService()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertIdentical(None, self.client._smID)
+        self.assertTrue(self.client._connection.disconnected)
+
+
+    def test_streamManager(self):
+        """
+        The client resumes streams for itself.
+        """
+        self.assertIdentical(self.client,
+                             self.client.factory.authenticator.streamManager)
+
+
+
+class DummyConnector(object):
+    """
+    Connector stub that records disconnects.
+    """
+
+    disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+
+class DummyResumingStreamManager(object):
+    """
+    Stream manager stub that records resumption events.
+    """
+
+    def __init__(self, info=None):
+        self.info = info
+        self.resumed = None
+        self.failed = False
+
+
+    def resumptionInfo(self):
+        return self.info
+
+
+    def streamResumed(self, h):
+        self.resumed = h
+
+
+    def resumptionFailed(self):
+        self.failed = True
+
+
+
+class StreamResumptionInitializerTest(unittest.TestCase):
+    """
+    Tests for L{client.StreamResumptionInitializer}.
+    """
+
+    def setUp(self):
+        self.output = []
+        self.xmlstream = xmlstream.XmlStream(xmlstream.Authenticator())
+        self.xmlstream.send = self.output.append
+        self.xmlstream.features = {(NS_SM, 'sm'): None}
+        self.streamManager = DummyResumingStreamManager((u'sm1', 5))
+        self.init = client.StreamResumptionInitializer(self.xmlstream,
+                                                       self.streamManager)
+        self.bind = jabberclient.BindInitializer(self.xmlstream)
+        self.session = jabberclient.SessionInitializer(self.xmlstream)
+        self.xmlstream.initializers = [self.init, self.bind, self.session]
+
+
+    def test_resume(self):
+        """
+        A resume request is sent for the previous stream.
+        """
+        self.init.initialize()
+        element = self.output[-1]
+        self.assertEqual((NS_SM, 'resume'), (element.uri, element.name))
+        self.assertEqual(u'sm1', element['previd'])
+        self.assertEqual('5', element['h'])
+
+
+    def test_resumed(self):
+        """
+        If resumed, binding and session establishment are skipped.
+        """
+        d = self.init.initialize()
+        self.xmlstream.dispatch(parseXml("<resumed xmlns='urn:xmpp:sm:3' "
+                                         "previd='sm1' h='3'/>"))
+        self.assertEqual(3, self.streamManager.resumed)
+        self.assertEqual([self.init], self.xmlstream.initializers)
+        return d
+
+
+    def test_failed(self):
+        """
+        If resumption fails, binding proceeds as usual.
+        """
+        d = self.init.initialize()
+        self.xmlstream.dispatch(parseXml("<failed xmlns='urn:xmpp:sm:3'/>"))
+        self.assertTrue(self.streamManager.failed)
+        self.assertIdentical(None, self.streamManager.resumed)
+        self.assertEqual([self.init, self.bind, self.session],
+                         self.xmlstream.initializers)
+        return d
+
+
+    def test_nothingToResume(self):
+        """
+        Without a previous resumable stream, nothing is sent.
+        """
+        self.streamManager.info = None
+        self.init.initialize()
+        self.assertEqual([], self.output)
+
+
+    def test_notOffered(self):
+        """
+        If the server doesn't offer Stream Management, nothing is sent.
+        """
+        self.xmlstream.features = {}
+        self.init.initialize()
+        self.assertEqual([], self.output)
+
+
+
+class CheckAuthInitializerTest(unittest.TestCase):
+    """
+    Tests for L{client.CheckAuthInitializer}.
+    """
+
+    def setUp(self):
+        self.authenticator = client.HybridAuthenticator(
+                JID('user@example.org'), 'secret')
+        self.xmlstream = xmlstream.XmlStream(self.authenticator)
+        self.xmlstream.features = {(sasl.NS_XMPP_SASL, 'mechanisms'): None}
+        self.xmlstream.initializers = []
+        self.init = client.CheckAuthInitializer(self.xmlstream)
+
+
+    def test_initializeSASL(self):
+        """
+        SASL authentication is followed by binding and session setup.
+        """
+        self.init.initialize()
+        self.assertEqual([sasl.SASLInitiatingInitializer,
+                          jabberclient.BindInitializer,
+                          jabberclient.SessionInitializer],
+                         [init.__class__
+                          for init in self.xmlstream.initializers])
+
+
+    def test_initializeSASLResumption(self):
+        """
+        With a stream manager, resumption is tried before binding.
+        """
+        self.authenticator.streamManager = DummyResumingStreamManager()
+        self.init.initialize()
+        self.assertEqual([sasl.SASLInitiatingInitializer,
+                          client.StreamResumptionInitializer,
+                          jabberclient.BindInitializer,
+                          jabberclient.SessionInitializer],
+                         [init.__class__
+                          for init in self.xmlstream.initializers])
+        self.assertIdentical(self.authenticator.streamManager,
+                             self.xmlstream.initializers[1].streamManager)
+
+
 
 class DeferredClientFactoryTest(unittest.TestCase):
     """
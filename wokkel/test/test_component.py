@@ -10,7 +10,7 @@ from zope.interface.verify import verifyObject
 from twisted.internet.base import BaseConnector
 from twisted.internet.error import ConnectionRefusedError
 from twisted.internet.task import Clock
-from twisted.python import failure
+from twisted.python import failure, log
 from twisted.trial import unittest
 from twisted.words.protocols.jabber import xmlstream
 from twisted.words.protocols.jabber.ijabber import IXMPPHandlerCollection
@@ -19,7 +19,7 @@ from twisted.words.protocols.jabber.xmlstream import XMPPHandler
 from twisted.words.xish import domish
 
 from wokkel import component
-from wokkel.generic import XmlPipe
+from wokkel.generic import SerializedStanza, XmlPipe
 
 class FakeConnector(BaseConnector):
     """
@@ -140,6 +140,15 @@ class InternalComponentTest(unittest.TestCase):
         self.assertIn('component', self.router.routes)
 
 
+    def test_startServiceQueuedPipe(self):
+        """
+        If enabled, the component connects to the router in queued mode.
+        """
+        self.component.queuedPipe = True
+        self.component.startService()
+        self.assertTrue(self.component._pipe.queued)
+
+
     def test_startServiceNoDomain(self):
         self.component = component.InternalComponent(self.router)
         self.component.startService()
@@ -264,6 +273,57 @@ class InternalComponentTest(unittest.TestCase):
         self.assertEquals([message], events)
 
 
+    def test_sendSerialized(self):
+        """
+        Serialized stanzas are parsed before they are sent to the router.
+        """
+        events = []
+        fn = lambda obj: events.append(obj)
+        message = SerializedStanza("<message to='user@example.org'/>",
+                                   'message')
+
+        self.router.route = fn
+        self.component.startService()
+        self.component.send(message)
+
+        self.assertEquals(1, len(events))
+        self.assertEquals('message', events[0].name)
+        self.assertEquals('user@example.org', events[0]['to'])
+
+
+    def test_sendSerializedIncomplete(self):
+        """
+        Serialized XML that is not a complete stanza is rejected.
+        """
+        events = []
+        fn = lambda obj: events.append(obj)
+
+        self.router.route = fn
+        self.component.startService()
+        self.assertRaises(ValueError, self.component.send,
+                          "<message to='user@example.org'")
+        self.assertRaises(ValueError, self.component.send, "")
+        self.assertRaises(ValueError, self.component.send,
+                          "<message></presence>")
+        self.assertEquals([], events)
+
+
+    def test_sendSerializedRouted(self):
+        """
+        Serialized stanzas sent from the component are routed.
+        """
+        events = []
+        fn = lambda obj: events.append(obj)
+        pipe = XmlPipe()
+        pipe.source.addObserver('/*', fn)
+        self.router.addRoute('example.org', pipe.sink)
+        self.component.startService()
+        self.component.send(u"<message to='user@example.org'/>")
+
+        self.assertEquals(1, len(events))
+        self.assertEquals('user@example.org', events[0]['to'])
+
+
 
 class RouterTest(unittest.TestCase):
     """
@@ -332,6 +392,796 @@ class RouterTest(unittest.TestCase):
 
 
 
+class FakeTransport(object):
+    """
+    Transport with a write buffer and producer support like FileDescriptor's.
+    """
+
+    producer = None
+    paused = False
+
+    def __init__(self, buffered=0):
+        self.dataBuffer = 'x' * buffered
+        self.offset = 0
+        self._tempDataLen = 0
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+
+class RouterMultiStreamTest(unittest.TestCase):
+    """
+    Tests for routes with several streams in L{component.Router}.
+    """
+
+    def setUp(self):
+        self.router = component.Router()
+        self.router.routeFactory = component.RoundRobinRoute
+        self.source = XmlPipe()
+        self.router.addRoute('component1.example.org', self.source.sink)
+        self.received = {}
+        self.pipes = []
+        for index in xrange(3):
+            pipe = XmlPipe()
+            pipe.sink.serial = index
+            self.pipes.append(pipe)
+            self.router.addRoute('component2.example.org', pipe.sink)
+            received = self.received[pipe.sink] = []
+            pipe.source.addObserver('/*', lambda element, received=received:
+                                              received.append(element))
+
+
+    def send(self, sender='user@example.org/Home',
+                   recipient='component2.example.org'):
+        stanza = domish.Element((None, 'message'))
+        stanza['from'] = sender
+        stanza['to'] = recipient
+        self.source.source.send(stanza)
+        return stanza
+
+
+    def counts(self):
+        return [len(self.received[pipe.sink]) for pipe in self.pipes]
+
+
+    def test_addRoute(self):
+        """
+        Streams for the same destination share a route.
+        """
+        route = self.router.routes['component2.example.org']
+        self.assertIsInstance(route, component.RoundRobinRoute)
+        self.assertEqual([pipe.sink for pipe in self.pipes], route.streams)
+
+
+    def test_addRouteExisting(self):
+        """
+        A single stream route becomes part of a multi-stream route.
+        """
+        router = component.Router()
+        pipe1 = XmlPipe()
+        pipe2 = XmlPipe()
+        router.addRoute('example.org', pipe1.sink)
+        router.routeFactory = component.RoundRobinRoute
+        router.addRoute('example.org', pipe2.sink)
+        self.assertEqual([pipe1.sink, pipe2.sink],
+                         router.routes['example.org'].streams)
+
+
+    def test_roundRobin(self):
+        """
+        Round robin routes select their streams in turn.
+        """
+        for _ in xrange(7):
+            self.send()
+        self.assertEqual([3, 2, 2], self.counts())
+
+
+    def test_removeRoute(self):
+        """
+        Traffic fails over to the remaining streams.
+        """
+        self.router.removeRoute('component2.example.org', self.pipes[1].sink)
+        for _ in xrange(4):
+            self.send()
+        self.assertEqual([2, 0, 2], self.counts())
+
+
+    def test_removeRouteLast(self):
+        """
+        Removing the last stream of a route removes the route.
+        """
+        for pipe in self.pipes:
+            self.router.removeRoute('component2.example.org', pipe.sink)
+        self.assertNotIn('component2.example.org', self.router.routes)
+
+
+    def test_leastOutstandingBytes(self):
+        """
+        The stream with the least unsent data is selected.
+        """
+        route = component.LeastOutstandingBytesRoute()
+        for buffered, pipe in zip((10, 5, 5), self.pipes):
+            pipe.sink.transport = FakeTransport(buffered)
+            route.addStream(pipe.sink)
+        self.router.routes['component2.example.org'] = route
+
+        self.send()
+        self.assertEqual([0, 1, 0], self.counts())
+
+        self.pipes[2].sink.transport.dataBuffer = ''
+        self.send()
+        self.assertEqual([0, 1, 1], self.counts())
+
+
+    def test_outstandingBytes(self):
+        """
+        Outstanding bytes are taken from the transport's write buffer.
+        """
+        xs = XmlPipe().sink
+        self.assertEqual(0, component.outstandingBytes(xs))
+        xs.transport = FakeTransport(10)
+        xs.transport.offset = 4
+        xs.transport._tempDataLen = 3
+        self.assertEqual(9, component.outstandingBytes(xs))
+
+
+    def test_outstandingBytesPartialBuffer(self):
+        """
+        Parts of the write buffer a transport doesn't have count as 0 bytes.
+        """
+        xs = XmlPipe().sink
+        xs.transport = FakeTransport(10)
+        del xs.transport.offset
+        del xs.transport._tempDataLen
+        self.assertEqual(10, component.outstandingBytes(xs))
+
+
+    def test_outstandingBytesWrapped(self):
+        """
+        A transport wrapping another transport is followed, as for TLS.
+        """
+        class WrappingTransport(object):
+            def __init__(self, transport):
+                self.transport = transport
+
+        xs = XmlPipe().sink
+        xs.transport = WrappingTransport(FakeTransport(10))
+        self.assertEqual(10, component.outstandingBytes(xs))
+
+        xs.transport = WrappingTransport(None)
+        self.assertEqual(0, component.outstandingBytes(xs))
+
+
+    def test_consistentHashSender(self):
+        """
+        All stanzas from the same bare JID are sent over the same stream.
+        """
+        route = component.ConsistentHashRoute('sender')
+        for pipe in self.pipes:
+            route.addStream(pipe.sink)
+        self.router.routes['component2.example.org'] = route
+
+        for resource in ('Home', 'Work', 'Mobile'):
+            self.send(sender='user@example.org/' + resource)
+        self.assertEqual([0, 0, 3], sorted(self.counts()))
+
+
+    def test_consistentHashNormalized(self):
+        """
+        Different forms of the same bare JID are sent over the same stream.
+        """
+        route = component.ConsistentHashRoute('sender')
+        for pipe in self.pipes:
+            route.addStream(pipe.sink)
+        self.router.routes['component2.example.org'] = route
+
+        for sender in ('user@example.org/Home', 'User@Example.org/Work',
+                       'USER@EXAMPLE.ORG'):
+            self.send(sender=sender)
+        self.assertEqual([0, 0, 3], sorted(self.counts()))
+
+
+    def test_consistentHashRecipient(self):
+        """
+        Stanzas can be distributed by recipient bare JID.
+        """
+        route = component.ConsistentHashRoute('recipient')
+        for pipe in self.pipes:
+            route.addStream(pipe.sink)
+
+        stanzas = []
+        for index in xrange(100):
+            stanza = domish.Element((None, 'message'))
+            stanza['to'] = 'user%d@component2.example.org/Home' % index
+            stanzas.append(stanza)
+
+        selected = [route.select(element) for element in stanzas]
+        for pipe in self.pipes:
+            self.assertIn(pipe.sink, selected)
+
+
+    def test_consistentHashRemove(self):
+        """
+        Removing a stream only moves the bare JIDs that mapped to it.
+        """
+        route = component.ConsistentHashRoute('sender')
+        for pipe in self.pipes:
+            route.addStream(pipe.sink)
+
+        stanzas = []
+        for index in xrange(100):
+            stanza = domish.Element((None, 'message'))
+            stanza['from'] = 'user%d@example.org/Home' % index
+            stanzas.append(stanza)
+
+        before = [route.select(element) for element in stanzas]
+        removed = self.pipes[0].sink
+        route.removeStream(removed)
+        after = [route.select(element) for element in stanzas]
+
+        for old, new in zip(before, after):
+            self.assertNotIdentical(removed, new)
+            if old is not removed:
+                self.assertIdentical(old, new)
+
+
+    def test_consistentHashUnknownKey(self):
+        """
+        Only the sender and recipient can be used as keys.
+        """
+        self.assertRaises(ValueError, component.ConsistentHashRoute, 'type')
+
+
+    def test_stats(self):
+        """
+        Routing statistics are kept per destination.
+        """
+        for _ in xrange(3):
+            self.send()
+        stats = self.router.stats()['routes']['component2.example.org']
+        self.assertEqual(3, stats['stanzas'])
+
+
+
+class SuffixTrieTest(unittest.TestCase):
+    """
+    Tests for L{component.SuffixTrie}.
+    """
+
+    def setUp(self):
+        self.trie = component.SuffixTrie()
+
+
+    def test_lookup(self):
+        """
+        A suffix matches subdomains at any depth.
+        """
+        self.trie.add('tenant.example.com', 'tenant')
+        self.assertEqual('tenant', self.trie.lookup('muc.tenant.example.com'))
+        self.assertEqual('tenant',
+                         self.trie.lookup('a.b.tenant.example.com'))
+
+
+    def test_lookupExact(self):
+        """
+        A suffix does not match the domain itself.
+        """
+        self.trie.add('tenant.example.com', 'tenant')
+        self.assertIdentical(None, self.trie.lookup('tenant.example.com'))
+
+
+    def test_lookupNoMatch(self):
+        """
+        Domains without matching suffixes have no value.
+        """
+        self.trie.add('tenant.example.com', 'tenant')
+        self.assertIdentical(None, self.trie.lookup('muc.example.com'))
+        self.assertIdentical(None, self.trie.lookup('example.com'))
+        self.assertIdentical(None,
+                             self.trie.lookup('muc.othertenant.example.com'))
+
+
+    def test_lookupLongest(self):
+        """
+        The longest matching suffix wins.
+        """
+        self.trie.add('example.com', 'example')
+        self.trie.add('tenant.example.com', 'tenant')
+        self.assertEqual('tenant', self.trie.lookup('muc.tenant.example.com'))
+        self.assertEqual('example', self.trie.lookup('tenant.example.com'))
+        self.assertEqual('example', self.trie.lookup('muc.other.example.com'))
+
+
+    def test_remove(self):
+        """
+        Removed suffixes no longer match, others are kept.
+        """
+        self.trie.add('example.com', 'example')
+        self.trie.add('tenant.example.com', 'tenant')
+        self.trie.remove('tenant.example.com')
+        self.assertEqual('example', self.trie.lookup('muc.tenant.example.com'))
+        self.assertEqual(1, len(self.trie))
+
+
+    def test_removePrunes(self):
+        """
+        Removing a suffix removes nodes that are no longer needed.
+        """
+        self.trie.add('muc.tenant.example.com', 'muc')
+        self.trie.add('example.org', 'org')
+        self.trie.remove('muc.tenant.example.com')
+        self.assertEqual(['org'], self.trie._root[0].keys())
+        self.assertEqual(1, len(self.trie))
+
+
+    def test_removeUnknown(self):
+        """
+        Removing an unknown suffix raises KeyError.
+        """
+        self.trie.add('tenant.example.com', 'tenant')
+        self.assertRaises(KeyError, self.trie.remove, 'example.com')
+        self.assertRaises(KeyError, self.trie.remove, 'other.example.com')
+        self.assertEqual(1, len(self.trie))
+
+
+
+class RouterWildcardTest(unittest.TestCase):
+    """
+    Tests for wildcard routes in L{component.Router}.
+    """
+
+    def setUp(self):
+        self.router = component.Router()
+        self.source = XmlPipe()
+        self.tenant = XmlPipe()
+        self.default = XmlPipe()
+        self.router.addRoute('component1.example.org', self.source.sink)
+        self.router.addRoute('*.tenant.example.com', self.tenant.sink)
+        self.router.addRoute(None, self.default.sink)
+
+        self.received = []
+        self.tenant.source.addObserver('/*', lambda element:
+                                                 self.received.append(element))
+
+
+    def send(self, to):
+        stanza = domish.Element((None, 'message'))
+        stanza['from'] = 'component1.example.org'
+        stanza['to'] = to
+        self.source.source.send(stanza)
+        return stanza
+
+
+    def test_route(self):
+        """
+        Stanzas for subdomains are routed to the wildcard route.
+        """
+        stanza = self.send('room@muc.tenant.example.com/nick')
+        self.assertEqual([stanza], self.received)
+        stats = self.router.stats()
+        self.assertEqual(0, stats['defaultRouted'])
+        self.assertEqual(1,
+                         stats['routes']['*.tenant.example.com']['stanzas'])
+
+
+    def test_routeExactFirst(self):
+        """
+        Routes for the exact host take precedence over wildcard routes.
+        """
+        muc = XmlPipe()
+        self.router.addRoute('muc.tenant.example.com', muc.sink)
+        self.send('room@muc.tenant.example.com')
+        self.assertEqual([], self.received)
+
+
+    def test_routeDefault(self):
+        """
+        Stanzas for the domain of a wildcard route go to the default route.
+        """
+        self.send('tenant.example.com')
+        self.assertEqual([], self.received)
+        self.assertEqual(1, self.router.stats()['defaultRouted'])
+
+
+    def test_removeRoute(self):
+        """
+        Removed wildcard routes no longer match.
+        """
+        self.router.removeRoute('*.tenant.example.com', self.tenant.sink)
+        self.send('room@muc.tenant.example.com')
+        self.assertEqual([], self.received)
+        self.assertEqual(0, len(self.router._wildcards))
+
+
+
+class RouterFlowControlTest(unittest.TestCase):
+    """
+    Tests for flow control in L{component.Router}.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.router = component.Router(reactor=self.clock)
+        self.router.highWater = 100
+        self.router.lowWater = 20
+
+        self.slow = XmlPipe()
+        self.slow.sink.transport = FakeTransport()
+        self.sender = XmlPipe()
+        self.sender.sink.transport = FakeTransport()
+        self.other = XmlPipe()
+        self.other.sink.transport = FakeTransport()
+        self.router.addRoute('slow.example.org', self.slow.sink)
+        self.router.addRoute('sender.example.org', self.sender.sink)
+        self.router.addRoute('other.example.org', self.other.sink)
+
+
+    def send(self, pipe, sender, recipient):
+        stanza = domish.Element((None, 'message'))
+        stanza['from'] = sender
+        stanza['to'] = recipient
+        pipe.source.send(stanza)
+
+
+    def test_addRouteRegistersProducer(self):
+        """
+        A producer is registered with the transport of added streams.
+        """
+        transport = self.slow.sink.transport
+        self.assertIsInstance(transport.producer, component.RouteProducer)
+        self.assertTrue(transport.streaming)
+        self.assertEqual(100, transport.bufferSize)
+
+
+    def test_removeRouteUnregistersProducer(self):
+        """
+        Removing a route unregisters the producer.
+        """
+        self.router.removeRoute('slow.example.org', self.slow.sink)
+        self.assertIdentical(None, self.slow.sink.transport.producer)
+
+
+    def test_queueDepth(self):
+        """
+        The queue depth of a route is the amount of unsent data.
+        """
+        self.slow.sink.transport.dataBuffer = 'x' * 50
+        self.assertEqual(50, self.router.queueDepth('slow.example.org'))
+        self.assertEqual(0, self.router.queueDepth('other.example.org'))
+
+
+    def test_congestedPausesSender(self):
+        """
+        Sending to a congested route pauses reading from the sender.
+        """
+        self.slow.sink.transport.producer.pauseProducing()
+        self.assertTrue(self.router.isCongested('slow.example.org'))
+
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+        self.assertTrue(self.sender.sink.transport.paused)
+        self.assertFalse(self.other.sink.transport.paused)
+
+
+    def test_notCongested(self):
+        """
+        Senders are not paused for routes that are not congested.
+        """
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+        self.assertFalse(self.router.isCongested('slow.example.org'))
+        self.assertFalse(self.sender.sink.transport.paused)
+
+
+    def test_congestedHighWater(self):
+        """
+        A route is congested when its queue exceeds the high water mark.
+        """
+        self.slow.sink.transport.dataBuffer = 'x' * 101
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+        self.assertTrue(self.router.isCongested('slow.example.org'))
+        self.assertFalse(self.sender.sink.transport.paused)
+
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+        self.assertTrue(self.sender.sink.transport.paused)
+
+
+    def test_drainedResumesSender(self):
+        """
+        When the transport resumes the producer, senders are resumed.
+        """
+        producer = self.slow.sink.transport.producer
+        producer.pauseProducing()
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+        producer.resumeProducing()
+        self.assertFalse(self.router.isCongested('slow.example.org'))
+        self.assertFalse(self.sender.sink.transport.paused)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_drainedLowWater(self):
+        """
+        A congested route drains when its queue is at the low water mark.
+        """
+        transport = self.slow.sink.transport
+        transport.dataBuffer = 'x' * 150
+        transport.producer.pauseProducing()
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+
+        transport.dataBuffer = 'x' * 21
+        self.clock.advance(self.router.drainInterval)
+        self.assertTrue(self.sender.sink.transport.paused)
+
+        transport.dataBuffer = 'x' * 20
+        self.clock.advance(self.router.drainInterval)
+        self.assertFalse(self.router.isCongested('slow.example.org'))
+        self.assertFalse(self.sender.sink.transport.paused)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_pausedForSeveralRoutes(self):
+        """
+        A sender paused for several routes resumes when all have drained.
+        """
+        self.slow.sink.transport.producer.pauseProducing()
+        self.other.sink.transport.producer.pauseProducing()
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+        self.send(self.sender, 'sender.example.org', 'other.example.org')
+
+        self.slow.sink.transport.producer.resumeProducing()
+        self.assertTrue(self.sender.sink.transport.paused)
+        self.other.sink.transport.producer.resumeProducing()
+        self.assertFalse(self.sender.sink.transport.paused)
+
+
+    def test_removeRouteCongested(self):
+        """
+        Removing a congested route resumes its senders.
+        """
+        self.slow.sink.transport.producer.pauseProducing()
+        self.send(self.sender, 'sender.example.org', 'slow.example.org')
+        self.router.removeRoute('slow.example.org', self.slow.sink)
+        self.assertFalse(self.sender.sink.transport.paused)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+
+class RouterStatsTest(unittest.TestCase):
+    """
+    Tests for the routing statistics and logging of L{component.Router}.
+    """
+
+    def setUp(self):
+        self.randomValues = []
+        self.router = component.Router(random=self.randomValues.pop)
+        self.component1 = XmlPipe()
+        self.component2 = XmlPipe()
+        self.router.addRoute('component1.example.org', self.component1.sink)
+        self.router.addRoute('component2.example.org', self.component2.sink)
+
+        self.logged = []
+        log.addObserver(self.logged.append)
+        self.addCleanup(log.removeObserver, self.logged.append)
+
+
+    def send(self, to, stanzaType=None):
+        stanza = domish.Element((None, 'message'))
+        stanza['from'] = 'component1.example.org'
+        stanza['to'] = to
+        if stanzaType:
+            stanza['type'] = stanzaType
+        self.component1.source.send(stanza)
+        return stanza
+
+
+    def test_stats(self):
+        """
+        Routed stanzas are counted per route.
+        """
+        self.send('user@component2.example.org')
+        self.send('component2.example.org')
+        self.send('component1.example.org')
+
+        self.assertEqual({'routes': {
+                              'component1.example.org': {'stanzas': 1,
+                                                         'bytes': 0},
+                              'component2.example.org': {'stanzas': 2,
+                                                         'bytes': 0}},
+                          'noRoute': 0,
+                          'defaultRouted': 0},
+                         self.router.stats())
+
+
+    def test_statsBytes(self):
+        """
+        If enabled, the number of routed bytes is counted.
+        """
+        self.router.measureBytes = True
+        stanza = self.send('component2.example.org')
+        stats = self.router.stats()['routes']['component2.example.org']
+        self.assertEqual(len(stanza.toXml()), stats['bytes'])
+
+
+    def test_statsDefaultRoute(self):
+        """
+        Stanzas routed to the default route are counted.
+        """
+        s2s = XmlPipe()
+        self.router.addRoute(None, s2s.sink)
+        self.send('example.com')
+
+        stats = self.router.stats()
+        self.assertEqual(1, stats['defaultRouted'])
+        self.assertEqual(1, stats['routes'][None]['stanzas'])
+
+
+    def test_statsNoRoute(self):
+        """
+        Stanzas without a route are counted, as is the error sent back.
+        """
+        self.send('example.com')
+
+        stats = self.router.stats()
+        self.assertEqual(1, stats['noRoute'])
+        self.assertEqual(1,
+                         stats['routes']['component1.example.org']['stanzas'])
+
+
+    def test_resetStats(self):
+        """
+        Statistics can be reset.
+        """
+        self.send('component2.example.org')
+        self.send('example.com', 'error')
+        self.router.resetStats()
+        self.assertEqual({'routes': {}, 'noRoute': 0, 'defaultRouted': 0},
+                         self.router.stats())
+
+
+    def test_routeNoLog(self):
+        """
+        By default, routed stanzas are not logged.
+        """
+        self.send('component2.example.org')
+        self.assertEqual([], self.logged)
+
+
+    def test_routeLogSampled(self):
+        """
+        If enabled, a sample of routed stanzas is logged.
+        """
+        self.router.logSampleRate = 0.5
+        self.randomValues.extend([0.7, 0.2])
+        stanza = self.send('component2.example.org')
+        self.send('component2.example.org')
+
+        self.assertEqual(1, len(self.logged))
+        self.assertEqual(("Routing to component2.example.org: %r" %
+                          (stanza.toXml(),),),
+                         self.logged[0]['message'])
+
+
+    def test_routeNoRouteLogged(self):
+        """
+        Stanzas without a route are logged without their contents.
+        """
+        self.send('example.com', 'error')
+        self.assertEqual(1, len(self.logged))
+        self.assertEqual(("No route to example.com",),
+                         self.logged[0]['message'])
+
+
+
+class RouterHostTest(unittest.TestCase):
+    """
+    Tests for host name extraction in L{component.Router}.
+    """
+
+    def setUp(self):
+        self.router = component.Router()
+
+
+    def test_getHost(self):
+        """
+        The host is the part between the user and resource.
+        """
+        getHost = self.router._getHost
+        self.assertEqual(u'example.org', getHost(u'example.org'))
+        self.assertEqual(u'example.org', getHost(u'user@example.org'))
+        self.assertEqual(u'example.org', getHost(u'user@example.org/Home'))
+        self.assertEqual(u'example.org', getHost(u'example.org/a@b/c'))
+
+
+    def test_getHostLowercase(self):
+        """
+        ASCII host names are lowercased.
+        """
+        self.assertEqual(u'example.org',
+                         self.router._getHost(u'User@Example.ORG/Home'))
+
+
+    def test_getHostNonASCII(self):
+        """
+        Non-ASCII host names need full parsing.
+        """
+        self.assertIdentical(None,
+                             self.router._getHost(u'user@\u00e9xample.org'))
+
+
+    def test_getHostCache(self):
+        """
+        Host names are cached, up to the maximum size of the cache.
+        """
+        self.router.hostCacheSize = 2
+        self.router._getHost(u'user1@example.org')
+        self.router._getHost(u'user2@example.org')
+        self.assertEqual(2, len(self.router._hostCache))
+        self.router._getHost(u'user3@example.org')
+        self.assertEqual({u'user3@example.org': u'example.org'},
+                         self.router._hostCache)
+
+
+    def test_routeNoJIDParsing(self):
+        """
+        Stanzas with a route for their host are routed without JID parsing.
+        """
+        pipe = XmlPipe()
+        self.router.addRoute('example.org', pipe.sink)
+        routed = []
+        pipe.source.addObserver('/*', lambda element: routed.append(element))
+        self.patch(component, 'internJID', None)
+
+        stanza = domish.Element((None, 'message'))
+        stanza['to'] = u'User@Example.org/Home'
+        self.router.route(stanza)
+        self.assertEqual([stanza], routed)
+
+
+    def test_routeNormalized(self):
+        """
+        If there is no route for the host as is, the normalized host is used.
+        """
+        pipe = XmlPipe()
+        self.router.addRoute(u'\u00e9xample.org', pipe.sink)
+        routed = []
+        pipe.source.addObserver('/*', lambda element: routed.append(element))
+
+        stanza = domish.Element((None, 'message'))
+        stanza['to'] = u'user@\u00c9xample.org'
+        self.router.route(stanza)
+        self.assertEqual([stanza], routed)
+
+
+    def test_routeMalformed(self):
+        """
+        Stanzas with a malformed destination without route are dropped.
+        """
+        s2s = XmlPipe()
+        self.router.addRoute(None, s2s.sink)
+        routed = []
+        s2s.source.addObserver('/*', lambda element: routed.append(element))
+
+        stanza = domish.Element((None, 'message'))
+        stanza['to'] = u'user@example.org@example.com'
+        self.router.route(stanza)
+        self.assertEqual([], routed)
+        self.assertEqual(1, self.router.stats()['noRoute'])
+
+
+
 class ListenComponentAuthenticatorTest(unittest.TestCase):
     """
     Tests for L{component.ListenComponentAuthenticator}.
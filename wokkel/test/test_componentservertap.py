@@ -0,0 +1,214 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.componentservertap}.
+"""
+
+import socket
+
+from twisted.python import usage
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from wokkel import component, componentservertap, server, shard, traffic
+
+class OptionsTest(unittest.TestCase):
+    """
+    Tests for L{componentservertap.Options}.
+    """
+
+    def setUp(self):
+        self.options = componentservertap.Options()
+
+
+    def test_workers(self):
+        """
+        The number of workers is parsed as an integer.
+        """
+        self.options.parseOptions(['--domain=example.org', '--workers=4'])
+        self.assertEqual(4, self.options['workers'])
+
+
+    def test_workersDefault(self):
+        """
+        By default, a single process is used.
+        """
+        self.options.parseOptions(['--domain=example.org'])
+        self.assertEqual(1, self.options['workers'])
+
+
+    def test_noWorkers(self):
+        """
+        At least one worker is needed.
+        """
+        self.assertRaises(usage.UsageError, self.options.parseOptions,
+                          ['--domain=example.org', '--workers=0'])
+
+
+    def test_workersTrafficLog(self):
+        """
+        Traffic logs cannot be written by more than one worker.
+        """
+        self.assertRaises(usage.UsageError, self.options.parseOptions,
+                          ['--domain=example.org', '--workers=2',
+                           '--traffic-log=traffic.log'])
+
+
+
+
+class MakeServiceTest(unittest.TestCase):
+    """
+    Tests for L{componentservertap.makeService}.
+    """
+
+    def makeService(self, *args):
+        config = componentservertap.Options()
+        config.parseOptions(['--domain=example.org'] + list(args))
+        return componentservertap.makeService(config)
+
+
+    def getFactory(self, s, factoryClass):
+        """
+        Find the factory of the given class among the services of C{s}.
+        """
+        for child in s:
+            factory = getattr(child, 'factory', None)
+            if isinstance(factory, factoryClass):
+                return factory
+        self.fail("No %r found" % (factoryClass,))
+
+
+    def test_router(self):
+        """
+        Components are routed by the router from L{wokkel.component}.
+        """
+        s = self.makeService()
+        factory = self.getFactory(s, component.XMPPComponentServerFactory)
+        self.assertIsInstance(factory.router, component.Router)
+
+
+    def test_trafficLogComponent(self):
+        """
+        With a traffic log, traffic of component streams is captured.
+        """
+        s = self.makeService('--traffic-log=%s' % (self.mktemp(),))
+        factory = self.getFactory(s, component.XMPPComponentServerFactory)
+        self.assertIsInstance(factory.trafficTap, traffic.TrafficTap)
+
+        xs = factory.buildProtocol(None)
+        xs.makeConnection(StringTransport())
+        xs.dataReceived("<stream:stream xmlns='jabber:component:accept' "
+                        "xmlns:stream='http://etherx.jabber.org/streams' "
+                        "to='component.example.org'>")
+
+        directions = [entry[2] for entry in factory.trafficTap.dump()]
+        self.assertIn(traffic.RECV, directions)
+        self.assertIn(traffic.SEND, directions)
+
+
+    def test_master(self):
+        """
+        With more than one worker, the service starts the workers.
+        """
+        s = self.makeService('--workers=2')
+        self.assertIsInstance(s, shard.ShardMaster)
+        self.assertEqual(2, s.workerCount)
+        self.assertEqual(set(['component-fd', 'server-fd']), set(s.ports))
+        self.assertIn('--domain=example.org', s.arguments)
+        self.assertIn('--server-port=tcp:5269', s.arguments)
+
+
+    def test_worker(self):
+        """
+        With a worker identifier, the service of a worker is made.
+        """
+        s = self.makeService('--workers=2', '--worker-id=1',
+                             '--shard-dir=shards', '--component-fd=3',
+                             '--server-fd=4')
+        shardServices = [child for child in s
+                         if isinstance(child, shard.ShardService)]
+        self.assertEqual(1, len(shardServices))
+        shardService = shardServices[0]
+        self.assertEqual(1, shardService.workerID)
+        self.assertEqual(2, shardService.workerCount)
+        self.assertEqual('shards', shardService.directory)
+        self.assertIsInstance(shardService.router, shard.ShardedRouter)
+
+        cFactory = self.getFactory(s, component.XMPPComponentServerFactory)
+        s2sFactory = self.getFactory(s, server.XMPPS2SServerFactory)
+        filenos = dict((child.factory, child.fileno) for child in s
+                       if isinstance(child, shard.InheritedPortService))
+        self.assertEqual({cFactory: 3, s2sFactory: 4}, filenos)
+        self.assertIdentical(shardService.router, cFactory.router)
+
+
+    def test_workerIPv6(self):
+        """
+        Sockets on IPv6 interfaces are adopted as IPv6 sockets.
+        """
+        s = self.makeService('--workers=2', '--worker-id=1',
+                             '--shard-dir=shards', '--component-fd=3',
+                             '--server-fd=4',
+                             '--component-port=tcp:5347:interface=\\:\\:1')
+        families = dict((child.fileno, child.family) for child in s
+                        if isinstance(child, shard.InheritedPortService))
+        self.assertEqual({3: socket.AF_INET6, 4: socket.AF_INET}, families)
+
+
+
+class SecretsTest(unittest.TestCase):
+    """
+    Tests for passing secrets to worker processes.
+    """
+
+    def makeMaster(self, *args):
+        config = componentservertap.Options()
+        config.parseOptions(['--domain=example.org', '--workers=2'] +
+                            list(args))
+        return componentservertap.makeService(config)
+
+
+    def test_notInArguments(self):
+        """
+        Secrets are not passed on the command line of the workers.
+        """
+        master = self.makeMaster('--component-secret=component-pass',
+                                 '--server-secret=server-pass')
+        for argument in master.arguments:
+            self.assertNotIn('secret', argument)
+            self.assertNotIn('pass', argument)
+
+
+    def test_inEnvironment(self):
+        """
+        Secrets are passed in the environment of the workers.
+        """
+        master = self.makeMaster('--component-secret=component-pass',
+                                 '--server-secret=server-pass')
+        self.assertEqual({'WOKKEL_COMPONENT_SECRET': 'component-pass',
+                          'WOKKEL_SERVER_SECRET': 'server-pass'},
+                         master.environment)
+
+
+    def test_serverSecretGenerated(self):
+        """
+        Without a server secret, one is generated for all workers.
+        """
+        master = self.makeMaster()
+        self.assertTrue(master.environment['WOKKEL_SERVER_SECRET'])
+
+
+    def test_readSecrets(self):
+        """
+        Workers take the secrets from the environment, removing them.
+        """
+        config = componentservertap.Options()
+        config.parseOptions(['--domain=example.org'])
+        environment = {'WOKKEL_COMPONENT_SECRET': 'component-pass',
+                       'WOKKEL_SERVER_SECRET': 'server-pass',
+                       'HOME': '/home/user'}
+        componentservertap._readSecrets(config, environment)
+        self.assertEqual('component-pass', config['component-secret'])
+        self.assertEqual('server-pass', config['server-secret'])
+        self.assertEqual({'HOME': '/home/user'}, environment)
@@ -13,14 +13,19 @@ from twisted.words.xish import domish
 from twisted.words.protocols.jabber import jid
 
 from wokkel import data_form
+from wokkel.test.helpers import SlotsTestMixin
 
 NS_X_DATA = 'jabber:x:data'
 
-class OptionTest(unittest.TestCase):
+class OptionTest(unittest.TestCase, SlotsTestMixin):
     """
     Tests for L{data_form.Option}.
     """
 
+    def makeObject(self):
+        return data_form.Option(u'a', u'A')
+
+
     def test_toElement(self):
         """
         An option is an option element with a value child with the option value.
@@ -92,11 +97,15 @@ class OptionTest(unittest.TestCase):
 
 
 
-class FieldTest(unittest.TestCase):
+class FieldTest(unittest.TestCase, SlotsTestMixin):
     """
     Tests for L{data_form.Field}.
     """
 
+    def makeObject(self):
+        return data_form.Field(var='test', value=u'a')
+
+
     def test_basic(self):
         """
         Test basic field initialization.
@@ -17,7 +17,8 @@ from twisted.words.xish import domish, utility
 from wokkel import data_form, disco
 from wokkel.generic import parseXml
 from wokkel.subprotocols import XMPPHandler
-from wokkel.test.helpers import TestableRequestHandlerMixin, XmlStreamStub
+from wokkel.test.helpers import SlotsTestMixin, TestableRequestHandlerMixin
+from wokkel.test.helpers import XmlStreamStub
 
 NS_DISCO_INFO = 'http://jabber.org/protocol/disco#info'
 NS_DISCO_ITEMS = 'http://jabber.org/protocol/disco#items'
@@ -61,11 +62,15 @@ class DiscoFeatureTest(unittest.TestCase):
 
 
 
-class DiscoIdentityTest(unittest.TestCase):
+class DiscoIdentityTest(unittest.TestCase, SlotsTestMixin):
     """
     Tests for L{disco.DiscoIdentity}.
     """
 
+    def makeObject(self):
+        return disco.DiscoIdentity(u'conference', u'text', u'Chatrooms')
+
+
     def test_init(self):
         """
         Test initialization with a category, type and name.
@@ -282,11 +287,15 @@ class DiscoInfoTest(unittest.TestCase):
 
 
 
-class DiscoItemTest(unittest.TestCase):
+class DiscoItemTest(unittest.TestCase, SlotsTestMixin):
     """
     Tests for L{disco.DiscoItem}.
     """
 
+    def makeObject(self):
+        return disco.DiscoItem(JID(u'example.org'), u'test', u'Test')
+
+
     def test_init(self):
         """
         Test initialization with a category, type and name.
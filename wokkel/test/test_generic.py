@@ -5,13 +5,16 @@
 Tests for L{wokkel.generic}.
 """
 
+import gc
 import re
 
+from twisted.internet import task
 from twisted.python import deprecate
 from twisted.python.versions import Version
 from twisted.trial import unittest
 from twisted.trial.util import suppress as SUPPRESS
 from twisted.words.xish import domish
+from twisted.words.protocols.jabber import error, jid
 from twisted.words.protocols.jabber.jid import JID
 
 from wokkel import generic
@@ -95,6 +98,545 @@ class XmlPipeTest(unittest.TestCase):
 
 
 
+class QueuedXmlPipeTest(unittest.TestCase):
+    """
+    Tests for L{wokkel.generic.XmlPipe} in queued mode.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pipe = generic.XmlPipe(queued=True, maxQueue=5, batchSize=3,
+                                    reactor=self.clock)
+
+
+    def test_sendFromSource(self):
+        """
+        Send an element from the source and observe it from the sink.
+        """
+        def cb(obj):
+            called.append(obj)
+
+        called = []
+        self.pipe.sink.addObserver('/test', cb)
+        element = domish.Element(('testns', 'test'))
+        self.pipe.source.send(element)
+        self.assertEquals([element], called)
+        self.assertEquals(1, self.pipe.delivered)
+        self.assertEquals(0, self.pipe.depth)
+
+
+    def test_sendFromSink(self):
+        """
+        Send an element from the sink and observe it from the source.
+        """
+        def cb(obj):
+            called.append(obj)
+
+        called = []
+        self.pipe.source.addObserver('/test', cb)
+        element = domish.Element(('testns', 'test'))
+        self.pipe.sink.send(element)
+        self.assertEquals([element], called)
+
+
+    def test_sendNotReentrant(self):
+        """
+        Elements sent by an observer are dispatched after it returns.
+        """
+        def onRequest(element):
+            self.pipe.sink.send(domish.Element((None, 'response')))
+            called.append('request done')
+
+        called = []
+        self.pipe.sink.addObserver('/request', onRequest)
+        self.pipe.source.addObserver('/response',
+                                     lambda _: called.append('response'))
+        self.pipe.source.send(domish.Element((None, 'request')))
+        self.assertEquals(['request done', 'response'], called)
+
+
+    def test_sendChain(self):
+        """
+        Long chains of responses do not exhaust the stack.
+        """
+        def onPing(element):
+            count = int(element['count'])
+            if count:
+                ping = domish.Element((None, 'ping'))
+                ping['count'] = str(count - 1)
+                self.pipe.sink.send(ping)
+
+        self.pipe.maxQueue = 10
+        self.pipe.batchSize = 10000
+        self.pipe.sink.addObserver('/ping', onPing)
+        self.pipe.source.addObserver('/ping', onPing)
+        ping = domish.Element((None, 'ping'))
+        ping['count'] = '5000'
+        self.pipe.source.send(ping)
+        self.assertEquals(5001, self.pipe.delivered)
+        self.assertEquals(1, self.pipe.peakDepth)
+
+
+    def test_batchSize(self):
+        """
+        Elements beyond the batch size are dispatched in the next iteration.
+        """
+        def onRequest(element):
+            called.append(element)
+            if len(called) == 1:
+                for _ in xrange(3):
+                    self.pipe.source.send(domish.Element((None, 'request')))
+
+        called = []
+        self.pipe.sink.addObserver('/request', onRequest)
+        self.pipe.source.send(domish.Element((None, 'request')))
+        self.assertEquals(3, len(called))
+        self.assertEquals(1, self.pipe.depth)
+
+        self.clock.advance(0)
+        self.assertEquals(4, len(called))
+        self.assertEquals(2, self.pipe.drains)
+        self.assertEquals(0, self.pipe.depth)
+
+
+    def test_sendPending(self):
+        """
+        Elements sent while a drain is scheduled are queued behind others.
+        """
+        self.pipe.batchSize = 1
+
+        def onRequest(element):
+            called.append(element['id'])
+            if element['id'] == '1':
+                for i in ('2', '3'):
+                    request = domish.Element((None, 'request'))
+                    request['id'] = i
+                    self.pipe.source.send(request)
+
+        called = []
+        self.pipe.sink.addObserver('/request', onRequest)
+        request = domish.Element((None, 'request'))
+        request['id'] = '1'
+        self.pipe.source.send(request)
+        request = domish.Element((None, 'request'))
+        request['id'] = '4'
+        self.pipe.source.send(request)
+        self.assertEquals(['1'], called)
+
+        self.clock.pump([0, 0, 0])
+        self.assertEquals(['1', '2', '3', '4'], called)
+
+
+    def test_congestion(self):
+        """
+        When the queue fills up, elements are dropped until it is drained.
+        """
+        def onRequest(element):
+            if not called:
+                for _ in xrange(6):
+                    self.pipe.source.send(domish.Element((None, 'request')))
+            called.append(element)
+
+        called = []
+        events = []
+        self.pipe.sink.addObserver('/request', onRequest)
+        self.pipe.source.addObserver(generic.PIPE_CONGESTED_EVENT,
+                                     lambda pipe: events.append('congested'))
+        self.pipe.source.addObserver(generic.PIPE_DRAINED_EVENT,
+                                     lambda pipe: events.append('drained'))
+        self.pipe.source.send(domish.Element((None, 'request')))
+
+        self.assertEquals(['congested'], events)
+        self.assertTrue(self.pipe.congested)
+        self.assertEquals(1, self.pipe.dropped)
+        self.assertEquals(5, self.pipe.peakDepth)
+
+        self.clock.pump([0, 0])
+        self.assertEquals(['congested', 'drained'], events)
+        self.assertFalse(self.pipe.congested)
+        self.assertEquals(6, len(called))
+        self.assertEquals(6, self.pipe.delivered)
+
+
+
+    def test_congestionRequest(self):
+        """
+        Requests dropped because of congestion are answered with an error.
+        """
+        def onRequest(element):
+            if not called:
+                for _ in xrange(5):
+                    self.pipe.source.send(domish.Element((None, 'request')))
+                self.pipe.source.send(iq)
+            called.append(element)
+
+        called = []
+        responses = []
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = '1'
+        iq['to'] = 'example.org'
+        iq['from'] = 'user@example.org'
+        self.pipe.sink.addObserver('/request', onRequest)
+        self.pipe.source.addObserver('/iq', lambda element:
+                                            responses.append(element))
+        self.pipe.source.send(domish.Element((None, 'request')))
+
+        self.assertEquals(1, len(responses))
+        response = responses[0]
+        self.assertEquals('error', response['type'])
+        self.assertEquals('1', response['id'])
+        self.assertEquals('user@example.org', response['to'])
+        exc = error.exceptionFromStanza(response)
+        self.assertEquals('resource-constraint', exc.condition)
+        self.assertEquals('wait', exc.type)
+
+
+    def test_congestionResponse(self):
+        """
+        Responses dropped because of congestion are not answered.
+        """
+        def onRequest(element):
+            if not called:
+                for _ in xrange(5):
+                    self.pipe.source.send(domish.Element((None, 'request')))
+                self.pipe.source.send(iq)
+            called.append(element)
+
+        called = []
+        responses = []
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'result'
+        iq['id'] = '1'
+        self.pipe.sink.addObserver('/request', onRequest)
+        self.pipe.source.addObserver('/iq', lambda element:
+                                            responses.append(element))
+        self.pipe.source.send(domish.Element((None, 'request')))
+
+        self.assertEquals([], responses)
+        self.assertEquals(1, self.pipe.dropped)
+
+
+class XmlParserTest(unittest.TestCase):
+    """
+    Tests for L{generic.XmlParser}.
+    """
+
+    def setUp(self):
+        self.parser = generic.XmlParser()
+
+
+    def test_parse(self):
+        """
+        A stanza parses to the same element as with parseXml.
+        """
+        xml = ("<message to='user@example.org' type='chat'>"
+               "<body>Hello</body>"
+               "<x xmlns='http://example.org/' xmlns:e='urn:example'>"
+               "<e:y a='1'/></x>"
+               "</message>")
+        element = self.parser.parse(xml)
+        self.assertEqual(generic.parseXml(xml).toXml(), element.toXml())
+        self.assertIdentical(None, element.parent)
+        self.assertEqual(u'Hello', unicode(element.body))
+
+
+    def test_parseReuse(self):
+        """
+        The parser can be used for many stanzas.
+        """
+        first = self.parser.parse("<presence/>")
+        second = self.parser.parse("<iq type='get'/>")
+        self.assertEqual('presence', first.name)
+        self.assertEqual('iq', second.name)
+        self.assertEqual(0, len(first.children))
+
+
+    def test_parseNamespace(self):
+        """
+        The default namespace of a stanza does not leak into the next.
+        """
+        self.parser.parse("<message xmlns='jabber:client'/>")
+        element = self.parser.parse("<message/>")
+        self.assertEqual(generic.parseXml("<message/>").uri, element.uri)
+
+
+    def test_parseIncomplete(self):
+        """
+        Incomplete input yields C{None} and doesn't affect the next stanza.
+        """
+        self.assertIdentical(None, self.parser.parse("<message><body>"))
+        self.assertEqual('presence', self.parser.parse("<presence/>").name)
+
+
+    def test_parseEmpty(self):
+        """
+        Empty input yields C{None}.
+        """
+        self.assertIdentical(None, self.parser.parse(""))
+
+
+    def test_parseXMLDeclaration(self):
+        """
+        Input with an XML declaration is parsed as with parseXml.
+        """
+        element = self.parser.parse("<?xml version='1.0'?><presence/>")
+        self.assertEqual('presence', element.name)
+        self.assertEqual('iq', self.parser.parse("<iq/>").name)
+
+
+    def test_parseInvalid(self):
+        """
+        Invalid input raises a parser error, and the parser can be reused.
+        """
+        self.assertRaises(domish.ParserError, self.parser.parse, "<a></b>")
+        self.assertEqual('iq', self.parser.parse("<iq/>").name)
+
+
+    def test_parseTrailingData(self):
+        """
+        Data after the element raises a parser error, as with parseXml.
+        """
+        self.assertRaises(domish.ParserError, generic.parseXml, "<a/>x")
+        self.assertRaises(domish.ParserError, self.parser.parse, "<a/>x")
+        self.assertRaises(domish.ParserError, self.parser.parse, "<a/><b/>")
+        self.assertEqual('iq', self.parser.parse("<iq/>").name)
+
+
+    def test_parseLeadingData(self):
+        """
+        Data before the element raises a parser error, as with parseXml.
+        """
+        self.assertRaises(domish.ParserError, self.parser.parse, "x<a/>")
+        self.assertEqual('iq', self.parser.parse("<iq/>").name)
+
+
+    def test_parseTrailingWhitespace(self):
+        """
+        Whitespace and comments around the element are allowed.
+        """
+        element = self.parser.parse(" <a/>\n<!-- comment -->")
+        self.assertEqual('a', element.name)
+
+
+    def test_parseTopLevelText(self):
+        """
+        Unlike with parseXml, text in the top-level element is kept.
+        """
+        xml = "<message>Hello<body/></message>"
+        self.assertEqual([], [child for child in generic.parseXml(xml).children
+                              if isinstance(child, unicode)])
+        self.assertEqual(u'Hello', self.parser.parse(xml).children[0])
+
+
+    def test_feed(self):
+        """
+        Stanzas are returned as they are completed.
+        """
+        self.assertEqual([], self.parser.feed("<message><bo"))
+        elements = self.parser.feed("dy/></message><presence/><iq")
+        self.assertEqual(['message', 'presence'],
+                         [element.name for element in elements])
+        self.assertEqual(['iq'],
+                         [element.name for element in self.parser.feed("/>")])
+
+
+    def test_feedInvalid(self):
+        """
+        Invalid data raises a parser error and resets the parser.
+        """
+        self.parser.feed("<message>")
+        self.assertRaises(domish.ParserError, self.parser.feed, "</iq>")
+        self.assertEqual(['iq'],
+                         [element.name for element in self.parser.feed("<iq/>")])
+
+
+    def test_parseStanzas(self):
+        """
+        Concatenated stanzas are parsed in one pass.
+        """
+        self.parser.chunkSize = 7
+        xml = "<message><body>Hello</body></message> <presence/><iq/>"
+        elements = list(self.parser.parseStanzas(xml))
+        self.assertEqual(['message', 'presence', 'iq'],
+                         [element.name for element in elements])
+        self.assertEqual(u'Hello', unicode(elements[0].body))
+
+
+    def test_parseStanzasChunks(self):
+        """
+        Stanzas can be parsed from an iterable of chunks.
+        """
+        elements = list(self.parser.parseStanzas(["<message><bo",
+                                                  "dy/></message>",
+                                                  "<presence/>"]))
+        self.assertEqual(['message', 'presence'],
+                         [element.name for element in elements])
+
+
+    def test_parseStanzasIncomplete(self):
+        """
+        Data ending with an incomplete stanza raises a parser error.
+        """
+        elements = self.parser.parseStanzas("<presence/><message>")
+        self.assertEqual('presence', next(elements).name)
+        self.assertRaises(domish.ParserError, next, elements)
+
+
+
+class StripNamespaceTest(unittest.TestCase):
+    """
+    Tests for L{generic.stripNamespace}.
+    """
+
+    def test_strip(self):
+        """
+        The stream namespace is removed from the stanza and its children.
+        """
+        element = generic.parseXml(
+                "<message xmlns='jabber:client'>"
+                  "<body>Hello</body>"
+                  "<x xmlns='http://example.org/'><y/></x>"
+                "</message>")
+        self.assertIdentical(element, generic.stripNamespace(element))
+        self.assertIdentical(None, element.uri)
+        self.assertIdentical(None, element.defaultUri)
+        self.assertIdentical(None, element.body.uri)
+        self.assertEqual('http://example.org/', element.x.uri)
+        self.assertEqual('http://example.org/', element.x.y.uri)
+
+
+    def test_stripNested(self):
+        """
+        Stream namespaced elements are stripped at any depth.
+        """
+        xml = "<message xmlns='jabber:client'>%s%s</message>" % (
+                "<a>" * 2000, "</a>" * 2000)
+        element = generic.stripNamespace(generic.parseXml(xml))
+        child = element
+        while child.children:
+            child = child.children[0]
+            self.assertIdentical(None, child.uri)
+
+
+    def test_stripNoNamespace(self):
+        """
+        Elements without namespace are not walked.
+        """
+        element = domish.Element((None, 'message'))
+        child = element.addElement(('jabber:client', 'body'))
+        generic.stripNamespace(element)
+        self.assertEqual('jabber:client', child.uri)
+
+
+
+class JIDCacheTest(unittest.TestCase):
+    """
+    Tests for L{generic.JIDCache}.
+    """
+
+    def setUp(self):
+        self.cache = generic.JIDCache(maxSize=3)
+
+
+    def test_get(self):
+        """
+        A JID is parsed once, and returned from the cache after that.
+        """
+        entity = self.cache.get(u'user@example.org/Home')
+        self.assertEqual(JID(u'user@example.org/Home'), entity)
+        self.assertIdentical(entity, self.cache.get(u'user@example.org/Home'))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+        self.assertEqual(1, len(self.cache))
+
+
+    def test_getInvalid(self):
+        """
+        Invalid JIDs raise an exception and are not cached.
+        """
+        self.assertRaises(jid.InvalidFormat, self.cache.get, u'user@')
+        self.assertNotIn(u'user@', self.cache)
+        self.assertEqual(0, len(self.cache))
+
+
+    def test_evict(self):
+        """
+        When the cache is full, the least recently used JID is evicted.
+        """
+        for user in (u'a', u'b', u'c'):
+            self.cache.get(user + u'@example.org')
+        self.cache.get(u'a@example.org')
+        self.cache.get(u'd@example.org')
+
+        self.assertEqual(3, len(self.cache))
+        self.assertEqual(1, self.cache.evictions)
+        self.assertNotIn(u'b@example.org', self.cache)
+        for user in (u'a', u'c', u'd'):
+            self.assertIn(user + u'@example.org', self.cache)
+
+
+    def test_evictOrder(self):
+        """
+        JIDs are evicted in order of their last use.
+        """
+        for user in (u'a', u'b', u'c', u'b', u'a', u'd', u'e'):
+            self.cache.get(user + u'@example.org')
+
+        self.assertEqual(2, self.cache.evictions)
+        for user in (u'a', u'd', u'e'):
+            self.assertIn(user + u'@example.org', self.cache)
+
+
+    def test_maxSizeZero(self):
+        """
+        With a maximum size of zero, nothing is cached.
+        """
+        self.cache = generic.JIDCache(maxSize=0)
+        entity = self.cache.get(u'user@example.org')
+        self.assertEqual(JID(u'user@example.org'), entity)
+        self.assertEqual(0, len(self.cache))
+
+
+    def test_clear(self):
+        """
+        Clearing the cache removes all JIDs and resets the statistics.
+        """
+        self.cache.get(u'user@example.org')
+        self.cache.get(u'user@example.org')
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(0, self.cache.misses)
+        self.cache.get(u'user@example.org')
+        self.assertEqual(1, len(self.cache))
+
+
+    def test_stats(self):
+        """
+        The statistics include the size, hits, misses and evictions.
+        """
+        for user in (u'a', u'b', u'a', u'c', u'd'):
+            self.cache.get(user + u'@example.org')
+
+        self.assertEqual({'size': 3,
+                          'maxSize': 3,
+                          'hits': 1,
+                          'misses': 4,
+                          'evictions': 1},
+                         self.cache.stats())
+
+
+    def test_internJID(self):
+        """
+        internJID uses the shared cache.
+        """
+        entity = generic.internJID(u'user@example.org')
+        self.assertIn(u'user@example.org', generic.jidCache)
+        self.assertIdentical(entity, generic.internJID(u'user@example.org'))
+
+
+
 class StanzaTest(unittest.TestCase):
     """
     Tests for L{generic.Stanza}.
@@ -111,6 +653,151 @@ class StanzaTest(unittest.TestCase):
         self.assertEqual(JID('user@example.org'), stanza.recipient)
 
 
+    def test_fromElementLazyAddressing(self):
+        """
+        Addresses are parsed when first accessed.
+        """
+        xml = """
+        <message from='Other@Example.org' to='user@example.org'/>
+        """
+
+        stanza = generic.Stanza.fromElement(generic.parseXml(xml))
+        self.assertEqual(u'Other@Example.org', stanza._senderRaw)
+        self.assertIdentical(None, stanza._sender)
+        self.assertEqual(JID('other@example.org'), stanza.sender)
+        self.assertIdentical(stanza.sender, stanza.sender)
+        self.assertIdentical(None, stanza._senderRaw)
+
+
+    def test_fromElementInvalidAddress(self):
+        """
+        A malformed address raises an exception when accessed.
+        """
+        xml = """
+        <message from='other@@example.org' to='user@example.org'/>
+        """
+
+        stanza = generic.Stanza.fromElement(generic.parseXml(xml))
+        self.assertEqual(JID('user@example.org'), stanza.recipient)
+        self.assertRaises(jid.InvalidFormat, getattr, stanza, 'sender')
+
+
+    def test_setAddressing(self):
+        """
+        Setting an address replaces the parsed one.
+        """
+        xml = """
+        <message from='other@example.org' to='user@example.org'/>
+        """
+
+        stanza = generic.Stanza.fromElement(generic.parseXml(xml))
+        stanza.sender = None
+        stanza.recipient = JID('third@example.org')
+        self.assertIdentical(None, stanza.sender)
+        self.assertEqual(JID('third@example.org'), stanza.recipient)
+
+
+    def test_fromElementKeepElement(self):
+        """
+        By default, the element a stanza was parsed from is kept.
+        """
+        element = generic.parseXml("<message type='chat'/>")
+        stanza = generic.Stanza.fromElement(element)
+        self.assertIdentical(element, stanza.element)
+        self.assertIdentical(element, stanza.sourceElement())
+
+
+    def test_fromElementDropElement(self):
+        """
+        The element can be dropped after parsing, and the stanza can then
+        be rendered from the parsed fields.
+        """
+        class Message(generic.Stanza):
+            stanzaKind = 'message'
+            keepElement = False
+
+        element = generic.parseXml("<message type='chat' "
+                                   "from='other@example.org' id='1'/>")
+        stanza = Message.fromElement(element)
+        self.assertIdentical(None, stanza.element)
+        self.assertIdentical(None, stanza.sourceElement())
+        self.assertEqual(element.attributes, stanza.toElement().attributes)
+
+
+    def test_fromElementDropElementPerCall(self):
+        """
+        Whether to keep the element can be set per call.
+        """
+        element = generic.parseXml("<message type='chat'/>")
+        stanza = generic.Stanza.fromElement(element, keepElement=False)
+        self.assertIdentical(None, stanza.element)
+
+
+    def test_fromElementWeakElement(self):
+        """
+        With a weak reference, the element is available as long as it is
+        referenced elsewhere.
+        """
+        class Message(generic.Stanza):
+            stanzaKind = 'message'
+
+        element = generic.parseXml("<message type='chat'/>")
+        stanza = Message.fromElement(element, keepElement=generic.KEEP_WEAK)
+        self.assertIdentical(None, stanza.element)
+        self.assertIdentical(element, stanza.sourceElement())
+
+        del element
+        gc.collect()
+        self.assertIdentical(None, stanza.sourceElement())
+
+
+    def test_toBytes(self):
+        """
+        A stanza is serialized like the result of toElement.
+        """
+        class Message(generic.Stanza):
+            stanzaKind = 'message'
+
+        stanza = Message(recipient=JID(u'user@example.org'),
+                         sender=JID(u'other@example.org/R&D'))
+        stanza.stanzaType = 'chat'
+        stanza.stanzaID = u'<1>'
+        data = stanza.toBytes()
+        self.assertIsInstance(data, generic.SerializedStanza)
+        self.assertEqual(stanza.toElement().toXml().encode('utf-8'), data)
+        self.assertEqual('message', data.stanzaKind)
+        self.assertEqual('chat', data.stanzaType)
+        self.assertEqual(u'<1>', data.stanzaID)
+
+
+    def test_toBytesFallback(self):
+        """
+        Subclasses that override toElement only are serialized from it.
+        """
+        class Request(generic.Request):
+            def toElement(self):
+                element = generic.Request.toElement(self)
+                element.addElement(('urn:example', 'query'))
+                return element
+
+        request = Request()
+        request.stanzaID = u'1'
+        self.assertEqual("<iq type='get' id='1'>"
+                         "<query xmlns='urn:example'/></iq>",
+                         request.toBytes())
+
+
+    def test_elementNotParsed(self):
+        """
+        A stanza not parsed from an element has no element, and accessing
+        it has no side effects.
+        """
+        request = generic.Request()
+        self.assertIdentical(None, request.element)
+        self.assertIdentical(None, request.sourceElement())
+        self.assertIdentical(None, request.stanzaID)
+
+
     def test_fromElementChildParser(self):
         """
         Child elements for which no parser is defined are ignored.
@@ -165,6 +852,83 @@ class StanzaTest(unittest.TestCase):
         generic.Stanza.fromElement(generic.parseXml(xml))
 
 
+    def test_childParsersCached(self):
+        """
+        Child parsers are accumulated once per class.
+        """
+        class Message(generic.Stanza):
+            childParsers = {('http://example.org/', 'x'): '_childParser_x'}
+
+            def _childParser_x(self, element):
+                pass
+
+        class SubMessage(Message):
+            childParsers = {('http://example.org/', 'y'): '_childParser_y'}
+
+            def _childParser_y(self, element):
+                pass
+
+        handlers = SubMessage._getChildParsers()
+        self.assertIdentical(handlers, SubMessage._getChildParsers())
+        self.assertEqual(set([('http://example.org/', 'x'),
+                              ('http://example.org/', 'y')]),
+                         set(handlers))
+        self.assertEqual([('http://example.org/', 'x')],
+                         Message._getChildParsers().keys())
+
+
+    def test_childParserOverridden(self):
+        """
+        Handlers are looked up on the class being parsed.
+        """
+        xml = """
+        <message from='other@example.org' to='user@example.org'>
+          <x xmlns='http://example.org/'/>
+        </message>
+        """
+
+        class Message(generic.Stanza):
+            childParsers = {('http://example.org/', 'x'): '_childParser_x'}
+            elements = []
+
+            def _childParser_x(self, element):
+                self.elements.append(('base', element.name))
+
+        class SubMessage(Message):
+            elements = []
+
+            def _childParser_x(self, element):
+                self.elements.append(('sub', element.name))
+
+        Message.fromElement(generic.parseXml(xml))
+        message = SubMessage.fromElement(generic.parseXml(xml))
+        self.assertEqual([('sub', 'x')], message.elements)
+
+
+    def test_childParserLate(self):
+        """
+        Handlers not defined on the class are looked up on the stanza.
+        """
+        xml = """
+        <message from='other@example.org' to='user@example.org'>
+          <x xmlns='http://example.org/'/>
+        </message>
+        """
+
+        class Message(generic.Stanza):
+            childParsers = {('http://example.org/', 'x'): '_childParser_x'}
+
+        elements = []
+
+        class LateMessage(Message):
+            def __init__(self):
+                Message.__init__(self)
+                self._childParser_x = elements.append
+
+        LateMessage.fromElement(generic.parseXml(xml))
+        self.assertEqual(1, len(elements))
+
+
 
 
 class RequestTest(unittest.TestCase):
@@ -300,6 +1064,92 @@ class RequestTest(unittest.TestCase):
 
 
 
+class SerializedStanzaTest(unittest.TestCase):
+    """
+    Tests for L{generic.SerializedStanza}.
+    """
+
+    def test_attributes(self):
+        """
+        A serialized stanza is a string with stanza attributes.
+        """
+        stanza = generic.SerializedStanza("<iq type='get' id='1'/>",
+                                          'iq', 'get', '1')
+        self.assertEqual("<iq type='get' id='1'/>", stanza)
+        self.assertIsInstance(stanza, str)
+        self.assertEqual('iq', stanza.stanzaKind)
+        self.assertEqual('get', stanza.stanzaType)
+        self.assertEqual('1', stanza.stanzaID)
+
+
+
+class StanzaTemplateTest(unittest.TestCase):
+    """
+    Tests for L{generic.StanzaTemplate}.
+    """
+
+    def setUp(self):
+        self.element = domish.Element((None, 'message'))
+        self.element['type'] = 'headline'
+        self.element.addElement('body', content=u'Caf\u00e9 <open>')
+        self.template = generic.StanzaTemplate(self.element)
+
+
+    def test_render(self):
+        """
+        Rendering splices in the recipient and identifier.
+        """
+        stanza = self.template.render(JID('user@example.org'), '1')
+        self.assertIsInstance(stanza, generic.SerializedStanza)
+        self.assertEqual('message', stanza.stanzaKind)
+        self.assertEqual('headline', stanza.stanzaType)
+        self.assertEqual('1', stanza.stanzaID)
+
+        element = generic.parseXml(stanza)
+        self.assertEqual(u'user@example.org', element['to'])
+        self.assertEqual(u'1', element['id'])
+        self.assertEqual(u'headline', element['type'])
+        self.assertEqual(u'Caf\u00e9 <open>', unicode(element.body))
+
+
+    def test_renderEquivalent(self):
+        """
+        The rendered stanza parses to the same element as the template.
+        """
+        self.element['to'] = u'r\u00e9gis@example.org'
+        self.element['id'] = u'a&b'
+        expected = self.element.toXml()
+
+        stanza = self.template.render(u'r\u00e9gis@example.org', u'a&b')
+        self.assertEqual(expected,
+                         generic.parseXml(stanza).toXml())
+
+
+    def test_renderNoAddressing(self):
+        """
+        Without recipient and identifier, the template is rendered as is.
+        """
+        stanza = self.template.render()
+        self.assertEqual(self.element.toXml().encode('utf-8'), stanza)
+        self.assertIdentical(None, stanza.stanzaID)
+
+
+    def test_templateIgnoresAddressing(self):
+        """
+        The C{to} and C{id} attributes of the template element are ignored,
+        and left in place.
+        """
+        self.element['to'] = 'other@example.org'
+        self.element['id'] = 'old'
+        template = generic.StanzaTemplate(self.element)
+        element = generic.parseXml(template.render('user@example.org'))
+        self.assertEqual('user@example.org', element['to'])
+        self.assertFalse(element.hasAttribute('id'))
+        self.assertEqual('other@example.org', self.element['to'])
+        self.assertEqual('old', self.element['id'])
+
+
+
 class PrepareIDNNameTests(unittest.TestCase):
     """
     Tests for L{wokkel.generic.prepareIDNName}.
@@ -19,7 +19,7 @@ from twisted.words.protocols.jabber.xmlstream import TimeoutError, toResponse
 
 from wokkel import data_form, delay, iwokkel, muc
 from wokkel.generic import parseXml
-from wokkel.test.helpers import TestableStreamManager
+from wokkel.test.helpers import SlotsTestMixin, TestableStreamManager
 
 
 NS_MUC_ADMIN = 'http://jabber.org/protocol/muc#admin'
@@ -168,6 +168,46 @@ class GroupChatTest(unittest.TestCase):
         self.assertNotIdentical(None, nodes, "Missing legacy delay element")
 
 
+    def test_toBytes(self):
+        """
+        A groupchat message is serialized like toElement.
+        """
+        message = muc.GroupChat(recipient=JID(u'room@muc.example.org'),
+                                body=u'Hello & welcome',
+                                subject=u'Chat')
+        data = message.toBytes()
+        self.assertEquals(message.toElement().toXml().encode('utf-8'), data)
+        self.assertEquals('groupchat', data.stanzaType)
+
+
+    def test_toBytesDelay(self):
+        """
+        If the delay attribute is set, toBytes has it rendered.
+        """
+        message = muc.GroupChat(body=u'Hello')
+        message.delay = delay.Delay(stamp=datetime(2002, 10, 13, 23, 58, 37,
+                                                   tzinfo=tzutc()),
+                                    sender=JID(u'room@muc.example.org'))
+
+        data = message.toBytes()
+        self.assertEquals(message.toElement().toXml().encode('utf-8'), data)
+        self.assertIn("<delay xmlns='%s'" % (delay.NS_DELAY,), data)
+
+
+    def test_toBytesDelayLegacy(self):
+        """
+        If legacy delay is requested, the legacy format is rendered.
+        """
+        message = muc.GroupChat(body=u'Hello')
+        message.delay = delay.Delay(stamp=datetime(2002, 10, 13, 23, 58, 37,
+                                                   tzinfo=tzutc()))
+
+        data = message.toBytes(legacyDelay=True)
+        element = message.toElement(legacyDelay=True)
+        self.assertEquals(element.toXml().encode('utf-8'), data)
+        self.assertIn("<x xmlns='%s'" % (delay.NS_JABBER_DELAY,), data)
+
+
 
 class HistoryOptionsTest(unittest.TestCase):
     """
@@ -389,6 +429,26 @@ class UserPresenceTest(unittest.TestCase):
 
 
 
+class AdminItemTest(unittest.TestCase, SlotsTestMixin):
+    """
+    Tests for L{muc.AdminItem}.
+    """
+
+    def makeObject(self):
+        return muc.AdminItem(affiliation='member', nick=u'thirdwitch')
+
+
+
+class UserTest(unittest.TestCase, SlotsTestMixin):
+    """
+    Tests for L{muc.User}.
+    """
+
+    def makeObject(self):
+        return muc.User(u'thirdwitch', JID(u'hag66@shakespeare.lit'))
+
+
+
 class MUCClientProtocolTest(unittest.TestCase):
     """
     Tests for L{muc.MUCClientProtocol}.
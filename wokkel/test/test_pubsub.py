@@ -16,7 +16,8 @@ from twisted.words.protocols.jabber.xmlstream import toResponse
 
 from wokkel import data_form, disco, iwokkel, pubsub, shim
 from wokkel.generic import parseXml
-from wokkel.test.helpers import TestableRequestHandlerMixin, XmlStreamStub
+from wokkel.test.helpers import SlotsTestMixin, TestableRequestHandlerMixin
+from wokkel.test.helpers import XmlStreamStub
 
 NS_PUBSUB = 'http://jabber.org/protocol/pubsub'
 NS_PUBSUB_NODE_CONFIG = 'http://jabber.org/protocol/pubsub#node_config'
@@ -43,11 +44,16 @@ def calledAsync(fn):
     return d, func
 
 
-class SubscriptionTest(unittest.TestCase):
+class SubscriptionTest(unittest.TestCase, SlotsTestMixin):
     """
     Tests for L{pubsub.Subscription}.
     """
 
+    def makeObject(self):
+        return pubsub.Subscription(u'test', JID(u'user@example.org'),
+                                   u'subscribed')
+
+
     def test_fromElement(self):
         """
         fromElement parses a subscription from XML DOM.
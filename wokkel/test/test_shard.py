@@ -0,0 +1,618 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.shard}.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.error import ProcessExitedAlready, ProcessTerminated
+from twisted.internet.task import Clock, deferLater
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.words.xish import domish
+
+from wokkel import shard
+from wokkel.component import RoundRobinRoute
+from wokkel.generic import XmlPipe
+
+def waitFor(condition, timeout=5):
+    """
+    Wait for a condition to become true, while the reactor runs.
+    """
+    def check(remaining):
+        if condition():
+            return
+        elif remaining <= 0:
+            raise AssertionError("Condition not met in %d seconds" %
+                                 (timeout,))
+        else:
+            d = deferLater(reactor, 0.01, lambda: None)
+            d.addCallback(lambda _: check(remaining - 0.01))
+            return d
+
+    return defer.maybeDeferred(check, timeout)
+
+
+
+class ShardedRouterTest(unittest.TestCase):
+    """
+    Tests for L{shard.ShardedRouter} and the links between routers.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.router1 = shard.ShardedRouter(reactor=self.clock)
+        self.router2 = shard.ShardedRouter(reactor=self.clock)
+        self.link1, self.link2 = self.connect(self.router1, self.router2)
+
+
+    def connect(self, router1, router2):
+        """
+        Link two routers with protocols over in-memory transports.
+        """
+        protocols = []
+        for router in (router1, router2):
+            factory = shard.ShardLinkServerFactory(router)
+            proto = factory.buildProtocol(None)
+            proto.makeConnection(StringTransport())
+            protocols.append(proto)
+        self.protocols = protocols
+        return protocols[0].link, protocols[1].link
+
+
+    def pump(self):
+        """
+        Deliver the data written by both ends of the link to the other end.
+        """
+        proto1, proto2 = self.protocols
+        while proto1.transport.value() or proto2.transport.value():
+            for source, sink in ((proto1, proto2), (proto2, proto1)):
+                data = source.transport.value()
+                source.transport.clear()
+                if data:
+                    sink.dataReceived(data)
+
+
+    def addComponent(self, router, destination):
+        """
+        Add a local component stream and collect what it receives.
+        """
+        pipe = XmlPipe()
+        received = []
+        pipe.source.addObserver('/*', lambda element: received.append(element))
+        router.addRoute(destination, pipe.sink)
+        return pipe, received
+
+
+    def send(self, pipe, sender, recipient):
+        stanza = domish.Element((None, 'message'))
+        stanza['from'] = sender
+        stanza['to'] = recipient
+        pipe.source.send(stanza)
+
+
+    def test_addRouteAnnounced(self):
+        """
+        Adding a local route adds a route over the link on the peer.
+        """
+        self.addComponent(self.router1, 'one.example.org')
+        self.pump()
+        self.assertIdentical(self.link2,
+                             self.router2.routes['one.example.org'])
+        self.assertEqual(['one.example.org'], self.router1.localRoutes())
+        self.assertEqual([], self.router2.localRoutes())
+
+
+    def test_addLinkAnnouncesExisting(self):
+        """
+        Routes added before the link was made are announced to the peer.
+        """
+        router3 = shard.ShardedRouter(reactor=self.clock)
+        self.addComponent(self.router1, 'one.example.org')
+        self.link1, self.link3 = self.connect(self.router1, router3)
+        self.pump()
+        self.assertIdentical(self.link3, router3.routes['one.example.org'])
+
+
+    def test_defaultRouteNotAnnounced(self):
+        """
+        The default route is not announced.
+        """
+        self.addComponent(self.router1, None)
+        self.pump()
+        self.assertNotIn(None, self.router2.routes)
+
+
+    def test_removeRouteAnnounced(self):
+        """
+        Removing a local route removes the route over the link on the peer.
+        """
+        pipe, _ = self.addComponent(self.router1, 'one.example.org')
+        self.pump()
+        self.router1.removeRoute('one.example.org', pipe.sink)
+        self.pump()
+        self.assertNotIn('one.example.org', self.router2.routes)
+
+
+    def test_routeOverLink(self):
+        """
+        Stanzas for a component of the peer are relayed over the link.
+        """
+        pipe1, received1 = self.addComponent(self.router1, 'one.example.org')
+        pipe2, received2 = self.addComponent(self.router2, 'two.example.org')
+        self.pump()
+
+        self.send(pipe2, 'two.example.org', 'user@one.example.org')
+        self.pump()
+        self.assertEqual(1, len(received1))
+        self.assertEqual(u'user@one.example.org', received1[0]['to'])
+
+        self.send(pipe1, 'one.example.org', 'two.example.org')
+        self.pump()
+        self.assertEqual(1, len(received2))
+
+
+    def test_relayedNotRelayedAgain(self):
+        """
+        Stanzas received over a link are not sent over another link.
+        """
+        router3 = shard.ShardedRouter(reactor=self.clock)
+        protocols = self.protocols
+        link13, _ = self.connect(self.router1, router3)
+        linkProtocols, self.protocols = self.protocols, protocols
+        linkProtocols[0].transport.clear()
+
+        # Both routers route to three.example.org over a link.
+        self.router1.addRemoteRoute('three.example.org', link13)
+        self.router2.addRemoteRoute('three.example.org', self.link2)
+        pipe, _ = self.addComponent(self.router2, 'two.example.org')
+        self.pump()
+
+        self.send(pipe, 'two.example.org', 'three.example.org')
+        self.pump()
+        self.assertEqual('', linkProtocols[0].transport.value())
+
+
+    def test_localRouteWins(self):
+        """
+        A local route replaces a remote route to the same destination.
+        """
+        self.addComponent(self.router2, 'one.example.org')
+        self.pump()
+        self.assertIdentical(self.link1,
+                             self.router1.routes['one.example.org'])
+
+        pipe, received = self.addComponent(self.router1, 'one.example.org')
+        self.assertIdentical(pipe.sink,
+                             self.router1.routes['one.example.org'])
+
+        other, _ = self.addComponent(self.router1, 'other.example.org')
+        self.send(other, 'other.example.org', 'one.example.org')
+        self.assertEqual(1, len(received))
+
+
+    def test_localRouteRemovedFallsBack(self):
+        """
+        Removing a local route restores the remote route.
+        """
+        self.addComponent(self.router2, 'one.example.org')
+        self.pump()
+        pipe, _ = self.addComponent(self.router1, 'one.example.org')
+        self.router1.removeRoute('one.example.org', pipe.sink)
+        self.assertIdentical(self.link1,
+                             self.router1.routes['one.example.org'])
+
+
+    def test_localAndRemoteWithRouteFactory(self):
+        """
+        With a route factory, traffic is spread over local and remote routes.
+        """
+        self.router1.routeFactory = RoundRobinRoute
+        self.addComponent(self.router2, 'one.example.org')
+        self.pump()
+        pipe, _ = self.addComponent(self.router1, 'one.example.org')
+
+        route = self.router1.routes['one.example.org']
+        self.assertEqual(set([self.link1, pipe.sink]), set(route.streams))
+
+
+    def test_relayedWithRouteFactory(self):
+        """
+        Stanzas relayed from a peer are only sent to local streams of a
+        route that also has a link.
+        """
+        self.router1.routeFactory = RoundRobinRoute
+        self.addComponent(self.router2, 'one.example.org')
+        self.pump()
+        pipe, received = self.addComponent(self.router1, 'one.example.org')
+        self.pump()
+
+        for _ in xrange(4):
+            self.protocols[0].stringReceived(
+                    "<message to='one.example.org'/>")
+        self.assertEqual(4, len(received))
+        self.assertEqual('', self.protocols[0].transport.value())
+
+
+    def test_removeLink(self):
+        """
+        Removing a link removes the routes announced over it.
+        """
+        self.addComponent(self.router2, 'one.example.org')
+        self.pump()
+        self.protocols[0].connectionLost(None)
+        self.assertNotIn('one.example.org', self.router1.routes)
+        self.assertNotIn(self.link1, self.router1.links)
+
+
+    def test_malformedMessage(self):
+        """
+        Malformed messages are dropped, keeping the link up.
+        """
+        pipe, received = self.addComponent(self.router1, 'one.example.org')
+        self.protocols[0].stringReceived("<message to='one.example.org'>"
+                                         "</presence>")
+        self.protocols[0].stringReceived("<message to='one.example.org'>")
+        self.assertIn(self.link1, self.router1.links)
+
+        self.protocols[0].stringReceived("<message to='one.example.org'/>")
+        self.assertEqual(1, len(received))
+
+
+    def test_removeRemoteRouteOtherPeer(self):
+        """
+        Removing the route of one peer keeps the route another peer still
+        announces for the same destination.
+        """
+        router3 = shard.ShardedRouter(reactor=self.clock)
+        link13, _ = self.connect(self.router1, router3)
+
+        self.router1.addRemoteRoute('one.example.org', self.link1)
+        self.router1.addRemoteRoute('one.example.org', link13)
+        self.router1.removeRemoteRoute('one.example.org', link13)
+        self.assertIdentical(self.link1,
+                             self.router1.routes['one.example.org'])
+
+        self.router1.addRemoteRoute('one.example.org', link13)
+        self.router1.removeRemoteRoute('one.example.org', self.link1)
+        self.assertIdentical(link13, self.router1.routes['one.example.org'])
+
+
+    def test_removeLinkOtherPeer(self):
+        """
+        Removing the link to one peer keeps the route another peer still
+        announces for the same destination.
+        """
+        router3 = shard.ShardedRouter(reactor=self.clock)
+        link13, _ = self.connect(self.router1, router3)
+
+        self.router1.addRemoteRoute('one.example.org', self.link1)
+        self.router1.addRemoteRoute('one.example.org', link13)
+        self.router1.removeLink(link13)
+        self.assertIdentical(self.link1,
+                             self.router1.routes['one.example.org'])
+
+
+
+class ListeningSocketTest(unittest.TestCase):
+    """
+    Tests for L{shard.listeningSocket}.
+    """
+
+    def test_tcp(self):
+        """
+        A TCP description opens a listening socket on the interface.
+        """
+        sock = shard.listeningSocket('tcp:0:interface=127.0.0.1')
+        self.addCleanup(sock.close)
+        self.assertEqual(socket.AF_INET, sock.family)
+        self.assertEqual('127.0.0.1', sock.getsockname()[0])
+
+
+    def test_tcp6(self):
+        """
+        An IPv6 interface, with escaped colons, opens an IPv6 socket.
+        """
+        try:
+            sock = shard.listeningSocket('tcp:0:interface=\\:\\:1')
+        except socket.error:
+            raise unittest.SkipTest("IPv6 is not available")
+        self.addCleanup(sock.close)
+        self.assertEqual(socket.AF_INET6, sock.family)
+        self.assertEqual('::1', sock.getsockname()[0])
+
+
+    def test_portKeyword(self):
+        """
+        The port can be given as a keyword argument.
+        """
+        sock = shard.listeningSocket('tcp:port=0:interface=127.0.0.1')
+        self.addCleanup(sock.close)
+        self.assertNotEqual(0, sock.getsockname()[1])
+
+
+    def test_notTCP(self):
+        """
+        Other kinds of ports cannot be shared.
+        """
+        self.assertRaises(ValueError, shard.listeningSocket, 'unix:/tmp/sock')
+
+
+    def test_noPort(self):
+        """
+        A port is required.
+        """
+        self.assertRaises(ValueError, shard.listeningSocket,
+                          'tcp:interface=127.0.0.1')
+
+
+
+class SocketFamilyTest(unittest.TestCase):
+    """
+    Tests for L{shard.socketFamily}.
+    """
+
+    def test_ipv4(self):
+        """
+        Ports on IPv4 interfaces are IPv4.
+        """
+        self.assertEqual(socket.AF_INET,
+                         shard.socketFamily('tcp:5347:interface=127.0.0.1'))
+
+
+    def test_allInterfaces(self):
+        """
+        Ports without an interface are IPv4.
+        """
+        self.assertEqual(socket.AF_INET, shard.socketFamily('tcp:5269'))
+
+
+    def test_ipv6(self):
+        """
+        Ports on IPv6 interfaces are IPv6.
+        """
+        self.assertEqual(socket.AF_INET6,
+                         shard.socketFamily('tcp:5347:interface=\\:\\:1'))
+
+
+
+class InheritedPortServiceTest(unittest.TestCase):
+    """
+    Tests for L{shard.InheritedPortService}.
+    """
+
+    def test_family(self):
+        """
+        The socket is adopted with the given address family.
+        """
+        adopted = []
+
+        class FakeReactor(object):
+            def adoptStreamPort(self, fileno, family, factory):
+                adopted.append((fileno, family, factory))
+
+        factory = protocol.ServerFactory()
+        s = shard.InheritedPortService(3, factory, socket.AF_INET6,
+                                       reactor=FakeReactor())
+        s.startService()
+        self.assertEqual([(3, socket.AF_INET6, factory)], adopted)
+
+
+
+class ShardServiceTest(unittest.TestCase):
+    """
+    Tests for L{shard.ShardService}, linking routers over Unix sockets.
+    """
+
+    def setUp(self):
+        # Not in the trial temporary directory, to keep the socket paths
+        # within the length allowed for Unix sockets.
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.routers = []
+        self.services = []
+        for workerID in xrange(2):
+            router = shard.ShardedRouter()
+            service = shard.ShardService(router, workerID, 2, self.directory)
+            service.startService()
+            self.addCleanup(self.stopService, service)
+            self.routers.append(router)
+            self.services.append(service)
+
+
+    def stopService(self, service):
+        if service.running:
+            return service.stopService()
+
+
+    def test_linked(self):
+        """
+        Each service listens on its socket and the services get linked.
+        """
+        for workerID in xrange(2):
+            self.assertTrue(os.path.exists(
+                shard.socketPath(self.directory, workerID)))
+
+        d = waitFor(lambda: all(router.links for router in self.routers))
+
+        def cb(_):
+            for router in self.routers:
+                self.assertEqual(1, len(router.links))
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_routeAnnounced(self):
+        """
+        Routes are announced and stanzas relayed over the socket link.
+        """
+        router1, router2 = self.routers
+        pipe = XmlPipe()
+        received = []
+        pipe.source.addObserver('/*', lambda element: received.append(element))
+        router1.addRoute('one.example.org', pipe.sink)
+
+        d = waitFor(lambda: 'one.example.org' in router2.routes)
+
+        def cb(_):
+            stanza = domish.Element((None, 'message'))
+            stanza['from'] = 'two.example.org'
+            stanza['to'] = 'one.example.org'
+            router2.route(stanza)
+            return waitFor(lambda: received)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_stopService(self):
+        """
+        Stopping the services closes the links.
+        """
+        d = waitFor(lambda: all(router.links for router in self.routers))
+        d.addCallback(lambda _: defer.gatherResults(
+            [service.stopService() for service in reversed(self.services)]))
+        d.addCallback(lambda _: waitFor(
+            lambda: not any(router.links for router in self.routers)))
+        return d
+
+
+
+class FakeProcess(object):
+    """
+    Process that records the signals sent to it.
+    """
+
+    def __init__(self):
+        self.signals = []
+        self.exited = False
+
+
+    def signalProcess(self, signal):
+        if self.exited:
+            raise ProcessExitedAlready()
+        self.signals.append(signal)
+
+
+
+class FakeReactor(object):
+    """
+    Reactor that records the processes spawned.
+    """
+
+    def __init__(self):
+        self.spawned = []
+
+
+    def spawnProcess(self, processProtocol, executable, args, env, childFDs):
+        process = FakeProcess()
+        self.spawned.append((processProtocol, executable, args, env, childFDs,
+                             process))
+        return process
+
+
+
+class ShardMasterTest(unittest.TestCase):
+    """
+    Tests for L{shard.ShardMaster}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.master = shard.ShardMaster(
+                2, ['--domain=example.org'],
+                {'server-fd': 'tcp:0:interface=127.0.0.1'},
+                {'WOKKEL_SERVER_SECRET': 'secret'},
+                reactor=self.reactor)
+        self.master.startService()
+        self.addCleanup(self.cleanup)
+
+
+    def cleanup(self):
+        for sock in self.master._sockets.itervalues():
+            sock.close()
+        if os.path.exists(self.master.directory):
+            shutil.rmtree(self.master.directory)
+
+
+    def endWorkers(self):
+        """
+        Let all worker processes end.
+        """
+        for processProtocol, _, _, _, _, process in self.reactor.spawned:
+            if not process.exited:
+                process.exited = True
+                processProtocol.processEnded(Failure(ProcessTerminated()))
+
+
+    def test_startService(self):
+        """
+        Workers are started with an identifier and the link directory.
+        """
+        self.assertEqual(2, len(self.reactor.spawned))
+        self.assertTrue(os.path.isdir(self.master.directory))
+        for workerID, spawned in enumerate(self.reactor.spawned):
+            args = spawned[2]
+            self.assertEqual(['--domain=example.org'], args[3:4])
+            self.assertIn('--workers=2', args)
+            self.assertIn('--worker-id=%d' % (workerID,), args)
+            self.assertIn('--shard-dir=%s' % (self.master.directory,), args)
+
+
+    def test_inheritedSocket(self):
+        """
+        Workers inherit the listening sockets, passed in their option.
+        """
+        fileno = self.master._sockets['server-fd'].fileno()
+        for spawned in self.reactor.spawned:
+            args, childFDs = spawned[2], spawned[4]
+            self.assertIn('--server-fd=%d' % (fileno,), args)
+            self.assertEqual(fileno, childFDs[fileno])
+            self.assertEqual('w', childFDs[0])
+
+
+    def test_environment(self):
+        """
+        Workers get the environment of this process and the extra variables.
+        """
+        for spawned in self.reactor.spawned:
+            env = spawned[3]
+            self.assertEqual('secret', env['WOKKEL_SERVER_SECRET'])
+            self.assertEqual(os.environ.get('PATH'), env.get('PATH'))
+
+
+    def test_stopService(self):
+        """
+        Stopping terminates the workers and removes the link directory once
+        they have ended.
+        """
+        d = self.master.stopService()
+        for spawned in self.reactor.spawned:
+            self.assertEqual(['TERM'], spawned[5].signals)
+        self.assertEqual({}, self.master._sockets)
+        self.assertTrue(os.path.isdir(self.master.directory))
+
+        self.endWorkers()
+        self.assertFalse(os.path.exists(self.master.directory))
+        return d
+
+
+    def test_stopServiceExited(self):
+        """
+        Workers that have already exited are not signalled.
+        """
+        self.endWorkers()
+        d = self.master.stopService()
+        for spawned in self.reactor.spawned:
+            self.assertEqual([], spawned[5].signals)
+        self.assertFalse(os.path.exists(self.master.directory))
+        return d
@@ -11,11 +11,12 @@ from twisted.trial import unittest
 from twisted.test import proto_helpers
 from twisted.internet import defer, task
 from twisted.internet.error import ConnectionDone
-from twisted.python import failure
+from twisted.python import failure, reflect
 from twisted.words.xish import domish
 from twisted.words.protocols.jabber import error, ijabber, xmlstream
+from twisted.words.protocols.jabber.jid import JID
 
-from wokkel import generic, subprotocols
+from wokkel import client, generic, subprotocols
 
 class DeprecationTest(unittest.TestCase):
     """
@@ -188,6 +189,366 @@ class XMPPHandlerTest(unittest.TestCase):
         return d
 
 
+    def test_requestMany(self):
+        """
+        Multiple requests are passed up to the stream manager.
+        """
+        class DummyStreamManager(object):
+            def requestMany(self, requests, window, maxPerRecipient):
+                self.args = (requests, window, maxPerRecipient)
+                return []
+
+        handler = subprotocols.XMPPHandler()
+        handler.parent = DummyStreamManager()
+        requests = [IQGetStanza()]
+        result = handler.requestMany(requests, window=5, maxPerRecipient=2)
+        self.assertEqual([], result)
+        self.assertEqual((requests, 5, 2), handler.parent.args)
+
+
+
+class TimeoutTrackerTest(unittest.TestCase):
+    """
+    Tests for L{subprotocols.TimeoutTracker}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.tracker = subprotocols.TimeoutTracker(self.clock, resolution=5)
+        self.timedOut = []
+
+
+    def add(self, key, timeout):
+        self.tracker.add(key, timeout, lambda: self.timedOut.append(key))
+
+
+    def test_timeout(self):
+        """
+        An item times out when its bucket expires.
+        """
+        self.add('a', 10)
+        self.clock.advance(9)
+        self.assertEqual([], self.timedOut)
+        self.clock.advance(1)
+        self.assertEqual(['a'], self.timedOut)
+        self.assertEqual(0, len(self.tracker))
+        self.assertFalse(self.clock.calls)
+
+
+    def test_timeoutRoundedUp(self):
+        """
+        Deadlines are rounded up to the resolution of the tracker.
+        """
+        self.add('a', 6)
+        self.clock.advance(9)
+        self.assertEqual([], self.timedOut)
+        self.clock.advance(1)
+        self.assertEqual(['a'], self.timedOut)
+
+
+    def test_singleDelayedCall(self):
+        """
+        Items in the same bucket share a single delayed call.
+        """
+        for i in xrange(100):
+            self.add(i, 9)
+
+        self.assertEqual(1, len(self.clock.calls))
+        self.clock.advance(10)
+        self.assertEqual(100, len(self.timedOut))
+
+
+    def test_earlierBucket(self):
+        """
+        Adding an item for an earlier bucket reschedules the delayed call.
+        """
+        self.add('late', 20)
+        self.add('early', 5)
+        self.assertEqual(1, len(self.clock.calls))
+        self.clock.advance(5)
+        self.assertEqual(['early'], self.timedOut)
+        self.assertEqual(1, len(self.clock.calls))
+        self.clock.advance(15)
+        self.assertEqual(['early', 'late'], self.timedOut)
+
+
+    def test_remove(self):
+        """
+        Removed items don't time out, and the last removal cancels the call.
+        """
+        self.add('a', 10)
+        self.add('b', 20)
+        self.tracker.remove('a')
+        self.assertNotIn('a', self.tracker)
+        self.assertIn('b', self.tracker)
+        self.tracker.remove('b')
+        self.assertFalse(self.clock.calls)
+        self.clock.advance(20)
+        self.assertEqual([], self.timedOut)
+
+
+    def test_removeUnknown(self):
+        """
+        Removing an unknown key is ignored.
+        """
+        self.tracker.remove('unknown')
+
+
+    def test_addDuringExpiry(self):
+        """
+        Items added while expiring a bucket are scheduled properly.
+        """
+        self.tracker.add('a', 5, lambda: self.add('b', 5))
+        self.clock.advance(5)
+        self.assertIn('b', self.tracker)
+        self.clock.advance(5)
+        self.assertEqual(['b'], self.timedOut)
+
+
+    def test_clear(self):
+        """
+        Clearing the tracker drops all items and the delayed call.
+        """
+        self.add('a', 10)
+        self.tracker.clear()
+        self.assertEqual(0, len(self.tracker))
+        self.assertFalse(self.clock.calls)
+
+
+
+class CoalescingTransportTest(unittest.TestCase):
+    """
+    Tests for L{subprotocols.CoalescingTransport}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wrapped = proto_helpers.StringTransport()
+        self.sequences = []
+        writeSequence = self.wrapped.writeSequence
+        def recordSequence(data):
+            self.sequences.append(list(data))
+            writeSequence(data)
+        self.wrapped.writeSequence = recordSequence
+        self.transport = subprotocols.CoalescingTransport(self.wrapped,
+                                                          self.clock,
+                                                          maxBytes=10)
+
+
+    def test_write(self):
+        """
+        Writes are buffered until the next reactor iteration.
+        """
+        self.transport.write('<a/>')
+        self.transport.write('<b/>')
+        self.assertEqual('', self.wrapped.value())
+        self.clock.advance(0)
+        self.assertEqual('<a/><b/>', self.wrapped.value())
+        self.assertEqual([['<a/>', '<b/>']], self.sequences)
+        self.assertEqual(2, self.transport.writes)
+        self.assertEqual(1, self.transport.flushes)
+        self.assertFalse(self.clock.calls)
+
+
+    def test_writeMaxDelay(self):
+        """
+        Writes are buffered for at most C{maxDelay} seconds.
+        """
+        self.transport.maxDelay = 0.5
+        self.transport.write('<a/>')
+        self.clock.advance(0.4)
+        self.assertEqual('', self.wrapped.value())
+        self.clock.advance(0.1)
+        self.assertEqual('<a/>', self.wrapped.value())
+
+
+    def test_writeMaxBytes(self):
+        """
+        The buffer is written out as soon as it reaches C{maxBytes}.
+        """
+        self.transport.write('<a/>')
+        self.transport.write('<b/>')
+        self.transport.write('<c/>')
+        self.assertEqual('<a/><b/><c/>', self.wrapped.value())
+        self.assertFalse(self.clock.calls)
+
+
+    def test_writeSequence(self):
+        """
+        Sequences of data are buffered as well.
+        """
+        self.transport.writeSequence(['<a/>', '<b/>'])
+        self.assertEqual('', self.wrapped.value())
+        self.clock.advance(0)
+        self.assertEqual('<a/><b/>', self.wrapped.value())
+
+
+    def test_loseConnection(self):
+        """
+        Buffered data is written out before closing the connection.
+        """
+        self.transport.write('<a/>')
+        self.transport.loseConnection()
+        self.assertEqual('<a/>', self.wrapped.value())
+        self.assertTrue(self.wrapped.disconnecting)
+        self.assertFalse(self.clock.calls)
+
+
+    def test_stopFlushing(self):
+        """
+        Buffered data is discarded when flushing is stopped.
+        """
+        self.transport.write('<a/>')
+        self.transport.stopFlushing()
+        self.clock.advance(0)
+        self.assertEqual('', self.wrapped.value())
+        self.assertFalse(self.clock.calls)
+
+
+    def test_getattr(self):
+        """
+        Other attributes are taken from the wrapped transport.
+        """
+        self.assertIdentical(self.wrapped.disconnecting,
+                             self.transport.disconnecting)
+        self.assertEqual(self.wrapped.getPeer(), self.transport.getPeer())
+
+
+
+class HandlerStatisticsTest(unittest.TestCase):
+    """
+    Tests for L{subprotocols.HandlerStatistics}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.statistics = subprotocols.HandlerStatistics(self.clock.seconds)
+        self.handler = DummyXMPPHandler()
+        self.key = ('wokkel.test.test_subprotocols.DummyXMPPHandler',
+                    'method')
+
+
+    def test_call(self):
+        """
+        Calls are counted and timed.
+        """
+        def method(value):
+            self.clock.advance(2)
+            return value
+
+        self.handler.method = method
+        result = self.statistics.call(self.handler, 'method', 'value')
+        self.assertEqual('value', result)
+
+        entry = self.statistics.snapshot()[self.key]
+        self.assertEqual(1, entry['calls'])
+        self.assertEqual(0, entry['errors'])
+        self.assertEqual(2, entry['syncTime'])
+        self.assertEqual(0, entry['deferredCalls'])
+
+
+    def test_callRaises(self):
+        """
+        Exceptions are counted as errors and propagated.
+        """
+        def method():
+            raise ValueError()
+
+        self.handler.method = method
+        self.assertRaises(ValueError, self.statistics.call,
+                          self.handler, 'method')
+
+        entry = self.statistics.snapshot()[self.key]
+        self.assertEqual(1, entry['calls'])
+        self.assertEqual(1, entry['errors'])
+
+
+    def test_callDeferred(self):
+        """
+        The time until a returned deferred fires is recorded.
+        """
+        d = defer.Deferred()
+        self.handler.method = lambda: d
+        result = self.statistics.call(self.handler, 'method')
+        self.assertIdentical(d, result)
+        self.assertEqual(1, self.statistics.snapshot()[self.key]['pending'])
+
+        self.clock.advance(3)
+        d.callback('value')
+        self.assertEqual('value', self.successResultOf(result))
+
+        entry = self.statistics.snapshot()[self.key]
+        self.assertEqual(1, entry['deferredCalls'])
+        self.assertEqual(3, entry['deferredTime'])
+        self.assertEqual(0, entry['pending'])
+        self.assertEqual(0, entry['errors'])
+
+
+    def test_callDeferredFailure(self):
+        """
+        Deferreds that errback are counted as errors.
+        """
+        d = defer.Deferred()
+        self.handler.method = lambda: d
+        self.statistics.call(self.handler, 'method')
+        d.errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(1, self.statistics.snapshot()[self.key]['errors'])
+
+
+    def test_wrapObserver(self):
+        """
+        Wrapped observers are recorded under their name.
+        """
+        def onMessage(element):
+            self.clock.advance(1)
+
+        wrapped = self.statistics.wrapObserver(self.handler, onMessage)
+        wrapped(None)
+        wrapped(None)
+
+        key = 'wokkel.test.test_subprotocols.DummyXMPPHandler', 'onMessage'
+        entry = self.statistics.snapshot()[key]
+        self.assertEqual(2, entry['calls'])
+        self.assertEqual(2, entry['syncTime'])
+
+
+    def test_wrapObserverEqual(self):
+        """
+        Wrapped observers compare and hash equal to the original.
+        """
+        def onMessage(element):
+            pass
+
+        wrapped = self.statistics.wrapObserver(self.handler, onMessage)
+        self.assertEqual(wrapped, onMessage)
+        self.assertEqual(hash(onMessage), hash(wrapped))
+        self.assertEqual(wrapped,
+                         self.statistics.wrapObserver(self.handler, onMessage))
+        self.assertNotEqual(wrapped, lambda element: None)
+
+
+    def test_snapshotCopy(self):
+        """
+        Snapshots are not affected by later calls.
+        """
+        self.handler.method = lambda: None
+        self.statistics.call(self.handler, 'method')
+        snapshot = self.statistics.snapshot()
+        self.statistics.call(self.handler, 'method')
+        self.assertEqual(1, snapshot[self.key]['calls'])
+
+
+    def test_reset(self):
+        """
+        Resetting discards all statistics.
+        """
+        self.handler.method = lambda: None
+        self.statistics.call(self.handler, 'method')
+        self.statistics.reset()
+        self.assertEqual({}, self.statistics.snapshot())
+
+
 
 class StreamManagerTest(unittest.TestCase):
     """
@@ -276,6 +637,37 @@ class StreamManagerTest(unittest.TestCase):
         self.assertNotIdentical(None, xs.rawDataOutFn)
 
 
+    def test_connectedCoalesceWrites(self):
+        """
+        Writes are coalesced if enabled.
+        """
+        sm = self.streamManager
+        sm.coalesceWrites = True
+        self._streamStarted()
+
+        self.assertIsInstance(self.xmlstream.transport,
+                              subprotocols.CoalescingTransport)
+        self.transport.clear()
+        sm.send("<presence/>")
+        sm.send("<message/>")
+        self.assertEqual("", self.transport.value())
+        self.clock.advance(0)
+        self.assertEqual("<presence/><message/>", self.transport.value())
+
+
+    def test_disconnectedCoalesceWrites(self):
+        """
+        When the stream is closed, no more data is written.
+        """
+        sm = self.streamManager
+        sm.coalesceWrites = True
+        self._streamStarted()
+        self.clock.advance(0)
+        sm.send("<presence/>")
+        self.xmlstream.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertFalse(self.clock.calls)
+
+
     def test_authd(self):
         """
         Test that protocol handlers have their connectionInitialized method
@@ -291,6 +683,59 @@ class StreamManagerTest(unittest.TestCase):
         self.assertEquals(0, handler.doneLost)
 
 
+    def test_statistics(self):
+        """
+        Connection events dispatched to handlers are recorded.
+        """
+        sm = self.streamManager
+        sm.statistics = subprotocols.HandlerStatistics()
+        handler = DummyXMPPHandler()
+        handler.setHandlerParent(sm)
+        self._streamStarted()
+        self.xmlstream.connectionLost(failure.Failure(ConnectionDone()))
+
+        snapshot = sm.statistics.snapshot()
+        name = 'wokkel.test.test_subprotocols.DummyXMPPHandler'
+        self.assertEqual(1, snapshot[name, 'makeConnection']['calls'])
+        self.assertEqual(1, snapshot[name, 'connectionInitialized']['calls'])
+        self.assertEqual(1, snapshot[name, 'connectionLost']['calls'])
+
+
+    def test_statisticsObservers(self):
+        """
+        Observers added by handlers during connection events are recorded.
+        """
+        clock = task.Clock()
+        sm = self.streamManager
+        sm.statistics = subprotocols.HandlerStatistics(clock.seconds)
+        received = []
+
+        class Handler(subprotocols.XMPPHandler):
+            def connectionInitialized(self):
+                self.xmlstream.addObserver('/message', self.onMessage)
+
+            def onMessage(self, message):
+                clock.advance(2)
+                received.append(message)
+
+        handler = Handler()
+        handler.setHandlerParent(sm)
+        self._streamStarted()
+        self.assertNotIn('addObserver', self.xmlstream.__dict__)
+
+        self.xmlstream.dataReceived("<message/>")
+        self.assertEqual(1, len(received))
+        key = reflect.qual(Handler), 'onMessage'
+        entry = sm.statistics.snapshot()[key]
+        self.assertEqual(1, entry['calls'])
+        self.assertEqual(2, entry['syncTime'])
+
+        # The observer can be removed with the original callable.
+        self.xmlstream.removeObserver('/message', handler.onMessage)
+        self.xmlstream.dataReceived("<message/>")
+        self.assertEqual(1, len(received))
+
+
     def test_disconnected(self):
         """
         Protocol handlers have connectionLost called on stream disconnect.
@@ -483,6 +928,19 @@ class StreamManagerTest(unittest.TestCase):
         self.assertEquals("<presence/>", xs.transport.value())
 
 
+    def test_sendSerializedStanza(self):
+        """
+        Pre-serialized stanzas are sent as is.
+        """
+        self._streamStarted()
+        self.transport.clear()
+        element = domish.Element((None, 'presence'))
+        template = generic.StanzaTemplate(element)
+        self.streamManager.send(template.render('user@example.org'))
+        self.assertEqual("<presence to='user@example.org'/>",
+                         self.transport.value())
+
+
     def test_sendNotConnected(self):
         """
         Test send when there is no established XML stream.
@@ -555,79 +1013,235 @@ class StreamManagerTest(unittest.TestCase):
         self.assertEquals("<presence/>", sm._packetQueue[0])
 
 
-    def test_requestSendInitialized(self):
+    def test_sendQueueMaxLength(self):
         """
-        A request is sent out over the wire when the stream is initialized.
+        The oldest queued data is dropped when the queue is full.
         """
-        self._streamStarted()
-
-        self.streamManager.request(self.request)
-        expected = u"<iq type='get' id='%s'/>" % self.request.stanzaID
-        self.assertEquals(expected, self.transport.value())
+        sm = self.streamManager
+        sm.maxQueueLength = 2
+        sm.send("<presence/>")
+        sm.send("<message/>")
+        sm.send("<iq/>")
+        self.assertEqual(["<message/>", "<iq/>"], list(sm._packetQueue))
+        self.assertEqual(1, sm.queueDropped)
 
 
-    def test_requestSendInitializedFreshID(self):
+    def test_sendQueueMaxLengthRejectNew(self):
         """
-        A request without an ID gets a fresh one upon send.
+        With the reject-new policy, new data is dropped if the queue is full.
         """
-        self._streamStarted()
-
-        self.request.stanzaID = None
-        self.streamManager.request(self.request)
-        self.assertNotIdentical(None, self.request.stanzaID)
-        expected = u"<iq type='get' id='%s'/>" % self.request.stanzaID
-        self.assertEquals(expected, self.transport.value())
+        sm = self.streamManager
+        sm.maxQueueLength = 2
+        sm.queueOverflowPolicy = subprotocols.REJECT_NEW
+        sm.send("<presence/>")
+        sm.send("<message/>")
+        sm.send("<iq/>")
+        self.assertEqual(["<presence/>", "<message/>"], list(sm._packetQueue))
+        self.assertEqual(1, sm.queueDropped)
 
 
-    def test_requestSendNotConnected(self):
+    def test_sendQueueMaxBytes(self):
         """
-        A request is queued until a stream is initialized.
+        The total size of the serialized queued data can be limited.
         """
-        handler = DummyXMPPHandler()
-        self.streamManager.addHandler(handler)
+        sm = self.streamManager
+        sm.maxQueueBytes = 40
+        sm.send("<presence/>")
+        element = domish.Element((None, 'message'))
+        element['to'] = u'r\u00e9gis@example.org'
+        sm.send(element)
+        self.assertEqual([element], list(sm._packetQueue))
+        self.assertEqual(len(element.toXml().encode('utf-8')), sm.queueBytes)
+        self.assertEqual(1, sm.queueDropped)
+        self.assertEqual(11, sm.queueDroppedBytes)
 
-        self.streamManager.request(self.request)
-        expected = u"<iq type='get' id='test'/>"
 
-        xs = self.xmlstream
-        self.assertEquals("", xs.transport.value())
+    def test_sendQueueMaxBytesTooLarge(self):
+        """
+        Data larger than the maximum queue size is never queued.
+        """
+        sm = self.streamManager
+        sm.maxQueueBytes = 5
+        sm.send("<presence/>")
+        self.assertFalse(sm._packetQueue)
+        self.assertEqual(0, sm.queueBytes)
+        self.assertEqual(1, sm.queueDropped)
 
-        xs.connectionMade()
-        self.assertEquals("", xs.transport.value())
 
-        xs.dataReceived("<stream:stream xmlns='jabber:client' "
-                        "xmlns:stream='http://etherx.jabber.org/streams' "
-                        "from='example.com' id='12345'>")
-        xs.dispatch(xs, "//event/stream/authd")
+    def test_sendQueueTimeout(self):
+        """
+        Queued data expires after the queue timeout.
+        """
+        sm = self.streamManager
+        sm.queueTimeout = 10
+        sm.send("<presence/>")
+        self.clock.advance(5)
+        sm.send("<message/>")
+        self.clock.advance(5)
 
-        self.assertEquals(expected, xs.transport.value())
-        self.assertFalse(self.streamManager._packetQueue)
+        self._streamStarted()
+        self.assertEqual("<message/>", self.transport.value())
+        self.assertEqual(1, sm.queueExpired)
 
 
-    def test_requestResultResponse(self):
+    def test_requestQueueOverflow(self):
         """
-        A result response gets the request deferred fired with the response.
+        A request dropped from the queue has its deferred errbacked.
         """
-        def cb(result):
-            self.assertEquals(result['type'], 'result')
+        sm = self.streamManager
+        sm.maxQueueLength = 1
+        d = sm.request(self.request)
+        sm.send("<presence/>")
+        self.assertNotIn('test', sm._iqDeferreds)
+        self.assertFailure(d, subprotocols.QueueOverflowError)
+        return d
 
-        self._streamStarted()
-        d = self.streamManager.request(self.request)
-        d.addCallback(cb)
 
-        xs = self.xmlstream
-        xs.dataReceived("<iq type='result' id='test'/>")
+    def test_requestQueueOverflowSerialized(self):
+        """
+        A pre-serialized request dropped from the queue is errbacked too.
+        """
+        sm = self.streamManager
+        sm.maxQueueLength = 1
+        d = defer.Deferred()
+        sm._iqDeferreds['s1'] = d
+        sm.send(generic.SerializedStanza("<iq type='get' id='s1'/>",
+                                         'iq', 'get', 's1'))
+        sm.send("<presence/>")
+        self.assertNotIn('s1', sm._iqDeferreds)
+        self.assertFailure(d, subprotocols.QueueOverflowError)
         return d
 
 
-    def test_requestErrorResponse(self):
+    def test_requestQueueTimeout(self):
         """
-        An error response gets the request deferred fired with a failure.
+        An expired request in the queue has its deferred errbacked.
         """
+        sm = self.streamManager
+        sm.queueTimeout = 10
+        d = sm.request(self.request)
+        self.clock.advance(10)
         self._streamStarted()
-        d = self.streamManager.request(self.request)
-        self.assertFailure(d, error.StanzaError)
-
+        self.assertEqual("", self.transport.value())
+        self.assertFailure(d, xmlstream.TimeoutError)
+        return d
+
+
+    def test_sendQueueFlushSize(self):
+        """
+        Queued data is sent in chunks, in subsequent reactor iterations.
+        """
+        sm = self.streamManager
+        sm.queueFlushSize = 2
+        for i in xrange(5):
+            sm.send("<presence id='%d'/>" % i)
+
+        self._streamStarted()
+        self.assertEqual("<presence id='0'/><presence id='1'/>",
+                         self.transport.value())
+
+        # Newly sent data goes after the queued data.
+        sm.send("<message/>")
+        self.assertEqual(4, len(sm._packetQueue))
+
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual("<presence id='0'/><presence id='1'/>"
+                         "<presence id='2'/><presence id='3'/>"
+                         "<presence id='4'/><message/>",
+                         self.transport.value())
+        self.assertFalse(sm._packetQueue)
+        self.assertFalse(self.clock.calls)
+
+
+    def test_sendQueueFlushDisconnected(self):
+        """
+        Flushing the queue stops when the stream is disconnected.
+        """
+        sm = self.streamManager
+        sm.queueFlushSize = 1
+        sm.send("<presence/>")
+        sm.send("<message/>")
+
+        self._streamStarted()
+        self.xmlstream.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(["<message/>"], list(sm._packetQueue))
+        self.assertFalse(self.clock.calls)
+
+
+    def test_requestSendInitialized(self):
+        """
+        A request is sent out over the wire when the stream is initialized.
+        """
+        self._streamStarted()
+
+        self.streamManager.request(self.request)
+        expected = u"<iq type='get' id='%s'/>" % self.request.stanzaID
+        self.assertEquals(expected, self.transport.value())
+
+
+    def test_requestSendInitializedFreshID(self):
+        """
+        A request without an ID gets a fresh one upon send.
+        """
+        self._streamStarted()
+
+        self.request.stanzaID = None
+        self.streamManager.request(self.request)
+        self.assertNotIdentical(None, self.request.stanzaID)
+        expected = u"<iq type='get' id='%s'/>" % self.request.stanzaID
+        self.assertEquals(expected, self.transport.value())
+
+
+    def test_requestSendNotConnected(self):
+        """
+        A request is queued until a stream is initialized.
+        """
+        handler = DummyXMPPHandler()
+        self.streamManager.addHandler(handler)
+
+        self.streamManager.request(self.request)
+        expected = u"<iq type='get' id='test'/>"
+
+        xs = self.xmlstream
+        self.assertEquals("", xs.transport.value())
+
+        xs.connectionMade()
+        self.assertEquals("", xs.transport.value())
+
+        xs.dataReceived("<stream:stream xmlns='jabber:client' "
+                        "xmlns:stream='http://etherx.jabber.org/streams' "
+                        "from='example.com' id='12345'>")
+        xs.dispatch(xs, "//event/stream/authd")
+
+        self.assertEquals(expected, xs.transport.value())
+        self.assertFalse(self.streamManager._packetQueue)
+
+
+    def test_requestResultResponse(self):
+        """
+        A result response gets the request deferred fired with the response.
+        """
+        def cb(result):
+            self.assertEquals(result['type'], 'result')
+
+        self._streamStarted()
+        d = self.streamManager.request(self.request)
+        d.addCallback(cb)
+
+        xs = self.xmlstream
+        xs.dataReceived("<iq type='result' id='test'/>")
+        return d
+
+
+    def test_requestErrorResponse(self):
+        """
+        An error response gets the request deferred fired with a failure.
+        """
+        self._streamStarted()
+        d = self.streamManager.request(self.request)
+        self.assertFailure(d, error.StanzaError)
+
         xs = self.xmlstream
         xs.dataReceived("<iq type='error' id='test'/>")
         return d
@@ -712,6 +1326,41 @@ class StreamManagerTest(unittest.TestCase):
         return d
 
 
+    def test_requestTimingOutBatched(self):
+        """
+        Timeouts of many requests are tracked using a single delayed call.
+        """
+        deferreds = []
+        for i in xrange(10):
+            request = IQGetStanza()
+            request.stanzaID = str(i)
+            request.timeout = 60
+            d = self.streamManager.request(request)
+            self.assertFailure(d, xmlstream.TimeoutError)
+            deferreds.append(d)
+
+        self.assertEqual(1, len(self.clock.calls))
+        self.clock.advance(60)
+        self.assertFalse(self.streamManager._iqDeferreds)
+        return defer.gatherResults(deferreds)
+
+
+    def test_requestTimingOutNoResolution(self):
+        """
+        Without a timeout resolution, each request gets its own delayed call.
+        """
+        self.streamManager.timeoutResolution = None
+        self.request.timeout = 60
+        d = self.streamManager.request(self.request)
+        self.assertFailure(d, xmlstream.TimeoutError)
+        self.assertEqual(60, self.clock.calls[0].getTime())
+
+        self.clock.pump([1, 60])
+        self.assertFalse(self.clock.calls)
+        self.assertFalse(self.streamManager._iqDeferreds)
+        return d
+
+
     def test_requestNotTimingOut(self):
         """
         Test that an iq request with a defined timeout does not time out
@@ -778,6 +1427,646 @@ class StreamManagerTest(unittest.TestCase):
 
 
 
+class StreamManagementTest(unittest.TestCase):
+    """
+    Tests for Stream Management (XEP-0198) in L{subprotocols.StreamManager}.
+    """
+
+    def setUp(self):
+        self.factory = xmlstream.XmlStreamFactory(xmlstream.Authenticator())
+        self.clock = task.Clock()
+        self.streamManager = subprotocols.StreamManager(self.factory,
+                                                        self.clock)
+        self.streamManager.streamManagement = True
+        self.streamManager.smAckInterval = None
+        self.handler = DummyXMPPHandler()
+        self.handler.setHandlerParent(self.streamManager)
+        self.request = IQGetStanza()
+
+
+    def connect(self, features=True, resumeH=None):
+        """
+        Set up a new connection, acting as the server side.
+
+        @param features: Whether the server offers Stream Management.
+        @param resumeH: If not C{None}, resume the previous stream, with
+            the given number of stanzas acknowledged by the server.
+        """
+        self.xmlstream = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.xmlstream.transport = self.transport
+        self.xmlstream.connectionMade()
+        self.xmlstream.dataReceived(
+                "<stream:stream xmlns='jabber:client' "
+                    "xmlns:stream='http://etherx.jabber.org/streams' "
+                    "from='example.com' id='12345'>")
+        if features:
+            self.xmlstream.features[(subprotocols.NS_SM, 'sm')] = None
+        if resumeH is not None:
+            self.streamManager.streamResumed(resumeH)
+        self.transport.clear()
+        self.xmlstream.dispatch(self.xmlstream, xmlstream.STREAM_AUTHD_EVENT)
+
+
+    def disconnect(self):
+        self.xmlstream.connectionLost(failure.Failure(ConnectionDone()))
+
+
+    def enable(self, resume=True):
+        """
+        Connect and have the server enable Stream Management.
+        """
+        self.connect()
+        if resume:
+            self.xmlstream.dataReceived("<enabled xmlns='urn:xmpp:sm:3' "
+                                        "id='sm1' resume='true'/>")
+        else:
+            self.xmlstream.dataReceived("<enabled xmlns='urn:xmpp:sm:3'/>")
+        self.transport.clear()
+
+
+    def test_enable(self):
+        """
+        Stream Management is enabled, requesting resumption.
+        """
+        self.connect()
+        self.assertEqual("<enable xmlns='urn:xmpp:sm:3' resume='true'/>",
+                         self.transport.value())
+
+
+    def test_enableNotOffered(self):
+        """
+        Stream Management is not enabled if the server doesn't offer it.
+        """
+        self.connect(features=False)
+        self.assertEqual("", self.transport.value())
+        self.assertIdentical(None, self.streamManager.resumptionInfo())
+
+
+    def test_enableDisabled(self):
+        """
+        Stream Management is not enabled unless requested.
+        """
+        self.streamManager.streamManagement = False
+        self.connect()
+        self.assertEqual("", self.transport.value())
+
+
+    def test_enabled(self):
+        """
+        A resumable stream can be resumed after the connection is lost.
+        """
+        self.enable()
+        self.xmlstream.dataReceived("<message/>")
+        self.disconnect()
+        self.assertEqual((u'sm1', 1), self.streamManager.resumptionInfo())
+
+
+    def test_enabledNotResumable(self):
+        """
+        If the stream is not resumable, there is nothing to resume.
+        """
+        self.enable(resume=False)
+        self.disconnect()
+        self.assertIdentical(None, self.streamManager.resumptionInfo())
+
+
+    def test_enableFailed(self):
+        """
+        If enabling fails, sent stanzas are not kept.
+        """
+        self.connect()
+        self.xmlstream.dataReceived("<failed xmlns='urn:xmpp:sm:3'/>")
+        self.streamManager.send("<presence/>")
+        self.assertFalse(self.streamManager._smUnacked)
+
+
+    def test_ackRequest(self):
+        """
+        An acknowledgement request is answered with the number of stanzas
+        received.
+        """
+        self.enable()
+        self.xmlstream.dataReceived("<message/><presence/><iq type='get'/>")
+        self.transport.clear()
+        self.xmlstream.dataReceived("<r xmlns='urn:xmpp:sm:3'/>")
+        self.assertEqual("<a xmlns='urn:xmpp:sm:3' h='3'/>",
+                         self.transport.value())
+
+
+    def test_ack(self):
+        """
+        Acknowledged stanzas are no longer kept.
+        """
+        self.enable()
+        self.streamManager.send("<presence/>")
+        self.streamManager.send("<message/>")
+        self.streamManager.send(domish.Element((None, 'iq')))
+        self.assertEqual(3, len(self.streamManager._smUnacked))
+        self.xmlstream.dataReceived("<a xmlns='urn:xmpp:sm:3' h='2'/>")
+        self.assertEqual(1, len(self.streamManager._smUnacked))
+
+
+    def test_ackInterval(self):
+        """
+        Acknowledgement is requested every C{smAckInterval} stanzas.
+        """
+        self.streamManager.smAckInterval = 2
+        self.enable()
+        self.streamManager.send("<presence/>")
+        self.streamManager.send("<message/>")
+        self.assertEqual("<presence/><message/><r xmlns='urn:xmpp:sm:3'/>",
+                         self.transport.value())
+
+
+    def test_nonzasNotCounted(self):
+        """
+        Stream Management elements are not counted as stanzas.
+        """
+        self.enable()
+        self.xmlstream.dataReceived("<r xmlns='urn:xmpp:sm:3'/>")
+        self.assertFalse(self.streamManager._smUnacked)
+        self.assertEqual(0, self.streamManager._smInbound)
+
+
+    def test_disconnectedHoldsRequests(self):
+        """
+        Requests are not failed when the connection of a resumable stream is
+        lost.
+        """
+        self.enable()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.assertIn('test', self.streamManager._iqDeferreds)
+        self.assertNoResult(d)
+
+
+    def test_resume(self):
+        """
+        On resumption, unacknowledged stanzas are resent, outstanding
+        requests can still be answered and handlers are notified.
+        """
+        resumed = []
+        self.handler.connectionResumed = lambda: resumed.append(True)
+
+        self.enable()
+        self.streamManager.send("<presence/>")
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.streamManager.send("<message/>")
+
+        self.connect(resumeH=1)
+        self.assertEqual("<iq type='get' id='test'/><message/>",
+                         self.transport.value())
+        self.assertEqual([True], resumed)
+        self.assertEqual(1, self.handler.doneInitialized)
+
+        self.xmlstream.dataReceived("<iq type='result' id='test'/>")
+        self.assertEqual('result', self.successResultOf(d)['type'])
+
+
+    def test_resumeCountsInbound(self):
+        """
+        The count of received stanzas continues on the resumed stream.
+        """
+        self.enable()
+        self.xmlstream.dataReceived("<message/>")
+        self.disconnect()
+        self.connect(resumeH=0)
+        self.xmlstream.dataReceived("<message/>")
+        self.disconnect()
+        self.assertEqual((u'sm1', 2), self.streamManager.resumptionInfo())
+
+
+    def test_resumptionFailed(self):
+        """
+        If resumption fails, held requests are failed.
+        """
+        self.enable()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        other = IQGetStanza()
+        other.stanzaID = 'other'
+        queued = self.streamManager.request(other)
+
+        self.streamManager.resumptionFailed()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertNoResult(queued)
+        self.assertIdentical(None, self.streamManager.resumptionInfo())
+
+
+    def test_stoppedTrying(self):
+        """
+        If no new connection will be made, held requests are failed.
+        """
+        self.enable()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.assertNoResult(d)
+
+        self.factory.stopTrying()
+        self.streamManager._stoppedTrying()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertIdentical(None, self.streamManager.resumptionInfo())
+
+
+    def test_disconnectedAfterStoppedTrying(self):
+        """
+        Requests are not held if the factory has stopped trying to connect.
+        """
+        self.enable()
+        d = self.streamManager.request(self.request)
+        self.factory.stopTrying()
+        self.streamManager._stoppedTrying()
+        self.assertNoResult(d)
+
+        self.disconnect()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertIdentical(None, self.streamManager.resumptionInfo())
+
+
+    def test_disconnectedNotReconnecting(self):
+        """
+        Requests are not held if the factory never reconnects.
+        """
+        self.factory = generic.DeferredXmlStreamFactory(
+                xmlstream.Authenticator())
+        self.streamManager = subprotocols.StreamManager(self.factory,
+                                                        self.clock)
+        self.streamManager.streamManagement = True
+        self.enable()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertIdentical(None, self.streamManager.resumptionInfo())
+
+
+    def test_notResumed(self):
+        """
+        If a new stream is not resumed, held requests are failed and
+        unacknowledged stanzas are discarded.
+        """
+        self.enable()
+        self.streamManager.send("<presence/>")
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+
+        self.connect()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertEqual("<enable xmlns='urn:xmpp:sm:3' resume='true'/>",
+                         self.transport.value())
+        self.assertEqual(2, self.handler.doneInitialized)
+
+
+
+class RequestReplayTest(unittest.TestCase):
+    """
+    Tests for replaying idempotent requests in L{subprotocols.StreamManager}.
+    """
+
+    def setUp(self):
+        self.factory = xmlstream.XmlStreamFactory(xmlstream.Authenticator())
+        self.clock = task.Clock()
+        self.streamManager = subprotocols.StreamManager(self.factory,
+                                                        self.clock)
+        self.request = IQGetStanza()
+        self.request.idempotent = True
+
+
+    def connect(self, initialize=True):
+        """
+        Set up a new connection, optionally initializing the stream.
+        """
+        self.xmlstream = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.xmlstream.transport = self.transport
+        self.xmlstream.connectionMade()
+        self.xmlstream.dataReceived(
+                "<stream:stream xmlns='jabber:client' "
+                    "xmlns:stream='http://etherx.jabber.org/streams' "
+                    "from='example.com' id='12345'>")
+        self.transport.clear()
+        if initialize:
+            self.xmlstream.dispatch(self.xmlstream,
+                                    xmlstream.STREAM_AUTHD_EVENT)
+
+
+    def disconnect(self):
+        self.xmlstream.connectionLost(failure.Failure(ConnectionDone()))
+
+
+    def test_replay(self):
+        """
+        An idempotent request is resent after reconnecting.
+        """
+        self.connect()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.assertNoResult(d)
+
+        self.connect()
+        self.assertEqual("<iq type='get' id='test'/>", self.transport.value())
+        self.xmlstream.dataReceived("<iq type='result' id='test'/>")
+        self.assertEqual('result', self.successResultOf(d)['type'])
+        self.assertFalse(self.streamManager._replayable)
+
+
+    def test_notIdempotent(self):
+        """
+        A request that is not idempotent fails when the connection is lost.
+        """
+        self.request.idempotent = False
+        self.connect()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.failureResultOf(d, ConnectionDone)
+
+
+    def test_budgetExhausted(self):
+        """
+        Once the request has been resent maxReplays times, it fails when
+        the connection is lost.
+        """
+        self.streamManager.maxReplays = 1
+        self.connect()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.connect()
+        self.disconnect()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertFalse(self.streamManager._replayable)
+
+
+    def test_budgetNone(self):
+        """
+        With no replays allowed, idempotent requests fail right away.
+        """
+        self.streamManager.maxReplays = 0
+        self.connect()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.failureResultOf(d, ConnectionDone)
+
+
+    def test_paced(self):
+        """
+        Held requests are resent in batches.
+        """
+        self.streamManager.replayBatchSize = 2
+        self.streamManager.replayInterval = 1
+        self.connect()
+        for i in xrange(3):
+            request = IQGetStanza()
+            request.stanzaID = str(i)
+            request.idempotent = True
+            self.streamManager.request(request)
+        self.disconnect()
+
+        self.connect()
+        self.assertEqual("<iq type='get' id='0'/><iq type='get' id='1'/>",
+                         self.transport.value())
+        self.clock.advance(1)
+        self.assertEqual("<iq type='get' id='0'/><iq type='get' id='1'/>"
+                         "<iq type='get' id='2'/>",
+                         self.transport.value())
+        self.assertFalse(self.clock.calls)
+
+
+    def test_stoppedTrying(self):
+        """
+        Held requests fail once no new connection will be made.
+        """
+        self.connect()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.assertNoResult(d)
+
+        self.factory.stopTrying()
+        self.streamManager._stoppedTrying()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertFalse(self.streamManager._replayable)
+
+
+    def test_disconnectedAfterStoppedTrying(self):
+        """
+        Requests are not held if the factory has stopped trying to connect.
+        """
+        self.connect()
+        d = self.streamManager.request(self.request)
+        self.factory.stopTrying()
+        self.disconnect()
+        self.failureResultOf(d, ConnectionDone)
+
+
+    def test_disconnectedNotReconnecting(self):
+        """
+        Requests are not held if the factory never reconnects.
+        """
+        factory = client.DeferredClientFactory(JID('user@example.org'),
+                                               'secret')
+        streamManager = factory.streamManager
+        xs = factory.buildProtocol(None)
+        xs.transport = proto_helpers.StringTransport()
+        xs.connectionMade()
+        xs.dispatch(xs, xmlstream.STREAM_AUTHD_EVENT)
+
+        d = streamManager.request(self.request)
+        xs.connectionLost(failure.Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+        self.assertNotIn('test', streamManager._iqDeferreds)
+
+
+    def test_pacedDisconnected(self):
+        """
+        Pending replays are cancelled when the connection is lost again.
+        """
+        self.streamManager.replayBatchSize = 1
+        self.connect()
+        for i in xrange(2):
+            request = IQGetStanza()
+            request.stanzaID = str(i)
+            request.idempotent = True
+            self.streamManager.request(request)
+        self.disconnect()
+        self.connect()
+        self.disconnect()
+        self.assertFalse(self.clock.calls)
+
+        self.connect()
+        self.assertEqual("<iq type='get' id='0'/>", self.transport.value())
+
+
+    def test_answeredWhileHeld(self):
+        """
+        A held request that is no longer outstanding is not resent.
+        """
+        self.request.timeout = 5
+        self.connect()
+        d = self.streamManager.request(self.request)
+        self.disconnect()
+        self.clock.advance(5)
+        self.failureResultOf(d, xmlstream.TimeoutError)
+
+        self.connect()
+        self.assertEqual("", self.transport.value())
+
+
+    def test_queuedNotResent(self):
+        """
+        A request still in the queue of unsent data is only sent once.
+        """
+        d = self.streamManager.request(self.request)
+        self.connect(initialize=False)
+        self.disconnect()
+        self.assertNoResult(d)
+
+        self.connect()
+        self.assertEqual("<iq type='get' id='test'/>", self.transport.value())
+
+
+    def test_queuedStoppedTrying(self):
+        """
+        A held request still in the queue fails once no new connection will
+        be made.
+        """
+        d = self.streamManager.request(self.request)
+        self.connect(initialize=False)
+        self.disconnect()
+        self.assertNoResult(d)
+
+        self.factory.stopTrying()
+        self.streamManager._stoppedTrying()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertNotIn('test', self.streamManager._iqDeferreds)
+
+
+
+class RequestManyTest(unittest.TestCase):
+    """
+    Tests for L{subprotocols.StreamManager.requestMany}.
+    """
+
+    def setUp(self):
+        self.streamManager = subprotocols.StreamManager(DummyFactory())
+        self.sent = []
+        self.streamManager.request = self.request
+
+
+    def request(self, request):
+        d = defer.Deferred()
+        self.sent.append((request, d))
+        return d
+
+
+    def makeRequests(self, *recipients):
+        requests = []
+        for recipient in recipients:
+            request = generic.Request(recipient=recipient)
+            request.stanzaID = '%s%d' % (recipient, len(requests))
+            requests.append(request)
+        return requests
+
+
+    def sentIDs(self):
+        return [request.stanzaID for request, d in self.sent]
+
+
+    def test_window(self):
+        """
+        At most C{window} requests are in flight.
+        """
+        requests = self.makeRequests('a', 'a', 'a', 'a')
+        deferreds = self.streamManager.requestMany(requests, window=2)
+        self.assertEqual(4, len(deferreds))
+        self.assertEqual(['a0', 'a1'], self.sentIDs())
+
+        self.sent[1][1].callback('response')
+        self.assertEqual(['a0', 'a1', 'a2'], self.sentIDs())
+        self.assertEqual('response', self.successResultOf(deferreds[1]))
+        self.assertNoResult(deferreds[0])
+
+
+    def test_failure(self):
+        """
+        Failed requests errback their deferreds and free up the window.
+        """
+        requests = self.makeRequests('a', 'a')
+        deferreds = self.streamManager.requestMany(requests, window=1)
+        self.sent[0][1].errback(xmlstream.TimeoutError())
+        self.assertEqual(['a0', 'a1'], self.sentIDs())
+        self.failureResultOf(deferreds[0], xmlstream.TimeoutError)
+
+
+    def test_requestRaises(self):
+        """
+        A request that raises fails its deferred without taking up room.
+        """
+        def failingRequest(request):
+            if request.stanzaID == 'a0':
+                raise ValueError("Not connected")
+            return self.request(request)
+
+        self.streamManager.request = failingRequest
+        pipeline = subprotocols._RequestPipeline(self.streamManager, 1)
+        deferreds = [pipeline.add(request)
+                     for request in self.makeRequests('a', 'a')]
+        pipeline.pump()
+        self.failureResultOf(deferreds[0], ValueError)
+        self.assertEqual(['a1'], self.sentIDs())
+
+        self.sent[0][1].callback(None)
+        self.assertEqual(0, pipeline.inFlight)
+        self.assertEqual({}, pipeline._perRecipient)
+
+
+    def test_synchronousResponses(self):
+        """
+        Requests that fire immediately don't exhaust the stack.
+        """
+        self.streamManager.request = lambda request: defer.succeed(request)
+        requests = self.makeRequests(*(['a'] * 5000))
+        deferreds = self.streamManager.requestMany(requests, window=1)
+        self.assertIdentical(requests[-1],
+                             self.successResultOf(deferreds[-1]))
+
+
+    def test_roundRobin(self):
+        """
+        Requests are sent to different recipients in turn.
+        """
+        requests = self.makeRequests('a', 'a', 'a', 'b', 'c', 'c')
+        self.streamManager.requestMany(requests, window=1)
+
+        for i in xrange(len(requests)):
+            self.sent[i][1].callback(None)
+
+        self.assertEqual(['a0', 'b3', 'c4', 'a1', 'c5', 'a2'], self.sentIDs())
+
+
+    def test_maxPerRecipient(self):
+        """
+        The number of requests in flight per recipient can be limited.
+        """
+        requests = self.makeRequests('a', 'a', 'a', 'b')
+        self.streamManager.requestMany(requests, window=5, maxPerRecipient=1)
+        self.assertEqual(['a0', 'b3'], self.sentIDs())
+
+        self.sent[1][1].callback(None)
+        self.assertEqual(['a0', 'b3'], self.sentIDs())
+
+        self.sent[0][1].callback(None)
+        self.assertEqual(['a0', 'b3', 'a1'], self.sentIDs())
+
+
+    def test_invalidWindow(self):
+        """
+        The window must hold at least one request.
+        """
+        self.assertRaises(ValueError, self.streamManager.requestMany, [],
+                          window=0)
+
+
+
 class DummyIQHandler(subprotocols.IQHandlerMixin):
     iqHandlers = {'/iq[@type="get"]': 'onGet'}
 
@@ -972,3 +2261,224 @@ class IQHandlerTest(unittest.TestCase):
         self.assertEquals('error', response['type'])
         e = error.exceptionFromStanza(response)
         self.assertEquals('feature-not-implemented', e.condition)
+
+
+    def test_matchIndexed(self):
+        """
+        Queries on the iq type and child element are matched via the index.
+        """
+
+        class Handler(DummyIQHandler):
+            iqHandlers = {
+                "/iq[@type='get']/query[@xmlns='urn:example:a']": 'onA',
+                '/iq[@type="get"]/query[@xmlns="urn:example:b"]': 'onB',
+                "/iq[@type='set']/query[@xmlns='urn:example:a']": 'onSetA',
+                }
+            called = None
+
+            def onA(self, iq):
+                self.called = 'a'
+
+            def onB(self, iq):
+                self.called = 'b'
+
+            def onSetA(self, iq):
+                self.called = 'setA'
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = 'r1'
+        iq.addElement(('urn:example:b', 'query'))
+        handler = Handler()
+        handler.handleRequest(iq)
+        self.assertEqual('b', handler.called)
+
+        index = Handler.__dict__['_iqDispatchIndex']
+        self.assertEqual(3, len(index.index))
+        self.assertEqual([], index.fallback)
+
+
+    def test_matchIndexedOtherChild(self):
+        """
+        Like XPath, the index matches on any child element of the iq.
+        """
+
+        class Handler(DummyIQHandler):
+            iqHandlers = {
+                "/iq[@type='get']/query[@xmlns='urn:example:a']": 'onA',
+                }
+            called = False
+
+            def onA(self, iq):
+                self.called = True
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = 'r1'
+        iq.addElement(('urn:example:other', 'other'))
+        iq.addElement(('urn:example:a', 'query'))
+        handler = Handler()
+        handler.handleRequest(iq)
+        self.assertTrue(handler.called)
+
+
+    def test_matchFallback(self):
+        """
+        Queries that cannot be indexed are still matched using XPath.
+        """
+
+        class Handler(DummyIQHandler):
+            iqHandlers = {
+                "/iq[@type='get']/query[@xmlns='urn:example:a']": 'onA',
+                "/iq[@type='get' or @type='set']/query": 'onOther',
+                }
+            called = None
+
+            def onA(self, iq):
+                self.called = 'a'
+
+            def onOther(self, iq):
+                self.called = 'other'
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'set'
+        iq['id'] = 'r1'
+        iq.addElement(('urn:example:a', 'query'))
+        handler = Handler()
+        handler.handleRequest(iq)
+        self.assertEqual('other', handler.called)
+
+
+    def test_indexRebuilt(self):
+        """
+        The index is rebuilt if C{iqHandlers} is replaced.
+        """
+
+        class Handler(DummyIQHandler):
+            called = None
+
+            def onGet(self, iq):
+                self.called = 'get'
+
+            def onSet(self, iq):
+                self.called = 'set'
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'set'
+        iq['id'] = 'r1'
+
+        handler = Handler()
+        handler.handleRequest(iq)
+        self.assertIdentical(None, handler.called)
+
+        handler.iqHandlers = {'/iq[@type="set"]': 'onSet'}
+        handler.handleRequest(iq)
+        self.assertEqual('set', handler.called)
+        self.assertIn('_iqDispatchIndex', handler.__dict__)
+        self.assertIn('_iqDispatchIndex', Handler.__dict__)
+
+
+    def test_indexRebuiltChanged(self):
+        """
+        The index is rebuilt if C{iqHandlers} is changed in place.
+        """
+
+        class Handler(DummyIQHandler):
+            called = None
+
+            def __init__(self):
+                DummyIQHandler.__init__(self)
+                self.iqHandlers = {'/iq[@type="get"]': 'onGet'}
+
+            def onGet(self, iq):
+                self.called = 'get'
+
+            def onSet(self, iq):
+                self.called = 'set'
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'set'
+        iq['id'] = 'r1'
+
+        handler = Handler()
+        handler.handleRequest(iq)
+        self.assertIdentical(None, handler.called)
+
+        handler.iqHandlers['/iq[@type="set"]'] = 'onSet'
+        handler.handleRequest(iq)
+        self.assertEqual('set', handler.called)
+
+
+    def test_indexRebuiltSharedChanged(self):
+        """
+        The index is rebuilt if a query is added to a shared C{iqHandlers}.
+        """
+        iqHandlers = {'/iq[@type="get"]': 'onGet'}
+
+        class Handler(DummyIQHandler):
+            called = None
+
+            def onGet(self, iq):
+                self.called = 'get'
+
+            def onSet(self, iq):
+                self.called = 'set'
+
+        Handler.iqHandlers = iqHandlers
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'set'
+        iq['id'] = 'r1'
+
+        handler = Handler()
+        handler.handleRequest(iq)
+        self.assertIdentical(None, handler.called)
+
+        iqHandlers['/iq[@type="set"]'] = 'onSet'
+        handler.handleRequest(iq)
+        self.assertEqual('set', handler.called)
+        self.assertIdentical(iqHandlers, Handler.iqHandlers)
+
+
+    def test_indexReused(self):
+        """
+        The index is not rebuilt if C{iqHandlers} is unchanged.
+        """
+
+        class Handler(DummyIQHandler):
+            def onGet(self, iq):
+                pass
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = 'r1'
+
+        handler = Handler()
+        handler.handleRequest(iq)
+        index = Handler._iqDispatchIndex
+        handler.handleRequest(iq)
+        self.assertIdentical(index, Handler._iqDispatchIndex)
+
+
+    def test_statistics(self):
+        """
+        Calls to request handlers are recorded if the parent has statistics.
+        """
+        class Handler(DummyIQHandler):
+            def onGet(self, iq):
+                return defer.fail(error.StanzaError('forbidden'))
+
+        class Parent(object):
+            statistics = subprotocols.HandlerStatistics()
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = 'r1'
+        handler = Handler()
+        handler.parent = Parent()
+        handler.handleRequest(iq)
+
+        self.assertEqual('error', handler.output[-1]['type'])
+        entry = Parent.statistics.snapshot()[reflect.qual(Handler), 'onGet']
+        self.assertEqual(1, entry['calls'])
+        self.assertEqual(1, entry['errors'])
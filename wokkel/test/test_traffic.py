@@ -0,0 +1,237 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.traffic}.
+"""
+
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.protocols.jabber.jid import JID
+
+from wokkel import traffic
+from wokkel.component import XMPPComponentServerFactory
+from wokkel.test.helpers import TestableStreamManager
+
+class TrafficTapTest(unittest.TestCase):
+    """
+    Tests for L{traffic.TrafficTap}.
+    """
+
+    def setUp(self):
+        self.tap = traffic.TrafficTap(maxEntries=3, clock=lambda: 1.5)
+
+
+    def test_record(self):
+        """
+        Recorded buffers are kept with a timestamp, serial and direction.
+        """
+        self.tap.record(traffic.RECV, "<presence/>", 1)
+        self.assertEqual([(1.5, 1, traffic.RECV, "<presence/>")],
+                         self.tap.dump())
+        self.assertEqual(1, self.tap.seen)
+        self.assertEqual(1, self.tap.recorded)
+
+
+    def test_recordUnicode(self):
+        """
+        Unicode buffers are recorded as UTF-8 encoded bytes.
+        """
+        self.tap.record(traffic.SEND, u"<message>\u00e9</message>")
+        self.assertEqual("<message>\xc3\xa9</message>", self.tap.dump()[0][3])
+
+
+    def test_ringBuffer(self):
+        """
+        Only the most recent entries are kept.
+        """
+        for i in xrange(5):
+            self.tap.record(traffic.RECV, str(i))
+        self.assertEqual(['2', '3', '4'],
+                         [entry[3] for entry in self.tap.dump()])
+        self.assertEqual(5, self.tap.recorded)
+
+
+    def test_dumpClear(self):
+        """
+        Dumping can clear the ring buffer.
+        """
+        self.tap.record(traffic.RECV, "<presence/>")
+        self.assertEqual(1, len(self.tap.dump(clear=True)))
+        self.assertEqual(0, len(self.tap))
+
+
+    def test_dumpToFile(self):
+        """
+        Entries are written to a file one per line.
+        """
+        self.tap.record(traffic.RECV, "<presence/>", 1)
+        self.tap.record(traffic.SEND, "<iq/>")
+        f = StringIO()
+        self.tap.dumpToFile(f)
+        self.assertEqual("1.500000 RECV (1): '<presence/>'\n"
+                         "1.500000 SEND: '<iq/>'\n",
+                         f.getvalue())
+
+
+    def test_sampling(self):
+        """
+        Buffers are recorded with the configured sample rate.
+        """
+        samples = iter([0.1, 0.6, 0.4])
+        self.tap.random = lambda: next(samples)
+        self.tap.sampleRate = 0.5
+        for buf in ["1", "2", "3"]:
+            self.tap.record(traffic.RECV, buf)
+        self.assertEqual(['1', '3'], [entry[3] for entry in self.tap.dump()])
+        self.assertEqual(3, self.tap.seen)
+
+
+    def test_filterKinds(self):
+        """
+        Only buffers containing the given stanza kinds are recorded.
+        """
+        self.tap.setFilters(kinds=['message', 'iq'])
+        self.tap.record(traffic.RECV, "<presence/>")
+        self.tap.record(traffic.RECV, "<message><body/></message>")
+        self.tap.record(traffic.RECV, "<iq type='get'/>")
+        self.assertEqual(["<message><body/></message>", "<iq type='get'/>"],
+                         [entry[3] for entry in self.tap.dump()])
+
+
+    def test_filterJIDs(self):
+        """
+        Only buffers mentioning the given JIDs are recorded.
+        """
+        self.tap.setFilters(jids=[JID(u'user@example.org')])
+        self.tap.record(traffic.RECV, "<presence from='other@example.org'/>")
+        self.tap.record(traffic.RECV, "<presence from='user@example.org'/>")
+        self.assertEqual(["<presence from='user@example.org'/>"],
+                         [entry[3] for entry in self.tap.dump()])
+
+
+    def test_writer(self):
+        """
+        Recorded entries are passed to the writer.
+        """
+        written = []
+
+        class Writer(object):
+            def write(self, entry):
+                written.append(entry)
+
+        self.tap.writer = Writer()
+        self.tap.record(traffic.RECV, "<presence/>")
+        self.assertEqual(self.tap.dump(), written)
+
+
+    def test_attach(self):
+        """
+        Attaching to a stream records its raw traffic.
+        """
+        xs = xmlstream.XmlStream(xmlstream.Authenticator())
+        xs.serial = 7
+        self.tap.attach(xs)
+        xs.rawDataInFn("<presence/>")
+        xs.rawDataOutFn("<iq/>")
+        self.assertEqual([(1.5, 7, traffic.RECV, "<presence/>"),
+                          (1.5, 7, traffic.SEND, "<iq/>")],
+                         self.tap.dump())
+
+
+
+class TrafficFileWriterTest(unittest.TestCase):
+    """
+    Tests for L{traffic.TrafficFileWriter}.
+    """
+
+    def test_write(self):
+        """
+        Entries written while running end up in the file.
+        """
+        path = self.mktemp()
+        writer = traffic.TrafficFileWriter(path)
+        writer.startService()
+        writer.write((1.5, 1, traffic.RECV, "<presence/>"))
+        d = writer.stopService()
+
+        def cb(_):
+            with open(path) as f:
+                self.assertEqual("1.500000 RECV (1): '<presence/>'\n",
+                                 f.read())
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_writeFull(self):
+        """
+        If the queue is full, entries are dropped.
+        """
+        writer = traffic.TrafficFileWriter(self.mktemp(), maxPending=1)
+        writer.write((1.5, 1, traffic.RECV, "<presence/>"))
+        writer.write((1.5, 1, traffic.RECV, "<presence/>"))
+        self.assertEqual(1, writer.dropped)
+
+
+    def test_stopWriteFailedFull(self):
+        """
+        If writing failed and the queue is full, stopping does not block and
+        the pending entries are discarded.
+        """
+        class FailingFile(object):
+            def write(self, data):
+                raise IOError("No space left on device")
+
+            def close(self):
+                pass
+
+        writer = traffic.TrafficFileWriter(self.mktemp(), maxPending=2)
+        writer.startService()
+        writer._file.close()
+        writer._file = FailingFile()
+        thread = writer._thread
+
+        writer.write((1.5, 1, traffic.RECV, "<presence/>"))
+        thread.join(5)
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+
+        writer.write((1.5, 1, traffic.RECV, "<presence/>"))
+        writer.write((1.5, 1, traffic.RECV, "<presence/>"))
+        self.assertIdentical(None, writer.stopService())
+        self.assertEqual(2, writer.dropped)
+
+
+
+class TrafficTapUsageTest(unittest.TestCase):
+    """
+    Tests for using a L{traffic.TrafficTap} with streams.
+    """
+
+    def test_streamManager(self):
+        """
+        A stream manager attaches its traffic tap to new streams.
+        """
+        tap = traffic.TrafficTap()
+
+        class TappedStreamManager(TestableStreamManager):
+            trafficTap = tap
+
+        streamManager = TappedStreamManager()
+        streamManager.xmlstream.rawDataInFn("<presence/>")
+        self.assertEqual(1, tap.recorded)
+
+
+    def test_componentServerFactory(self):
+        """
+        A component server factory attaches its traffic tap to new streams.
+        """
+        factory = XMPPComponentServerFactory(None)
+        factory.trafficTap = traffic.TrafficTap()
+        xs = factory.buildProtocol(None)
+        factory.makeConnection(xs)
+        xs.rawDataOutFn("<presence/>")
+        self.assertEqual([0], [entry[1] for entry in factory.trafficTap.dump()])
@@ -14,7 +14,8 @@ from twisted.words.xish import domish, utility
 
 from wokkel import xmppim
 from wokkel.generic import ErrorStanza, parseXml
-from wokkel.test.helpers import TestableRequestHandlerMixin, XmlStreamStub
+from wokkel.test.helpers import SlotsTestMixin, TestableRequestHandlerMixin
+from wokkel.test.helpers import XmlStreamStub
 
 NS_XML = 'http://www.w3.org/XML/1998/namespace'
 NS_ROSTER = 'jabber:iq:roster'
@@ -99,6 +100,129 @@ class AvailabilityPresenceTest(unittest.TestCase):
         self.assertEquals(50, presence.priority)
 
 
+    def assertToBytesEqual(self, presence):
+        """
+        Assert that toBytes renders the same as serializing toElement.
+        """
+        data = presence.toBytes()
+        self.assertEquals(presence.toElement().toXml().encode('utf-8'), data)
+        self.assertEquals('presence', data.stanzaKind)
+        return data
+
+
+    def test_toBytes(self):
+        """
+        A presence is serialized with all its fields, like toElement.
+        """
+        presence = xmppim.AvailabilityPresence(
+                recipient=JID('user@example.com'),
+                sender=JID('user@example.org/Home'),
+                show='away', priority=-5,
+                statuses={None: u'Out to <lunch> & \u2615',
+                          'nl': u"Aan 't lunchen"})
+        presence.stanzaID = u'p1'
+        data = self.assertToBytesEqual(presence)
+        self.assertEquals(u'p1', data.stanzaID)
+        self.assertIn(" xml:lang='nl'", data)
+        self.assertIn("Out to &lt;lunch&gt; &amp; \xe2\x98\x95", data)
+
+
+    def test_toBytesMinimal(self):
+        """
+        A presence without any fields has no child elements.
+        """
+        data = self.assertToBytesEqual(xmppim.AvailabilityPresence())
+        self.assertEquals('<presence/>', data)
+
+
+    def test_toBytesUnavailable(self):
+        """
+        An unavailable presence only has its statuses rendered.
+        """
+        presence = xmppim.AvailabilityPresence(available=False, show='away',
+                                               priority=5,
+                                               statuses={None: u''})
+        data = self.assertToBytesEqual(presence)
+        self.assertEquals("<presence type='unavailable'><status/></presence>",
+                          data)
+        self.assertEquals('unavailable', data.stanzaType)
+
+
+    def test_toBytesParsed(self):
+        """
+        A parsed presence is serialized with its parsed fields.
+        """
+        xml = """<presence from='user@example.org' to='user@example.com'
+                           id='p1'>
+                   <show>chat</show>
+                   <status xml:lang='en'>Let's chat!</status>
+                   <priority>50</priority>
+                   <c xmlns='http://jabber.org/protocol/caps'/>
+                 </presence>
+              """
+
+        presence = xmppim.AvailabilityPresence.fromElement(parseXml(xml))
+        self.assertToBytesEqual(presence)
+
+
+
+class MessageTest(unittest.TestCase):
+    """
+    Tests for L{xmppim.Message}.
+    """
+
+    def assertToBytesEqual(self, message):
+        """
+        Assert that toBytes renders the same as serializing toElement.
+        """
+        data = message.toBytes()
+        self.assertEquals(message.toElement().toXml().encode('utf-8'), data)
+        self.assertEquals('message', data.stanzaKind)
+        return data
+
+
+    def test_toBytes(self):
+        """
+        A message is serialized with all its fields, like toElement.
+        """
+        message = xmppim.Message(recipient=JID(u'user@example.com/Home'),
+                                 sender=JID(u'other@example.org'),
+                                 body=u"<b>Hi</b> & 'bye' \xe9",
+                                 subject=u'"Greetings"')
+        message.stanzaType = 'chat'
+        message.stanzaID = u"it's"
+        data = self.assertToBytesEqual(message)
+        self.assertEquals('chat', data.stanzaType)
+        self.assertEquals(u"it's", data.stanzaID)
+        self.assertIn(" id='it&apos;s'", data)
+        self.assertIn("<body>&lt;b&gt;Hi&lt;/b&gt; &amp; 'bye' \xc3\xa9"
+                      "</body>", data)
+
+
+    def test_toBytesMinimal(self):
+        """
+        A message without any fields has no child elements.
+        """
+        data = self.assertToBytesEqual(xmppim.Message())
+        self.assertEquals('<message/>', data)
+
+
+    def test_toBytesSubclass(self):
+        """
+        Subclasses that only override toElement are rendered by it.
+        """
+        class ThreadMessage(xmppim.Message):
+            def toElement(self):
+                element = xmppim.Message.toElement(self)
+                element.addElement('thread', content=u't1')
+                return element
+
+        message = ThreadMessage(body=u'Hello')
+        data = self.assertToBytesEqual(message)
+        self.assertIn('<thread>t1</thread>', data)
+
+
+
 class PresenceProtocolTest(unittest.TestCase):
     """
     Tests for L{xmppim.PresenceProtocol}
@@ -450,11 +574,15 @@ class PresenceProtocolTest(unittest.TestCase):
 
 
 
-class RosterItemTest(unittest.TestCase):
+class RosterItemTest(unittest.TestCase, SlotsTestMixin):
     """
     Tests for L{xmppim.RosterItem}.
     """
 
+    def makeObject(self):
+        return xmppim.RosterItem(JID(u'user@example.org'))
+
+
     def test_toElement(self):
         """
         A roster item has the correct namespace/name, lacks unset attributes.
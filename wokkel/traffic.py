@@ -0,0 +1,302 @@
+# -*- test-case-name: wokkel.test.test_traffic -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Low-overhead traffic capture for XML Streams.
+
+Setting C{logTraffic} on a stream manager or stream factory logs the
+C{repr} of every raw buffer through L{log.msg}, which is too expensive to
+leave on under production load. A L{TrafficTap} instead keeps sampled,
+filtered buffers in a bounded ring buffer that can be dumped on demand and,
+optionally, hands them off to a L{TrafficFileWriter} that writes them to disk
+from a background thread.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty, Full
+
+from twisted.application import service
+from twisted.internet import threads
+from twisted.python import log
+
+__all__ = ['TrafficTap', 'TrafficFileWriter', 'RECV', 'SEND']
+
+RECV = 'RECV'
+SEND = 'SEND'
+
+class TrafficTap(object):
+    """
+    Sampled capture of raw XML Stream traffic.
+
+    A tap is attached to one or more L{XmlStream}s with L{attach}, which
+    hooks into their C{rawDataInFn} and C{rawDataOutFn}. Each buffer that
+    passes sampling and the filters is recorded as a tuple of timestamp,
+    stream serial, direction (L{RECV} or L{SEND}) and the raw data.
+
+    Filtering works on the raw buffers, without parsing: a stanza kind
+    filter matches if a buffer contains an opening tag for one of the given
+    kinds, a JID filter matches if a buffer contains one of the given JIDs
+    verbatim. Since buffers do not necessarily align with stanza
+    boundaries, this is a heuristic that errs on the side of recording.
+
+    @ivar maxEntries: The maximum number of entries kept in the ring buffer.
+    @type maxEntries: C{int}
+    @ivar sampleRate: The fraction of buffers, between C{0} and C{1},
+        that are considered for recording.
+    @type sampleRate: C{float}
+    @ivar writer: Optional object with a C{write} method, called with each
+        recorded entry, e.g. a L{TrafficFileWriter}.
+    @ivar seen: The number of buffers passed to this tap.
+    @type seen: C{int}
+    @ivar recorded: The number of buffers recorded by this tap.
+    @type recorded: C{int}
+    """
+
+    def __init__(self, maxEntries=1000, sampleRate=1.0,
+                       kinds=None, jids=None, writer=None,
+                       clock=time.time, random=random.random):
+        """
+        @param kinds: Stanza kinds (e.g. C{'message'}) to record. If
+            C{None}, buffers are not filtered on stanza kind.
+        @type kinds: iterable of C{str}
+        @param jids: JIDs to record traffic for. If C{None}, buffers are
+            not filtered on JID.
+        @type jids: iterable of L{JID<twisted.words.protocols.jabber.jid.JID>}
+            or C{unicode}
+        @param clock: Callable returning the current time.
+        @param random: Callable returning a random float in [0, 1).
+        """
+        self.maxEntries = maxEntries
+        self.sampleRate = sampleRate
+        self.writer = writer
+        self.clock = clock
+        self.random = random
+        self.setFilters(kinds, jids)
+
+        self._entries = deque(maxlen=maxEntries)
+        self.seen = 0
+        self.recorded = 0
+
+
+    def setFilters(self, kinds=None, jids=None):
+        """
+        Replace the stanza kind and JID filters.
+
+        See L{__init__} for the parameters.
+        """
+        if kinds is None:
+            self._kindMarkers = None
+        else:
+            self._kindMarkers = tuple(('<%s' % kind).encode('utf-8')
+                                      for kind in kinds)
+
+        if jids is None:
+            self._jidMarkers = None
+        else:
+            self._jidMarkers = tuple(unicode(jid).encode('utf-8')
+                                     for jid in jids)
+
+
+    def attach(self, xs, serial=None):
+        """
+        Capture traffic of an XML Stream.
+
+        @param xs: The XML Stream to capture traffic for.
+        @type xs: L{XmlStream<twisted.words.protocols.jabber.xmlstream.XmlStream>}
+        @param serial: Identifier for the stream in recorded entries. If
+            C{None}, the stream's C{serial} attribute is used, if present.
+        """
+        if serial is None:
+            serial = getattr(xs, 'serial', None)
+
+        def dataIn(buf):
+            self.record(RECV, buf, serial)
+
+        def dataOut(buf):
+            self.record(SEND, buf, serial)
+
+        xs.rawDataInFn = dataIn
+        xs.rawDataOutFn = dataOut
+
+
+    def record(self, direction, buf, serial=None):
+        """
+        Record a raw buffer, subject to sampling and filters.
+
+        This is called for every buffer on the reactor thread, so it does
+        as little work as possible for buffers that are not recorded.
+        """
+        self.seen += 1
+
+        if self.sampleRate < 1 and self.random() >= self.sampleRate:
+            return
+
+        if isinstance(buf, unicode):
+            buf = buf.encode('utf-8')
+
+        if self._kindMarkers is not None:
+            for marker in self._kindMarkers:
+                if marker in buf:
+                    break
+            else:
+                return
+
+        if self._jidMarkers is not None:
+            for marker in self._jidMarkers:
+                if marker in buf:
+                    break
+            else:
+                return
+
+        entry = (self.clock(), serial, direction, buf)
+        self._entries.append(entry)
+        self.recorded += 1
+
+        if self.writer is not None:
+            self.writer.write(entry)
+
+
+    def dump(self, clear=False):
+        """
+        Return the entries in the ring buffer, oldest first.
+
+        @param clear: If set, empty the ring buffer.
+        @type clear: C{bool}
+        @rtype: C{list} of C{tuple}
+        """
+        entries = list(self._entries)
+        if clear:
+            self._entries.clear()
+        return entries
+
+
+    def dumpToFile(self, f, clear=False):
+        """
+        Write the entries in the ring buffer to a file.
+
+        @param f: File-like object opened for writing bytes.
+        @param clear: If set, empty the ring buffer.
+        @type clear: C{bool}
+        """
+        for entry in self.dump(clear):
+            f.write(formatEntry(entry))
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+
+def formatEntry(entry):
+    """
+    Format a recorded traffic entry as a line of text.
+
+    @param entry: Tuple of timestamp, stream serial, direction and data.
+    @rtype: C{str}
+    """
+    timestamp, serial, direction, buf = entry
+    if serial is None:
+        return "%.6f %s: %r\n" % (timestamp, direction, buf)
+    else:
+        return "%.6f %s (%s): %r\n" % (timestamp, direction, serial, buf)
+
+
+
+class TrafficFileWriter(service.Service):
+    """
+    Write recorded traffic to a file from a background thread.
+
+    The writing thread runs while this service is running.
+
+    Entries are handed over through a bounded queue. If the writing thread
+    cannot keep up, entries are dropped instead of blocking the reactor
+    thread.
+
+    @ivar dropped: The number of entries dropped because the queue was full,
+        or discarded on stop.
+    @type dropped: C{int}
+    """
+
+    _stop = object()
+
+    def __init__(self, path, maxPending=10000):
+        self.path = path
+        self.dropped = 0
+        self._queue = Queue(maxPending)
+        self._thread = None
+
+
+    def startService(self):
+        """
+        Open the file and start the writing thread.
+        """
+        service.Service.startService(self)
+        self._file = open(self.path, 'ab')
+        self._thread = threading.Thread(target=self._run,
+                                        name='TrafficFileWriter')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def stopService(self):
+        """
+        Write out pending entries, stop the writing thread and close the file.
+
+        The writing thread is waited for in the thread pool of the reactor.
+        If the queue is full, because the writing thread cannot keep up or
+        has stopped on an error, the pending entries are discarded.
+
+        @rtype: L{Deferred<twisted.internet.defer.Deferred>} or C{None}
+        """
+        service.Service.stopService(self)
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+
+        try:
+            self._queue.put_nowait(self._stop)
+        except Full:
+            self._discardPending()
+            self._queue.put_nowait(self._stop)
+
+        if thread.isAlive():
+            return threads.deferToThread(thread.join)
+
+
+    def _discardPending(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                break
+            self.dropped += 1
+
+
+    def write(self, entry):
+        """
+        Queue an entry for writing.
+        """
+        try:
+            self._queue.put_nowait(entry)
+        except Full:
+            self.dropped += 1
+
+
+    def _run(self):
+        try:
+            while True:
+                entry = self._queue.get()
+                if entry is self._stop:
+                    break
+                self._file.write(formatEntry(entry))
+                if self._queue.empty():
+                    self._file.flush()
+        except:
+            log.err(None, "Error writing traffic log")
+        finally:
+            self._file.close()
@@ -17,7 +17,7 @@ from twisted.words.protocols.jabber import error
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.xish import domish
 
-from wokkel.generic import ErrorStanza, Stanza, Request
+from wokkel.generic import ErrorStanza, SlotsPickleMixin, Stanza, Request
 from wokkel.subprotocols import IQHandlerMixin
 from wokkel.subprotocols import XMPPHandler
 
@@ -27,6 +27,17 @@ NS_ROSTER = 'jabber:iq:roster'
 XPATH_ROSTER_SET = "/iq[@type='set']/query[@xmlns='%s']" % NS_ROSTER
 
 
+def _renderTextElement(name, text, attributes=u''):
+    """
+    Serialize an element with only text content, like L{domish} would.
+    """
+    if text:
+        return u'<%s%s>%s</%s>' % (name, attributes, domish.escapeToXml(text),
+                                   name)
+    else:
+        return u'<%s%s/>' % (name, attributes)
+
+
 
 class Presence(domish.Element):
     def __init__(self, to=None, type=None):
@@ -360,6 +371,30 @@ class AvailabilityPresence(BasePresence):
         return presence
 
 
+    def _renderChildren(self):
+        if not self.available:
+            self.stanzaType = 'unavailable'
+
+        children = []
+
+        if self.available:
+            if self.show in ('chat', 'away', 'xa', 'dnd'):
+                children.append(_renderTextElement('show', self.show))
+            if self.priority != 0:
+                children.append(_renderTextElement('priority',
+                                                   unicode(self.priority)))
+
+        for lang, text in self.statuses.iteritems():
+            if lang:
+                attributes = u" xml:lang='%s'" % (
+                        domish.escapeToXml(lang, 1),)
+            else:
+                attributes = u''
+            children.append(_renderTextElement('status', text, attributes))
+
+        return children
+
+
 
 class SubscriptionPresence(BasePresence):
     """
@@ -605,7 +640,7 @@ class PresenceProtocol(BasePresenceProtocol):
 
 
 
-class RosterItem(object):
+class RosterItem(SlotsPickleMixin):
     """
     Roster item.
 
@@ -635,6 +670,10 @@ class RosterItem(object):
     @type remove: C{bool}
     """
 
+    __slots__ = ('entity', 'name', 'subscriptionTo', 'subscriptionFrom',
+                 'pendingOut', 'groups', 'approved', 'remove', '__dict__',
+                 '__weakref__')
+
     __subscriptionStates = {(False, False): None,
                             (True, False): 'to',
                             (False, True): 'from',
@@ -1038,6 +1077,17 @@ class Message(Stanza):
         return element
 
 
+    def _renderChildren(self):
+        children = []
+
+        if self.body:
+            children.append(_renderTextElement('body', self.body))
+        if self.subject:
+            children.append(_renderTextElement('subject', self.subject))
+
+        return children
+
+
 
 class MessageProtocol(XMPPHandler):
     """